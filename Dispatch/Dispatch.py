@@ -3,10 +3,12 @@ import time
 import yaml
 import os
 from Messenger import EmailSMSMessenger, SlackMessenger, TwilioMessenger
-from EventStore import SplunkEventStore
+from EventStore import SplunkEventStore, LocalEventStore, LocalEventStoreHandler, compile_conditions
+from StreamDispatch import StreamingAlertGenerator, StreamIngest
 import datetime
 import dateutil.parser
 import subprocess
+import string
 
 __description__ = "PERSEUS Dispatch server with EventStore and Messenger"
 
@@ -29,13 +31,23 @@ except IOError as e:
 
 class Dispatch(object):
 
-    def __init__(self, rules, zones, roles, update_interval=30):
-        self.event_store = SplunkEventStore()
+    def __init__(self, rules, zones, roles, update_interval=30, event_store=None, push_address=None):
+        # Pass a LocalEventStore to run without a Splunk server
+        self.event_store = event_store or SplunkEventStore()
         self.alert_router = AlertRouter(zones, roles)
         self.alert_generator = AlertGenerator(rules, self.event_store, self.alert_router)
+        # (host, port) to take listener records on, rather than polling the event store
+        self.push_address = push_address
 
     def run(self):
-        self.alert_generator.run()
+        if self.push_address:
+            generator = StreamingAlertGenerator(self.alert_generator)
+            generator.start()
+            server = StreamIngest(self.push_address, generator)
+            logging.info('Taking listener records on {0}:{1}'.format(*server.server_address))
+            server.serve_forever()
+        else:
+            self.alert_generator.run()
 
 
 class AlertGenerator(object):
@@ -63,6 +75,7 @@ class AlertGenerator(object):
         self.update_interval = 30
         self.history_interval = 120    # query earliest time offset (seconds)
         self.entry_interval = 10       # timechart time span
+        self.last_cycle = {}
 
     def review(self, host, rule, start_time, end_time):
         # Assess historical data against a particular rule and return the number of violations
@@ -91,21 +104,49 @@ class AlertGenerator(object):
 
         return number_of_alerts
 
+    def evaluate(self, rows):
+        # returns: (rule, row) for the first rule, in the given order, that any row of a host's
+        # summary meets, or (None, None)
+        for rule in self.rules:
+            for row in rows:
+                if rule.matches(row):
+                    return rule, row
+        return None, None
+
+    def run_cycle(self, query_args):
+        # Fetch every host's summary table with one query, then check each rule against the
+        # tables in memory, so the store's cost scales with hosts, not hosts x rules
+        tic = time.time()
+        summaries = self.event_store.get_summaries(self.router.hosts, self.entry_interval, query_args)
+        toc = time.time()
+
+        alerts = []
+        for host in self.router.hosts:
+            rule, row = self.evaluate(summaries.get(host, []))
+            if not rule:
+                continue
+            if rule.silent:
+                logging.debug("{0} matched {1}, no alert".format(host, rule.name))
+                continue
+            self.router.alert(host, rule, row)
+            alerts.append((host, rule, row))
+
+        self.last_cycle = {'hosts': len(self.router.hosts),
+                           'rules': len(self.rules),
+                           'alerts': len(alerts),
+                           'query_time': toc - tic,
+                           'rule_time': time.time() - toc,
+                           'cycle_time': time.time() - tic}
+        logging.debug("Update time: {cycle_time:.3f}s ({hosts} hosts, {rules} rules, {alerts} alerts; "
+                      "query {query_time:.3f}s, rules {rule_time:.3f}s)".format(**self.last_cycle))
+        return alerts
+
     def run(self):
         while 1:
-            tic = time.clock()
-
             query_args = {"latest_time": "now",
                           "earliest_time": "-{0}s".format(self.history_interval)}
-
-            for host in self.router.hosts:
-                for rule in self.rules:
-                    results = self.event_store.get_summary(host, rule.conditions, self.entry_interval, query_args)
-                    if results:
-                        self.router.alert(host, rule, results[0])
-            toc = time.clock()
-            logging.debug("Update time: " + str(toc - tic))
-            time.sleep(self.update_interval - (toc - tic))
+            self.run_cycle(query_args)
+            time.sleep(max(self.update_interval - self.last_cycle['cycle_time'], 0))
 
 
 class AlertRouter(object):
@@ -151,16 +192,34 @@ class Rule(object):
         self.priority = kwargs.get('priority')
         self.conditions = kwargs.get('conditions')
         self.alert_str = kwargs.get('alert_str')
+        # Conditions are compiled once into a predicate for summary rows
+        self.matches = compile_conditions(self.conditions)
+
+    @property
+    def silent(self):
+        # A rule without an alert_str (None, or "None" as written in YAML) still matches, to
+        # keep later rules from alerting
+        return self.alert_str in (None, 'None')
 
     def alert_msg(self, host, values):
         logging.debug(values)
 
-        s = self.alert_str.format(priority=self.priority,
-                                  host=host,
-                                  **values)
+        # Fields the summary doesn't have (BP, ...) are shown as "?"
+        fields = MissingFields(values)
+        fields.update(priority=self.priority, host=host)
+        s = string.Formatter().vformat(self.alert_str, (), fields)
         return s
 
 
+class MissingFields(dict):
+    def __missing__(self, key):
+        return '?'
+
+
+# The repo's config.yaml, wherever the tests are run from
+test_config = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.yaml')
+
+
 def test_alert_generator():
 
     generator = AlertGenerator()
@@ -179,9 +238,185 @@ def test_alert_generator():
     assert number_of_alerts == 19  # 2/minute for 9.5 minutes
 
 
+def test_alert_generator_cycle():
+    # Runs dispatch cycles against a LocalEventStore: the single query cycle must raise the
+    # same alerts as a search per host per rule (stopping at the first match), and its time
+    # should grow with hosts only
+
+    rules = [{'name': 'tachy', 'priority': 'HIGH', 'conditions': {'bpm': ['GT', 100]},
+              'alert_str': "{priority} alert at {host} | bpm: {bpm}"},
+             {'name': 'brady', 'priority': 'HIGH', 'conditions': {'bpm': ['LT', 50]},
+              'alert_str': "{priority} alert at {host} | bpm: {bpm}"},
+             {'name': 'hypoxia', 'priority': 'LOW', 'conditions': {'spo2': ['LTE', 89]},
+              'alert_str': "{priority} alert at {host} | spo2: {spo2}"},
+             {'name': 'tachy_trend', 'priority': 'LOW', 'conditions': {'bpm': ['TGT', 110]},
+              'alert_str': "{priority} alert at {host} | trending up"},
+             {'name': 'alarm', 'priority': 'LOW', 'conditions': {'alarm_code': ['MATCH', 'NOM_EVT_ECG_.*']},
+              'alert_str': "{priority} alert at {host} | {alarm_code}"}]
+
+    def cycle(hosts):
+        store = LocalEventStore()
+        start = datetime.datetime(2016, 7, 28, 11, 30, 0)
+        for h in range(hosts):
+            records = []
+            for i in range(480):
+                record = {'timestamp': start + datetime.timedelta(seconds=i/4.0),
+                          'Heart Rate': 40 + 10*(h % 8) + i/24.0,
+                          'SpO2': 86 + h % 12}
+                if h % 3 == 0:
+                    record['alarms'] = {'Alarm_T_0': {'code': 'NOM_EVT_ECG_V_TACHY', 'source': 'NOM_ECG_CARD_BEAT_RATE'}}
+                records.append(record)
+            store.add_events('bed{0}'.format(h), records)
+
+        router = AlertRouter()
+        router.hosts = set('bed{0}'.format(h) for h in range(hosts))
+        generator = AlertGenerator(rules, store, router)
+        query_args = {"latest_time": (start + datetime.timedelta(seconds=120)).isoformat(),
+                      "earliest_time": start.isoformat()}
+
+        alerts = generator.run_cycle(query_args)
+        expected = []
+        for host in router.hosts:
+            for rule in generator.rules:
+                results = store.get_summary(host, rule.conditions, generator.entry_interval, query_args)
+                if results:
+                    # Only the first matching rule counts
+                    expected.append((host, rule.name, results[0]['_time']))
+                    break
+        assert sorted(expected) == sorted((host, rule.name, row['_time']) for host, rule, row in alerts)
+        return generator.last_cycle
+
+    small = cycle(10)
+    large = cycle(30)
+    logging.debug(small)
+    logging.debug(large)
+    assert large['alerts'] > small['alerts'] > 0
+
+
+def test_local_dispatch():
+    # A listener's data logger writes to a database file through a LocalEventStoreHandler,
+    # and a Dispatch polling the same file with its own connection alerts on the records
+
+    import tempfile
+    filename = os.path.join(tempfile.mkdtemp(), 'perseus.db')
+
+    logger = logging.getLogger('PERSEUS.test_local_dispatch')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = LocalEventStoreHandler(filename, host='bed1')
+    logger.addHandler(handler)
+
+    class Router(AlertRouter):
+        def __init__(self):
+            super(Router, self).__init__()
+            self.hosts = {'bed1'}
+            self.alerts = []
+
+        def alert(self, host, rule, values):
+            self.alerts.append((host, rule.name, values))
+
+    rules = [{'name': 'tachy', 'priority': 'HIGH', 'conditions': {'bpm': ['GT', 100]},
+              'alert_str': "{priority} alert at {host} | bpm: {bpm}"}]
+    router = Router()
+    generator = AlertGenerator(rules, LocalEventStore(filename), router)
+    query_args = {"latest_time": "now", "earliest_time": "-{0}s".format(generator.history_interval)}
+
+    # Half a minute of normal rate, then a minute fast
+    start = datetime.datetime.now() - datetime.timedelta(seconds=90)
+    for i in range(360):
+        logger.info({'timestamp': start + datetime.timedelta(seconds=i/4.0),
+                     'Heart Rate': 80 if i < 120 else 130, 'SpO2': 97, 'alarms': None})
+        if i == 119:
+            assert not generator.run_cycle(query_args)
+    logger.info('Status messages are not stored')
+
+    alerts = generator.run_cycle(query_args)
+    assert alerts and router.alerts[0][:2] == ('bed1', 'tachy') and router.alerts[0][2]['bpm'] > 100
+
+    logger.removeHandler(handler)
+
+
+def test_rules():
+    # Checks the compiled config.yaml rules on hand made summary rows, including HAS,
+    # wildcards, trends, and first match ordering
+
+    with file(test_config) as f:
+        config = yaml.load(f)
+    generator = AlertGenerator(config.get('rules'), event_store=LocalEventStore(), alert_router=AlertRouter())
+
+    def first(row):
+        rule, row = generator.evaluate([row])
+        return rule and generator.rules.index(rule) + 1
+
+    # VFib matches the silent false positive rule before the MAX alert
+    row = {'alarm_source': 'NOM_ECG_CARD_BEAT_RATE', 'alarm_code': ['NOM_ECG_V_FIB_TACHY', 'NOM_EVT_HI_HR']}
+    assert first(row) == 1 and generator.rules[0].silent
+
+    # VTach with a high rate: SpO2 decides between the two MAX V.TACH rules
+    row = {'alarm_source': ['NOM_ECG_CARD_BEAT_RATE', 'NOM_ECG_V_P_C_CNT'], 'alarm_code': 'NOM_EVT_ECG_V_TACHY',
+           'bpm': 130.0, 'spo2': 85.0}
+    assert first(row) == 3
+    row['spo2'] = 95.0
+    assert first(row) == 4
+    del row['spo2']
+    assert first(row) == 4
+
+    # Wildcard codes, from the pulse oximeter
+    row = {'alarm_source': 'NOM_PULS_OXIM_SAT_O2', 'alarm_code': 'NOM_EVT_LO_PULS_RATE', 'bpm': 28.0}
+    assert first(row) == 6
+    row = {'alarm_source': 'NOM_PULS_OXIM_SAT_O2', 'alarm_code': 'NOM_EVT_LOW_SAT', 'spo2': 85.0}
+    assert first(row) == 12
+
+    # Trends use the pred_ fields
+    row = {'alarm_source': 'NOM_ECG_CARD_BEAT_RATE', 'bpm': 75.0, 'pred_bpm': 55.0}
+    assert first(row) == 10
+    row['pred_bpm'] = 115.0
+    assert first(row) == 11
+
+    # Nothing, and NEQ on sets
+    assert first({'bpm': 80.0, 'spo2': 98.0}) is None
+    matches = compile_conditions({'alarm_code': ['NEQ', 'NOM_EVT_LO*']})
+    assert matches({'alarm_code': 'NOM_EVT_HI_HR'}) and not matches({'alarm_code': ['NOM_EVT_HI_HR', 'NOM_EVT_LO_HR']})
+
+    rule = generator.rules[4]
+    assert rule.alert_msg('sample1A', row) == "V.TACH | Current HR 75.0 bpm | Current SpO2 ? % | Latest BP ? mmHg (? min ago)"
+
+
+def benchmark_rules(rows=12, hosts=30, cycles=100):
+    # Times evaluating the config.yaml rule set against in-memory summary tables, as each
+    # dispatch cycle does
+
+    with file(test_config) as f:
+        config = yaml.load(f)
+    generator = AlertGenerator(config.get('rules'), event_store=LocalEventStore(), alert_router=AlertRouter())
+
+    codes = ['NOM_EVT_ECG_V_TACHY', 'NOM_EVT_LO_SAT', 'NOM_EVT_HI_HR', 'NOM_EVT_DESAT', 'NOM_EVT_ECG_PACING']
+    sources = ['NOM_ECG_CARD_BEAT_RATE', 'NOM_PULS_OXIM_SAT_O2', 'NOM_PRESS_BLD_NONINV_SYS']
+    tables = []
+    for h in range(hosts):
+        table = []
+        for i in range(rows):
+            row = {'bpm': 60.0 + (h*7 + i) % 50, 'spo2': 90.0 + (h + i) % 10,
+                   'pred_bpm': 60.0 + (h*7 + i) % 60, 'pred_spo2': 92.0}
+            if (h + i) % 4 == 0:
+                row['alarm_code'] = codes[(h + i) % len(codes)]
+                row['alarm_source'] = sources[(h + i) % len(sources)]
+            table.append(row)
+        tables.append(table)
+
+    tic = time.time()
+    for c in range(cycles):
+        for table in tables:
+            generator.evaluate(table)
+    elapsed = (time.time() - tic)/cycles
+
+    logging.info("{0} rules x {1} hosts x {2} rows: {3:.2f} ms per cycle, {4:.1f} us per host".format(
+        len(generator.rules), hosts, rows, 1000*elapsed, 1e6*elapsed/hosts))
+
+
 def test_alert_router():
 
-    with file('config.yaml') as f:
+    with file(test_config) as f:
         config = yaml.load(f)
 
     zones = config.get('zones')
@@ -215,6 +450,24 @@ def configure_parser(parser):
     parser.add_argument('--config',
                          default='config.yaml',
                          help='YAML description of the alert rules, zones, and roles (default: config.yaml)')
+    parser.add_argument('--event_store',
+                         choices=['splunk', 'local'],
+                         default='splunk',
+                         help='Query a Splunk server, or a local SQLite event database (default: splunk)')
+    parser.add_argument('--db',
+                         default='perseus.db',
+                         help='Local event database file (default: perseus.db)')
+    parser.add_argument('--retention',
+                         type=float,
+                         default=24,
+                         help='Hours of events to keep in the local event database, 0 keeps everything (default: 24)')
+    parser.add_argument('--push',
+                         type=int,
+                         help='Evaluate rules as listener records arrive on this TCP port, instead of polling')
+    parser.add_argument('--push_host',
+                         default='0.0.0.0',
+                         help='Interface for --push (default: all)')
+    return parser
 
 
 if __name__ == "__main__":
@@ -222,5 +475,9 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
     #test_alert_generator()
+    test_rules()
+    test_alert_generator_cycle()
+    test_local_dispatch()
     test_alert_router()
+    benchmark_rules()
 
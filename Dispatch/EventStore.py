@@ -2,11 +2,25 @@
 Should support a range of event storage types.  Splunk is free for small workloads and easy
 to setup, so we focused on that.  We could also easily support an ELK stack or a custom Python
 shipper/indexer (as I wrote in the previous Perseus v0.2).
+
+LocalEventStore is such an indexer, an embedded SQLite database that answers the same
+summaries as the Splunk search, so Dispatch can run (and be load tested) offline.
 """
 
 import logging
 import yaml
 import os
+import re
+import fnmatch
+import operator
+import json
+import time
+import datetime
+import sqlite3
+import socket
+import threading
+import dateutil.parser
+import dateutil.tz
 import splunklib.client as SplunkClient
 import splunklib.results as SplunkResults
 
@@ -19,14 +33,212 @@ except IOError as e:
     print("Unable to open shadow.yaml file for additional environment vars") #Does not exist OR no read permissions
 
 
+def to_epoch(value):
+    # Seconds since the epoch for a datetime, ISO string, or number; naive times are local,
+    # as the listeners write them
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, datetime.datetime):
+        try:
+            # The listeners' isoformat, without going through the much slower general parser
+            value = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            value = dateutil.parser.parse(value)
+    if value.tzinfo is not None:
+        return (value - datetime.datetime(1970, 1, 1, tzinfo=dateutil.tz.tzutc())).total_seconds()
+    return time.mktime(value.timetuple()) + value.microsecond/1e6
+
+
+def parse_time(value, now=None):
+    # Splunk style earliest/latest times: "now", "-120s" (or m, h), an ISO string, or a number
+    now = time.time() if now is None else now
+    if value is None or value == "now":
+        return now
+    m = re.match(r'^-(\d+(?:\.\d+)?)([smh]?)$', str(value))
+    if m:
+        return now - float(m.group(1))*{'': 1, 's': 1, 'm': 60, 'h': 3600}[m.group(2)]
+    return to_epoch(value)
+
+
+class HoltPredictor(object):
+    # Holt's linear trend smoothing, updated one value (or gap) at a time, for streaming
+    # forecasts; holt_predict runs the same updates over a whole table
+
+    def __init__(self, alpha=0.5, beta=0.3):
+        self.alpha = alpha
+        self.beta = beta
+        self.level = None
+        self.trend = None
+        # Steps since the last value, gaps count
+        self.steps = 1
+
+    def forecast(self, k=1):
+        # returns: the forecast k steps on from the last step, None before any value
+        if self.level is None:
+            return None
+        return self.level + (self.steps - 1 + k)*self.trend
+
+    def skip(self, steps=1):
+        # Gaps of steps with no value
+        self.steps += steps
+
+    def update(self, value):
+        if value is None:
+            self.skip()
+            return
+        if self.level is None:
+            self.level, self.trend = value, 0.0
+        else:
+            last = self.level
+            self.level = self.alpha*value + (1 - self.alpha)*(self.level + self.steps*self.trend)
+            self.trend = self.beta*(self.level - last)/self.steps + (1 - self.beta)*self.trend
+        self.steps = 1
+
+
+def holt_predict(values, future=4, alpha=0.5, beta=0.3):
+    # Stands in for Splunk's predict: one-step-ahead forecasts from Holt's linear trend
+    # smoothing for each value, then future more steps.  Gaps (None) are skipped but still
+    # count as steps.  Forecasts are None until there is a value.
+    predictor = HoltPredictor(alpha, beta)
+    preds = []
+    for value in values:
+        preds.append(predictor.forecast())
+        predictor.update(value)
+    for k in range(future):
+        preds.append(predictor.forecast(k + 1))
+    return preds
+
+
+def record_value(record, name):
+    # A listener record field by its Splunk name, with dots into nested dicts
+    # ("Non-invasive Blood Pressure.systolic")
+    value = record.get(name)
+    if value is None and '.' in name:
+        value = record
+        for part in name.split('.'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(part)
+    return value
+
+
+def compile_conditions(conditions):
+    """
+    Compiles a rule's conditions into a predicate for summary rows, once, so rules run in
+    process instead of as a "where" clause.  Every condition must hold, and a missing field
+    fails.  Numeric ops compare floats; TLT and TGT compare the pred_ field.  On alarm
+    sets, HAS and EQ are true if any value is one of the given names, where names may use
+    glob wildcards (NOM_EVT_LO*); MATCH takes regexes, and NEQ is true if no value is.
+    """
+
+    tests = []
+    for field, spec in (conditions or {}).items():
+        op, args = spec[0], spec[1:]
+        if not args:
+            raise ValueError('No values given for {0}: {1}'.format(field, spec))
+
+        if op in ("TLT", "TGT"):
+            field = "pred_" + field
+
+        if op in NUMERIC_OPS and isinstance(args[0], (int, float)):
+            tests.append(numeric_test(field, NUMERIC_OPS[op], float(args[0])))
+        elif op in ("HAS", "EQ", "NEQ", "MATCH"):
+            tests.append(set_test(field, op, args))
+        else:
+            raise NotImplementedError('Unsupported condition {0}: {1}'.format(field, spec))
+
+    def predicate(row):
+        for test in tests:
+            if not test(row):
+                return False
+        return True
+
+    return predicate
+
+
+NUMERIC_OPS = {"GT": operator.gt, "TGT": operator.gt, "GTE": operator.ge,
+               "LT": operator.lt, "TLT": operator.lt, "LTE": operator.le,
+               "EQ": operator.eq, "NEQ": operator.ne}
+
+
+def numeric_test(field, compare, target):
+    def test(row):
+        value = row.get(field)
+        if value is None:
+            return False
+        if not isinstance(value, float):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return False
+        return compare(value, target)
+    return test
+
+
+def set_test(field, op, args):
+    # Exact names are looked up in a set, wildcards and regexes are folded into one pattern
+    if op == "MATCH":
+        names = frozenset()
+        pattern = re.compile("|".join(str(arg) for arg in args))
+        search = pattern.search
+    else:
+        names = frozenset(str(arg) for arg in args if not any(c in str(arg) for c in '*?['))
+        globs = [fnmatch.translate(str(arg)) for arg in args if str(arg) not in names]
+        search = re.compile("|".join(globs)).match if globs else None
+
+    def any_value(row):
+        values = row.get(field)
+        if values is None:
+            return None
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if value in names or (search and search(value)):
+                return True
+        return False
+
+    if op == "NEQ":
+        return lambda row: any_value(row) is False
+    return lambda row: bool(any_value(row))
+
+
 class EventStore(object):
 
+    # Numerics, averaged in each row with max_ and min_ values and pred_ trend values
+    numerics = ['bpm', 'spo2', 'bp_sys', 'bp_dia', 'bp_mean']
+
+    # Rows predicted past the end of the timechart, as predict's future_timespan
+    future_timespan = 4
+
     # Returns a table of fields from matching events ordered by host name
     # time_span refers to the duration of each row of the table
     # Start and stop time for the entire table should be set in the query_args dictionary
     def get_summary(self, host, rule, time_span, query_args):
         raise NotImplementedError
 
+    # Returns {host: table} of every field for each host, unfiltered, from one query; rules
+    # are then checked against the tables in memory with row_matches
+    def get_summaries(self, hosts, time_span, query_args):
+        raise NotImplementedError
+
+    @classmethod
+    def predict(cls, rows, time_span):
+        # Adds pred_ values for each numeric, and future_timespan rows of only predictions
+        future = [{'_time': datetime.datetime.fromtimestamp(
+                        to_epoch(rows[-1]['_time']) + (k + 1)*time_span).isoformat()}
+                  for k in range(cls.future_timespan)] if rows else []
+        for key in cls.numerics:
+            preds = holt_predict([row.get(key) for row in rows], cls.future_timespan)
+            for row, pred in zip(rows + future, preds):
+                if pred is not None:
+                    row['pred_' + key] = pred
+        return rows + future
+
+    @classmethod
+    def row_matches(cls, row, rule):
+        # True if a summary row meets every condition of a rule
+        return compile_conditions(rule)(row)
+
 
 class SplunkEventStore(EventStore):
 
@@ -34,6 +246,9 @@ class SplunkEventStore(EventStore):
     # in case the fields aren't assigned properly in a test environment
     field_names = { 'bpm': "Heart Rate",
                     'spo2': "SpO2",
+                    'bp_sys': "Non-invasive Blood Pressure.systolic",
+                    'bp_dia': "Non-invasive Blood Pressure.diastolic",
+                    'bp_mean': "Non-invasive Blood Pressure.mean",
                     'alarm_code': "alarms.{}.code",
                     'alarm_source': "alarms.{}.source"}
 
@@ -107,18 +322,17 @@ class SplunkEventStore(EventStore):
                 "[eval alarm_codes='<<FIELD>>'+\",\"+alarm_codes] | " \
             "makemv delim=\",\" alarm_codes | " \
             "timechart span={time_span}s " \
-                "avg(\"{bpm_fn}\") as bpm, "\
-                "avg(\"{spo2_fn}\") as spo2, " \
+                "{numerics}, " \
                 "values(alarm_codes) as alarm_code, " \
                 "values(alarm_sources) as alarm_source | " \
-            "predict bpm as pred_bpm future_timespan=4 | " \
-            "predict spo2 as pred_spo2 future_timespan=4 | " \
+            "{predicts} | " \
             "where {filter}" \
             .format( index=index,
                      host=host,
                      time_span=time_span,
-                     bpm_fn="Heart Rate",
-                     spo2_fn="SpO2",
+                     numerics=cls.numeric_stats_str(),
+                     predicts=" | ".join("predict {0} as pred_{0} future_timespan={1}".format(
+                         key, cls.future_timespan) for key in cls.numerics),
                      filter=" AND ".join(qitems) )
 
         return q
@@ -136,14 +350,272 @@ class SplunkEventStore(EventStore):
             # logging.debug(dict(item))
         return r
 
+    @classmethod
+    def perseus_hosts_to_query_str(cls, index, hosts, time_span=30):
+        # One search for every host's summary table; predict has no "by" clause, so the
+        # pred_ values are added afterwards
+
+        q = "search index={index} ({hosts}) | "\
+            "eval alarm_sources=\"\" | "\
+            "foreach alarms.*.source " \
+                "[eval alarm_sources='<<FIELD>>'+\",\"+alarm_sources] | " \
+            "makemv delim=\",\" alarm_sources | " \
+            "eval alarm_codes=\"\" | " \
+            "foreach alarms.*.code " \
+                "[eval alarm_codes='<<FIELD>>'+\",\"+alarm_codes] | " \
+            "makemv delim=\",\" alarm_codes | " \
+            "bin _time span={time_span}s | " \
+            "stats {numerics}, " \
+                "values(alarm_codes) as alarm_code, " \
+                "values(alarm_sources) as alarm_source " \
+                "by host _time" \
+            .format( index=index,
+                     hosts=" OR ".join("host={0}".format(host) for host in sorted(hosts)),
+                     time_span=time_span,
+                     numerics=cls.numeric_stats_str() )
+
+        return q
+
+    @classmethod
+    def numeric_stats_str(cls):
+        # avg(...) as bpm, max(...) as max_bpm, min(...) as min_bpm, ... for each numeric
+        return ", ".join("avg(\"{0}\") as {1}, max(\"{0}\") as max_{1}, min(\"{0}\") as min_{1}".format(
+            cls.field_names[key], key) for key in cls.numerics)
+
+    def get_summaries(self, hosts, time_span=30, query_args={}):
+
+        query_str = self.perseus_hosts_to_query_str(self.index, hosts, time_span)
+        response = self.service.jobs.oneshot(query_str, **dict({'count': 0}, **query_args))
+        reader = SplunkResults.ResultsReader(response)
+        return self.summary_tables(reader, time_span)
+
+    @classmethod
+    def summary_tables(cls, items, time_span=30):
+        # returns: {host: table} from the "stats ... by host _time" results, with the empty
+        # bins filled in and pred_ values added, as the per host timechart and predict would
+
+        binned = {}
+        for item in items:
+            if not isinstance(item, dict):
+                # Diagnostic messages
+                continue
+            row = dict(item)
+            host = row.pop('host')
+            t = to_epoch(row['_time'])
+            for key in cls.numerics:
+                for field in (key, 'max_' + key, 'min_' + key):
+                    if row.get(field) not in (None, ''):
+                        row[field] = float(row[field])
+                    else:
+                        # Empty stats values are nulls, not gaps for the predict to trip on
+                        row.pop(field, None)
+            binned.setdefault(host, {})[int(t//time_span)] = row
+
+        # stats leaves out empty bins, timechart would have kept them
+        tables = {}
+        for host, rows in binned.items():
+            first, last = min(rows), max(rows)
+            tables[host] = cls.predict(
+                [rows.get(b) or {'_time': datetime.datetime.fromtimestamp(b*time_span).isoformat()}
+                 for b in range(first, last + 1)], time_span)
+        return tables
+
+
+class LocalEventStore(EventStore):
+    # Keeps listener records in an embedded SQLite database (WAL mode, so listeners can write
+    # while Dispatch reads) and answers get_summary like the Splunk search: a timechart of
+    # average (and max/min) numerics and alarm code/source sets, pred_ trend values, filtered
+    # by the rule.  Runs fully offline; filename=':memory:' keeps everything in process.
+    # With retention (secs), events older than that are deleted as new ones are added, at most
+    # every prune_interval secs, so a long running file stops growing; without it, as for
+    # back-testing old logs, nothing is ever deleted.
+
+    # Mapping between cardinal field names (keys) and listener record field names (values)
+    field_names = {'bpm': "Heart Rate",
+                   'spo2': "SpO2",
+                   'bp_sys': "Non-invasive Blood Pressure.systolic",
+                   'bp_dia': "Non-invasive Blood Pressure.diastolic",
+                   'bp_mean': "Non-invasive Blood Pressure.mean"}
+
+    def __init__(self, filename=':memory:', retention=None, prune_interval=60, **kwargs):
+        self.filename = filename
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.pruned_at = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS numerics (host TEXT, time REAL, {0})'.format(
+            ', '.join('{0} REAL'.format(key) for key in sorted(self.field_names))))
+        # Databases from before a numeric was added get its column
+        columns = [column[1] for column in self.db.execute('PRAGMA table_info(numerics)')]
+        for key in sorted(self.field_names):
+            if key not in columns:
+                self.db.execute('ALTER TABLE numerics ADD COLUMN {0} REAL'.format(key))
+        self.db.execute('CREATE INDEX IF NOT EXISTS numerics_host_time ON numerics (host, time)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS alarms (host TEXT, time REAL, code TEXT, source TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS alarms_host_time ON alarms (host, time)')
+        if retention:
+            # For pruning every host at once
+            self.db.execute('CREATE INDEX IF NOT EXISTS numerics_time ON numerics (time)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS alarms_time ON alarms (time)')
+        self.db.commit()
+
+    def add_events(self, host, records):
+        # Ingests listener records (dicts as logged, timestamps as datetimes or ISO strings)
+        numerics = []
+        alarms = []
+        keys = sorted(self.field_names)
+        for record in records:
+            t = to_epoch(record['timestamp'])
+            values = [record_value(record, self.field_names[key]) for key in keys]
+            if any(value is not None for value in values):
+                numerics.append([host, t] + values)
+            for alarm in (record.get('alarms') or {}).values():
+                alarms.append((host, t, alarm.get('code'), alarm.get('source')))
+
+        with self.lock:
+            self.db.executemany('INSERT INTO numerics (host, time, {0}) VALUES ({1})'.format(
+                ', '.join(keys), ', '.join('?'*(len(keys) + 2))), numerics)
+            self.db.executemany('INSERT INTO alarms VALUES (?, ?, ?, ?)', alarms)
+            self.db.commit()
+
+        now = time.time()
+        if self.retention and now >= self.pruned_at + self.prune_interval:
+            self.prune(now)
+
+    def prune(self, now=None):
+        # Deletes events older than the retention period; returns: the number of rows deleted
+        now = time.time() if now is None else now
+        self.pruned_at = now
+        if not self.retention:
+            return 0
+        with self.lock:
+            deleted = self.db.execute('DELETE FROM numerics WHERE time<?', (now - self.retention,)).rowcount
+            deleted += self.db.execute('DELETE FROM alarms WHERE time<?', (now - self.retention,)).rowcount
+            self.db.commit()
+        if deleted:
+            logging.debug('Pruned {0} events older than {1}s from {2}'.format(deleted, self.retention, self.filename))
+        return deleted
+
+    def add_event(self, host, record):
+        self.add_events(host, [record])
+
+    def load(self, filename, host):
+        # Ingests a listener's JSON event log, one record per line
+        with open(filename) as f:
+            self.add_events(host, (json.loads(line) for line in f if line.strip()))
+
+    def timecharts(self, hosts, time_span, earliest, latest):
+        # returns: {host: a row per time_span bin from earliest[host] to latest[host], oldest first},
+        # from one query per table for every host
+        keys = sorted(self.field_names)
+        first = dict((host, int(earliest[host]//time_span)) for host in hosts)
+        last = {}
+        for host in hosts:
+            last[host] = int(latest[host]//time_span)
+            if latest[host] % time_span == 0:
+                last[host] -= 1
+        where = 'host IN ({0}) AND time>=? AND time<?'.format(', '.join('?'*len(hosts)))
+        args = [time_span] + list(hosts) + [min(earliest.values()), max(latest.values())]
+
+        with self.lock:
+            numerics = self.db.execute(
+                'SELECT host, CAST(time/? AS INTEGER) AS bin, {0} FROM numerics '
+                'WHERE {1} GROUP BY host, bin'.format(
+                    ', '.join('AVG({0}), MAX({0}), MIN({0})'.format(key) for key in keys), where),
+                args).fetchall()
+            alarms = self.db.execute(
+                'SELECT DISTINCT host, CAST(time/? AS INTEGER), code, source FROM alarms WHERE {0}'.format(where),
+                args).fetchall()
+
+        tables = dict((host, [{'_time': datetime.datetime.fromtimestamp(b*time_span).isoformat()}
+                              for b in range(first[host], last[host] + 1)]) for host in hosts)
+
+        def row(host, b):
+            if first[host] <= b <= last[host]:
+                return tables[host][b - first[host]]
+
+        for values in numerics:
+            r = row(values[0], values[1])
+            if r is None:
+                continue
+            for i, key in enumerate(keys):
+                if values[2 + 3*i] is not None:
+                    r[key], r['max_' + key], r['min_' + key] = values[2 + 3*i:5 + 3*i]
+
+        codes = {}
+        for host, b, code, source in alarms:
+            if code is not None:
+                codes.setdefault((host, b, 'alarm_code'), set()).add(code)
+            if source is not None:
+                codes.setdefault((host, b, 'alarm_source'), set()).add(source)
+        for (host, b, key), values in codes.items():
+            r = row(host, b)
+            if r is None:
+                continue
+            # Multivalue fields come back as lists, single values as strings, as from Splunk
+            values = sorted(values)
+            r[key] = values if len(values) > 1 else values[0]
+
+        return tables
+
+    def get_summaries(self, hosts, time_span=30, query_args={}):
+
+        # Without a time range, each timechart spans the host's events, as an all time search
+        hosts = list(hosts)
+        now = time.time()
+        earliest = query_args.get("earliest_time")
+        latest = query_args.get("latest_time")
+        if earliest is None or latest is None:
+            with self.lock:
+                extents = self.db.execute(
+                    'SELECT host, MIN(time), MAX(time) FROM numerics WHERE host IN ({0}) GROUP BY host'.format(
+                        ', '.join('?'*len(hosts))), hosts).fetchall()
+            extents = dict((host, (first, last)) for host, first, last in extents)
+            hosts = [host for host in hosts if host in extents]
+        if not hosts:
+            return {}
+        earliest = dict((host, extents[host][0] if earliest is None else parse_time(earliest, now)) for host in hosts)
+        latest = dict((host, extents[host][1] + time_span/2.0 if latest is None else parse_time(latest, now))
+                      for host in hosts)
+
+        tables = self.timecharts(hosts, time_span, earliest, latest)
+        return dict((host, self.predict(rows, time_span)) for host, rows in tables.items())
+
+    def get_summary(self, host, rule, time_span=30, query_args={}):
+        rows = self.get_summaries([host], time_span, query_args).get(host, [])
+        matches = compile_conditions(rule)
+        return [row for row in rows if matches(row)]
+
+
+class LocalEventStoreHandler(logging.Handler):
+    # Writes a listener's data records into a LocalEventStore file, as one of its data log
+    # sinks, so a Dispatch polling the same file (--event_store local) sees them as they come
+
+    host = socket.gethostname()
+
+    def __init__(self, filename, host=None, retention=None):
+        super(LocalEventStoreHandler, self).__init__()
+        self.store = LocalEventStore(filename, retention=retention)
+        self.host = host or LocalEventStoreHandler.host
+
+    def emit(self, record):
+        if not isinstance(record.msg, dict): return
+        if record.levelno != logging.INFO: return
+        if not record.msg.get('timestamp'): return
+        try:
+            self.store.add_event(self.host, record.msg)
+        except Exception:
+            self.handleError(record)
+
 
 def test_splunk_event_store():
 
     index="ppg"
     host = "s20"
 
-    splunk = SplunkEventStore(index=index)
-
     # TEST A SIMPLE QUERY
     rule_str = """
     bpm: [GT, 0]
@@ -152,7 +624,27 @@ def test_splunk_event_store():
     query_str = SplunkEventStore.perseus_rule_to_query_str(index, host, rule)
     logging.debug(query_str)
 
-    assert query_str == '''search index=ppg host=s20 | eval alarm_sources="" | foreach alarms.*.source [eval alarm_sources='<<FIELD>>'+","+alarm_sources] | makemv delim="," alarm_sources | eval alarm_codes="" | foreach alarms.*.code [eval alarm_codes='<<FIELD>>'+","+alarm_codes] | makemv delim="," alarm_codes | timechart span=30s avg("Heart Rate") as bpm, avg("SpO2") as spo2, values(alarm_codes) as alarm_code, values(alarm_sources) as alarm_source | predict bpm as pred_bpm future_timespan=4 | predict spo2 as pred_spo2 future_timespan=4 | where bpm>0'''
+    assert query_str == 'search index=ppg host=s20 | eval alarm_sources="" | foreach alarms.*.source [eval alarm_sources=\'<<FIELD>>\'+","+alarm_sources] | makemv delim="," alarm_sources | eval alarm_codes="" | foreach alarms.*.code [eval alarm_codes=\'<<FIELD>>\'+","+alarm_codes] | makemv delim="," alarm_codes | ' \
+        'timechart span=30s avg("Heart Rate") as bpm, max("Heart Rate") as max_bpm, min("Heart Rate") as min_bpm, avg("SpO2") as spo2, max("SpO2") as max_spo2, min("SpO2") as min_spo2, ' \
+        'avg("Non-invasive Blood Pressure.systolic") as bp_sys, max("Non-invasive Blood Pressure.systolic") as max_bp_sys, min("Non-invasive Blood Pressure.systolic") as min_bp_sys, ' \
+        'avg("Non-invasive Blood Pressure.diastolic") as bp_dia, max("Non-invasive Blood Pressure.diastolic") as max_bp_dia, min("Non-invasive Blood Pressure.diastolic") as min_bp_dia, ' \
+        'avg("Non-invasive Blood Pressure.mean") as bp_mean, max("Non-invasive Blood Pressure.mean") as max_bp_mean, min("Non-invasive Blood Pressure.mean") as min_bp_mean, ' \
+        'values(alarm_codes) as alarm_code, values(alarm_sources) as alarm_source | ' \
+        'predict bpm as pred_bpm future_timespan=4 | predict spo2 as pred_spo2 future_timespan=4 | predict bp_sys as pred_bp_sys future_timespan=4 | ' \
+        'predict bp_dia as pred_bp_dia future_timespan=4 | predict bp_mean as pred_bp_mean future_timespan=4 | where bpm>0'
+
+    # TEST THE MULTI-HOST QUERY, one stats search by host in place of the timechart and predicts
+    query_str = SplunkEventStore.perseus_hosts_to_query_str(index, ["s21", host])
+    logging.debug(query_str)
+
+    assert query_str == 'search index=ppg (host=s20 OR host=s21) | eval alarm_sources="" | foreach alarms.*.source [eval alarm_sources=\'<<FIELD>>\'+","+alarm_sources] | makemv delim="," alarm_sources | eval alarm_codes="" | foreach alarms.*.code [eval alarm_codes=\'<<FIELD>>\'+","+alarm_codes] | makemv delim="," alarm_codes | ' \
+        'bin _time span=30s | stats avg("Heart Rate") as bpm, max("Heart Rate") as max_bpm, min("Heart Rate") as min_bpm, avg("SpO2") as spo2, max("SpO2") as max_spo2, min("SpO2") as min_spo2, ' \
+        'avg("Non-invasive Blood Pressure.systolic") as bp_sys, max("Non-invasive Blood Pressure.systolic") as max_bp_sys, min("Non-invasive Blood Pressure.systolic") as min_bp_sys, ' \
+        'avg("Non-invasive Blood Pressure.diastolic") as bp_dia, max("Non-invasive Blood Pressure.diastolic") as max_bp_dia, min("Non-invasive Blood Pressure.diastolic") as min_bp_dia, ' \
+        'avg("Non-invasive Blood Pressure.mean") as bp_mean, max("Non-invasive Blood Pressure.mean") as max_bp_mean, min("Non-invasive Blood Pressure.mean") as min_bp_mean, ' \
+        'values(alarm_codes) as alarm_code, values(alarm_sources) as alarm_source by host _time'
+
+    splunk = SplunkEventStore(index=index)
 
     # TEST THAT VALID QUERY RETURNS ALL LINES
     response = splunk.get_summary(host, rule, 30)
@@ -182,7 +674,117 @@ def test_splunk_event_store():
     logging.debug(len(response))
     assert len(response) == 15
 
+
+def test_splunk_summary_tables():
+
+    # Canned "stats ... by host _time" results, as the ResultsReader yields them: string
+    # values, a diagnostic message, and s20 has no events in the 11:31:00 bin
+    items = [{'host': 's20', '_time': '2016-07-28T11:30:00.000-04:00', 'bpm': '80', 'max_bpm': '82', 'min_bpm': '78',
+              'spo2': '97', 'alarm_code': ['NOM_EVT_ECG_TACHY', 'NOM_EVT_HI_HR']},
+             {'host': 's21', '_time': '2016-07-28T11:30:00.000-04:00', 'bpm': '60', 'spo2': ''},
+             "Search results may be incomplete",
+             {'host': 's20', '_time': '2016-07-28T11:30:30.000-04:00', 'bpm': '90', 'spo2': '96'},
+             {'host': 's20', '_time': '2016-07-28T11:31:30.000-04:00', 'bpm': '110', 'spo2': '95'}]
+
+    tables = SplunkEventStore.summary_tables(items, 30)
+    assert sorted(tables) == ['s20', 's21']
+
+    # TEST THE BIN FILL, 4 bins (one empty) and future_timespan forecasts
+    rows = tables['s20']
+    assert len(rows) == 4 + SplunkEventStore.future_timespan
+    assert [row.get('bpm') for row in rows[:4]] == [80.0, 90.0, None, 110.0]
+    assert rows[0]['max_bpm'] == 82.0 and rows[0]['alarm_code'] == ['NOM_EVT_ECG_TACHY', 'NOM_EVT_HI_HR']
+    assert 'host' not in rows[0] and sorted(rows[2]) == ['_time', 'pred_bpm', 'pred_spo2']
+    assert to_epoch(rows[2]['_time']) - to_epoch(rows[1]['_time']) == 30
+    assert to_epoch(rows[4]['_time']) - to_epoch(rows[3]['_time']) == 30
+
+    # TEST THE PREDICT, the same Holt forecasts as for a per host timechart, gaps counted as steps
+    preds = holt_predict([80.0, 90.0, None, 110.0], SplunkEventStore.future_timespan)
+    assert [row.get('pred_bpm') for row in rows] == preds
+    assert rows[-1]['pred_bpm'] > 110 and 'bpm' not in rows[-1]
+
+    # Empty values stay unset, a single bin still gets its forecasts
+    rows = tables['s21']
+    assert len(rows) == 1 + SplunkEventStore.future_timespan
+    assert rows[0]['bpm'] == 60.0 and 'spo2' not in rows[0] and 'pred_spo2' not in rows[-1]
+    assert [row['pred_bpm'] for row in rows[1:]] == [60.0]*SplunkEventStore.future_timespan
+
+
+def test_local_event_store():
+
+    host = "sample1A"
+    store = LocalEventStore()
+
+    # 20 minutes of records every 2 secs, bpm climbing from 60 to 120 after 10 minutes, with
+    # a tachy alarm over the last 2 minutes and NIBP every 5 minutes
+    start = datetime.datetime(2016, 7, 28, 11, 30, 0)
+    records = []
+    for i in range(600):
+        t = start + datetime.timedelta(seconds=2*i)
+        record = {'timestamp': t.isoformat(),
+                  'Heart Rate': 60 if i < 300 else 60 + (i - 300)/5.0,
+                  'SpO2': 97,
+                  'alarms': None}
+        if i % 150 == 0:
+            record['Non-invasive Blood Pressure'] = {'systolic': 120 + i/10, 'diastolic': 80, 'mean': 93}
+        if i >= 540:
+            record['alarms'] = {'Alarm_T_0': {'code': 'NOM_EVT_ECG_TACHY', 'source': 'NOM_ECG_CARD_BEAT_RATE'},
+                                'Alarm_T_1': {'code': 'NOM_EVT_HI_HR', 'source': 'NOM_ECG_CARD_BEAT_RATE'}}
+        records.append(record)
+    store.add_events(host, records)
+
+    # TEST THAT VALID QUERY RETURNS ALL LINES, plus the predicted ones
+    rule = yaml.load("bpm: [GT, 0]")
+    response = store.get_summary(host, rule, 30)
+    logging.debug(len(response))
+    assert len(response) == 40
+    assert response[0]['bpm'] == 60 and response[0]['spo2'] == 97
+    assert round(response[-1]['max_bpm'], 1) == 119.8 and response[-1]['min_bpm'] == 117
+
+    # TEST NIBP, one row per reading
+    response = store.get_summary(host, yaml.load("bp_sys: [GT, 0]"), 30)
+    assert [row['bp_sys'] for row in response] == [120, 135, 150, 165]
+    assert response[0]['bp_dia'] == 80 and 'pred_bp_sys' in response[-1]
+
+    # TEST THAT A TIME RESTRICTED QUERY RETURNS FEWER LINES
+    query_args = {"earliest_time": (start + datetime.timedelta(minutes=5)).isoformat(),
+                  "latest_time":   (start + datetime.timedelta(minutes=15)).isoformat()}
+    response = store.get_summary(host, rule, 30, query_args)
+    assert len(response) == 20
+
+    # TEST ALARM SETS
+    rule = yaml.load("alarm_code: [MATCH, NOM_EVT_ECG_TACHY]")
+    response = store.get_summary(host, rule, 30)
+    assert len(response) == 4
+    assert response[0]['alarm_code'] == ['NOM_EVT_ECG_TACHY', 'NOM_EVT_HI_HR']
+    assert response[0]['alarm_source'] == 'NOM_ECG_CARD_BEAT_RATE'
+
+    # TEST A TREND QUERY, the forecasts past the end of the data keep climbing
+    rule = yaml.load("bpm: [TGT, 120]")
+    response = store.get_summary(host, rule, 30)
+    assert response and all('bpm' not in row for row in response)
+    assert len(store.get_summary(host, yaml.load("pred_bpm: [GT, 100]"), 30)) > 4
+
+    # TEST RELATIVE TIMES, nothing has been logged in the last two minutes
+    response = store.get_summary(host, {}, 10, {"latest_time": "now", "earliest_time": "-120s"})
+    assert len(response) >= 16 and all(list(row) == ['_time'] for row in response)
+
+    # TEST RETENTION, writing an hour of records keeps only the last 10 minutes, and a store
+    # without retention (as for the back-test above) keeps everything
+    store = LocalEventStore(retention=600, prune_interval=0)
+    now = time.time()
+    store.add_events(host, [{'timestamp': now - 3600 + 2*i, 'Heart Rate': 80, 'alarms': None if i % 10 else
+                             {'Alarm_T_0': {'code': 'NOM_EVT_HI_HR', 'source': 'NOM_ECG_CARD_BEAT_RATE'}}}
+                            for i in range(1800)])
+    oldest, count = store.db.execute('SELECT MIN(time), COUNT(*) FROM numerics').fetchone()
+    assert oldest >= now - 600 and count <= 300
+    assert store.db.execute('SELECT MIN(time) FROM alarms').fetchone()[0] >= now - 600
+    assert LocalEventStore().prune() == 0
+
+
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
+    test_local_event_store()
+    test_splunk_summary_tables()
     test_splunk_event_store()
@@ -0,0 +1,694 @@
+"""
+Push based alerting for PERSEUS Dispatch
+
+Listeners stream their records to an ingest socket (one JSON object per line, either a record
+with a "host" field or {"host": ..., "event": record} as HEC events are written) instead of
+Dispatch polling the event store every update_interval.  Each host keeps a sliding window of
+entry_interval bins (average, max and min numerics, alarm code/source sets), window-wide
+aggregates, and a Holt trend predictor per numeric, updated in O(1) as records arrive.  The
+rules are checked against the host's open bin as each record lands: alarm codes and sources
+count straight away, but a numeric only once the bin holds min_samples of its values, so a
+lone outlier record at the start of a bin can't raise a GT/LT alert on its own.  A bin is
+checked as a whole with its forecasts, as a poll would see it, when it closes, either on the
+host's first record for a later bin or, if the host has gone quiet, on a wall clock timer.
+
+Polling (AlertGenerator.run) remains for back-testing against stored events.
+"""
+
+import collections
+import datetime
+import json
+import logging
+import threading
+import time
+
+try:
+    import SocketServer
+except ImportError:
+    import socketserver as SocketServer
+
+from EventStore import EventStore, LocalEventStore, HoltPredictor, record_value, to_epoch
+
+
+class HostWindow(object):
+    # Summary rows for one host, kept as records arrive: a row per time_span bin for the last
+    # history secs, in the same form as LocalEventStore.get_summaries.  For the window as a
+    # whole, each numeric also keeps a running sum and count and monotonic max/min deques of
+    # the closed bins, so aggregate() is O(1); adding a record is O(1) amortized.
+
+    field_names = LocalEventStore.field_names
+    numerics = EventStore.numerics
+
+    def __init__(self, time_span=10, history=120, future=EventStore.future_timespan):
+        self.time_span = time_span
+        self.future = future
+        # Closed bins in the window, oldest first, and the open one
+        self.length = max(int(history//time_span), 1)
+        self.bins = collections.deque()
+        self.current = None
+        # Latest record time seen
+        self.last_time = None
+        # The last closed bin's row and its forecasts, as a poll at its close would have seen them
+        self.closed = []
+        self.predictors = dict((key, HoltPredictor()) for key in self.numerics)
+        # Over the closed bins: [sum, count] of values, and (bin, value) deques with the
+        # window max (min) at the front
+        self.totals = dict((key, [0.0, 0]) for key in self.numerics)
+        self.maxima = dict((key, collections.deque()) for key in self.numerics)
+        self.minima = dict((key, collections.deque()) for key in self.numerics)
+
+    def new_bin(self, b):
+        # stats are [sum, count, max, min] for each numeric
+        return {'bin': b, 'stats': dict((key, [0.0, 0, None, None]) for key in self.numerics),
+                'alarm_code': set(), 'alarm_source': set(), 'records': 0}
+
+    def push_extremes(self, key, b, hi, lo):
+        maxima, minima = self.maxima[key], self.minima[key]
+        while maxima and maxima[-1][1] <= hi:
+            maxima.pop()
+        maxima.append((b, hi))
+        while minima and minima[-1][1] >= lo:
+            minima.pop()
+        minima.append((b, lo))
+
+    def close_bin(self, b):
+        # Moves on to bin b, feeding the closed bin (and any empty ones skipped) to the
+        # predictors and the window totals, then ages out bins older than the window
+        closed = self.current
+        self.closed = []
+        if closed:
+            self.closed = [self.row(closed)] + \
+                          [{'_time': datetime.datetime.fromtimestamp((closed['bin'] + k + 1)*self.time_span).isoformat()}
+                           for k in range(self.future)]
+            for key, (total, count, hi, lo) in closed['stats'].items():
+                predictor = self.predictors[key]
+                preds = [predictor.forecast()]
+                predictor.update(total/count if count else None)
+                preds += [predictor.forecast(k + 1) for k in range(self.future)]
+                predictor.skip(b - closed['bin'] - 1)
+                for row, pred in zip(self.closed, preds):
+                    if pred is not None:
+                        row['pred_' + key] = pred
+                if count:
+                    self.totals[key][0] += total
+                    self.totals[key][1] += count
+                    self.push_extremes(key, closed['bin'], hi, lo)
+            self.bins.append(closed)
+        self.current = self.new_bin(b)
+
+        while self.bins and self.bins[0]['bin'] < b - self.length:
+            old = self.bins.popleft()
+            for key, (total, count, hi, lo) in old['stats'].items():
+                if not count:
+                    continue
+                self.totals[key][0] -= total
+                self.totals[key][1] -= count
+                if self.maxima[key][0][0] == old['bin']:
+                    self.maxima[key].popleft()
+                if self.minima[key][0][0] == old['bin']:
+                    self.minima[key].popleft()
+
+    def add(self, record, t=None):
+        # Adds a listener record to its bin; returns False if it is too old to count
+        if t is None:
+            t = to_epoch(record['timestamp'])
+        b = int(t//self.time_span)
+        self.last_time = t if self.last_time is None else max(self.last_time, t)
+
+        if self.current is None or b > self.current['bin']:
+            self.close_bin(b)
+        late = b < self.current['bin']
+        if not late:
+            target = self.current
+        else:
+            # Late, add it to its closed bin if that is still in the window; the forecasts
+            # have already moved on
+            target = None
+            for old in self.bins:
+                if old['bin'] == b:
+                    target = old
+            if target is None:
+                return False
+        target['records'] += 1
+
+        for key, name in self.field_names.items():
+            value = record_value(record, name)
+            if value is None:
+                continue
+            stats = target['stats'][key]
+            stats[0] += value
+            stats[1] += 1
+            if stats[2] is None or value > stats[2]:
+                stats[2] = value
+            if stats[3] is None or value < stats[3]:
+                stats[3] = value
+            if late:
+                self.totals[key][0] += value
+                self.totals[key][1] += 1
+                # Rare enough to rebuild the deques for, in window order
+                self.maxima[key].clear()
+                self.minima[key].clear()
+                for old in self.bins:
+                    if old['stats'][key][1]:
+                        self.push_extremes(key, old['bin'], old['stats'][key][2], old['stats'][key][3])
+
+        for alarm in (record.get('alarms') or {}).values():
+            if alarm.get('code') is not None:
+                target['alarm_code'].add(alarm['code'])
+            if alarm.get('source') is not None:
+                target['alarm_source'].add(alarm['source'])
+        return True
+
+    def aggregate(self, key):
+        # returns: {'avg', 'max', 'min', 'count'} of a numeric over the window, including the
+        # open bin, or None if it has no values
+        total, count = self.totals[key]
+        hi = self.maxima[key][0][1] if self.maxima[key] else None
+        lo = self.minima[key][0][1] if self.minima[key] else None
+        if self.current and self.current['stats'][key][1]:
+            bin_total, bin_count, bin_hi, bin_lo = self.current['stats'][key]
+            total += bin_total
+            count += bin_count
+            hi = bin_hi if hi is None else max(hi, bin_hi)
+            lo = bin_lo if lo is None else min(lo, bin_lo)
+        if not count:
+            return None
+        return {'avg': total/count, 'max': hi, 'min': lo, 'count': count}
+
+    def row(self, summary, min_samples=1):
+        # returns: a summary row for a bin, multivalue fields as lists and single values as strings;
+        # numerics with fewer than min_samples values are left out
+        ret = {'_time': datetime.datetime.fromtimestamp(summary['bin']*self.time_span).isoformat()}
+        for key, (total, count, hi, lo) in summary['stats'].items():
+            if count and count >= min_samples:
+                ret[key] = total/count
+                ret['max_' + key] = hi
+                ret['min_' + key] = lo
+        for key in ['alarm_code', 'alarm_source']:
+            values = sorted(summary[key])
+            if values:
+                ret[key] = values if len(values) > 1 else values[0]
+        return ret
+
+    def current_rows(self):
+        # returns: the open bin, with its one-step forecasts, and future rows of only forecasts
+        if self.current is None:
+            return []
+        rows = [self.row(self.current)]
+        for k in range(self.future):
+            rows.append({'_time': datetime.datetime.fromtimestamp(
+                (self.current['bin'] + k + 1)*self.time_span).isoformat()})
+        for key, predictor in self.predictors.items():
+            for k, row in enumerate(rows):
+                pred = predictor.forecast(k + 1)
+                if pred is not None:
+                    row['pred_' + key] = pred
+        return rows
+
+    def rows(self):
+        # returns: every bin in the window, oldest first, empty ones included, then the current rows
+        if self.current is None:
+            return []
+        closed = dict((summary['bin'], summary) for summary in self.bins)
+        return [self.row(closed.get(b) or self.new_bin(b))
+                for b in range(self.current['bin'] - self.length, self.current['bin'])] + self.current_rows()
+
+
+class StreamingAlertGenerator(object):
+    # Checks an AlertGenerator's rules each time a record arrives for one of its router's
+    # hosts, against the open bin (numerics once they have min_samples values) and, when the
+    # record closes a bin, the whole closed bin and its forecasts too.  start() runs a timer that closes the
+    # bins of hosts that have gone quiet for quiet_grace secs past a bin's end.  A (host, rule)
+    # alerts again only after realert_interval secs, the cadence a polling cycle would have
+    # repeated it at.  Rules are keyed by the Rule object itself, since config rules are
+    # usually unnamed.
+
+    def __init__(self, generator, realert_interval=None, store_events=True, min_samples=4, quiet_grace=1.0):
+        self.generator = generator
+        self.realert_interval = generator.update_interval if realert_interval is None else realert_interval
+        self.min_samples = min_samples
+        self.quiet_grace = quiet_grace
+        # Keep a copy of the events in a LocalEventStore, for back-testing and polling
+        self.store_events = store_events and hasattr(generator.event_store, 'add_event')
+        self.windows = {}
+        # Wall clock time of each host's last record
+        self.received = {}
+        self.last_alerts = {}
+        self.lock = threading.Lock()
+        self.records = 0
+        self.ignored = 0
+        self.alerts = 0
+        # Secs from a record arriving to its alert being routed: [alerts, total, max]
+        self.latency = [0, 0.0, 0.0]
+
+    def window(self, host):
+        if host not in self.windows:
+            self.windows[host] = HostWindow(self.generator.entry_interval, self.generator.history_interval)
+        return self.windows[host]
+
+    def ingest(self, host, record, received=None):
+        # returns: the (rule, row) routed for this record, or None
+        received = time.time() if received is None else received
+        with self.lock:
+            if host not in self.generator.router.hosts or not record.get('timestamp'):
+                self.ignored += 1
+                return
+            self.records += 1
+            alert = self.check(host, record, received)
+
+        if alert:
+            self.generator.router.alert(host, *alert)
+            secs = time.time() - received
+            with self.lock:
+                self.latency[0] += 1
+                self.latency[1] += secs
+                self.latency[2] = max(self.latency[2], secs)
+
+        # Stored after alerting, so it doesn't add to the latency
+        if self.store_events:
+            self.generator.event_store.add_event(host, record)
+        return alert
+
+    def check(self, host, record, received):
+        # returns: (rule, row) if the record brings the host's open bin, or a bin it closes, to
+        # a rule that should alert now
+        window = self.window(host)
+        current = window.current
+        if not window.add(record):
+            return
+        self.received[host] = received
+        # The forecasts only move when a bin closes, so they are checked then
+        rows = [window.row(window.current, self.min_samples)]
+        if window.current is not current:
+            rows = window.closed + rows
+        return self.match(host, rows, received)
+
+    def match(self, host, rows, now):
+        # returns: (rule, row) for the first rule the rows meet, unless it is silent or alerted
+        # for this host within realert_interval
+        rule, row = self.generator.evaluate(rows)
+        if not rule or rule.silent:
+            return
+        last = self.last_alerts.get((host, rule))
+        if last is not None and now < last + self.realert_interval:
+            return
+        self.last_alerts[(host, rule)] = now
+        self.alerts += 1
+        return rule, row
+
+    def close_quiet(self, now=None):
+        # Closes the open bin of each host whose records stopped quiet_grace secs or more before
+        # the bin's end, by the host's own clock, and routes any alert the closed bin raises
+        # returns: [(host, (rule, row))] routed
+        now = time.time() if now is None else now
+        alerts = []
+        with self.lock:
+            for host, window in self.windows.items():
+                if not window.current or not window.current['records']:
+                    continue
+                end = (window.current['bin'] + 1)*window.time_span
+                if window.last_time + (now - self.received[host]) < end + self.quiet_grace:
+                    continue
+                window.close_bin(window.current['bin'] + 1)
+                alert = self.match(host, window.closed, now)
+                if alert:
+                    alerts.append((host, alert))
+
+        for host, alert in alerts:
+            self.generator.router.alert(host, *alert)
+        return alerts
+
+    def start(self, interval=0.25):
+        # Runs close_quiet every interval secs on a thread of its own
+        def run():
+            while 1:
+                time.sleep(interval)
+                try:
+                    self.close_quiet()
+                except Exception:
+                    logging.exception('Closing quiet hosts\' bins failed')
+
+        thread = threading.Thread(target=run, name='StreamingAlertGenerator')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stats(self):
+        count, total, worst = self.latency
+        return {'records': self.records,
+                'ignored': self.ignored,
+                'alerts': self.alerts,
+                'hosts': len(self.windows),
+                'mean_latency': total/count if count else 0,
+                'max_latency': worst}
+
+
+class IngestHandler(SocketServer.StreamRequestHandler):
+    # Reads one JSON record per line from a listener connection
+
+    def handle(self):
+        logging.debug('Listener connected from {0}'.format(self.client_address))
+        for line in self.rfile:
+            received = time.time()
+            if not line.strip():
+                continue
+            try:
+                msg = json.loads(line)
+                host = msg.get('host')
+                record = msg.get('event', msg)
+                self.server.generator.ingest(host, record, received)
+            except Exception:
+                logging.exception('Bad record from {0}'.format(self.client_address))
+        logging.debug('Listener at {0} disconnected'.format(self.client_address))
+
+
+class StreamIngest(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    # TCP ingest endpoint, a thread per listener connection
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, generator):
+        SocketServer.TCPServer.__init__(self, address, IngestHandler)
+        self.generator = generator
+
+
+def test_stream_dispatch():
+    # Streams records for four beds to an ingest socket at the monitor's 4 Hz and checks that
+    # an alarm-only rule alerts on its first record, a VTach alert is routed within a second of
+    # the first VTach record, only once per realert interval, that a bed which goes quiet is
+    # alerted on when the timer closes its bin, and that a lone outlier record doesn't alert
+
+    import socket
+    from Dispatch import AlertGenerator, AlertRouter
+
+    class Router(AlertRouter):
+        def __init__(self):
+            super(Router, self).__init__()
+            self.hosts = {'bed1', 'bed2', 'bed3', 'bed4'}
+            self.alerts = []
+
+        def alert(self, host, rule, values):
+            self.alerts.append((time.time(), host, rule.name))
+
+    rules = [{'name': 'vfib', 'priority': 'MAX',
+              'conditions': {'alarm_code': ['HAS', 'NOM_ECG_V_FIB_TACHY']},
+              'alert_str': "V.FIB"},
+             {'name': 'vtach', 'priority': 'MAX',
+              'conditions': {'alarm_code': ['HAS', 'NOM_EVT_ECG_V_TACHY'], 'bpm': ['GT', 100]},
+              'alert_str': "V.TACH | Current HR {bpm} bpm"},
+             {'name': 'tachy', 'priority': 'HIGH',
+              'conditions': {'bpm': ['GT', 140]},
+              'alert_str': "TACHYCARDIA | Current HR {bpm} bpm"},
+             {'name': 'tachy_trend', 'priority': 'HIGH',
+              'conditions': {'bpm': ['TGT', 140]},
+              'alert_str': "HR RAPIDLY TRENDING UP"}]
+    router = Router()
+    generator = StreamingAlertGenerator(AlertGenerator(rules, LocalEventStore(), router))
+    generator.start(0.05)
+    server = StreamIngest(('127.0.0.1', 0), generator)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    # Start on a bin boundary, so the VTach records fill a bin of their own
+    start = datetime.datetime.fromtimestamp(10*(int(time.time())//10))
+    sock = socket.create_connection(server.server_address)
+
+    def send(host, i, **fields):
+        record = {'timestamp': (start + datetime.timedelta(seconds=i/4.0)).isoformat(), 'Heart Rate': 80, 'SpO2': 97}
+        record.update(fields)
+        sock.sendall((json.dumps({'host': host, 'event': record}) + '\n').encode('ascii'))
+
+    def wait(n, secs):
+        deadline = time.time() + secs
+        while len(router.alerts) < n and time.time() < deadline:
+            time.sleep(0.001)
+        return router.alerts[n - 1] if len(router.alerts) >= n else None
+
+    # A minute of normal rhythm for two beds, and one unknown bed
+    for i in range(240):
+        send('bed1', i)
+        send('bed2', i)
+        send('bed9', i)
+    time.sleep(0.2)
+    assert not router.alerts
+
+    # A VFib alarm alerts on its own record
+    sent = time.time()
+    send('bed3', 240, alarms={'Alarm_T_0': {'code': 'NOM_ECG_V_FIB_TACHY', 'source': 'NOM_ECG_CARD_BEAT_RATE'}})
+    alert = wait(1, 1)
+    assert alert and alert[1:] == ('bed3', 'vfib')
+    alarm_latency = alert[0] - sent
+
+    # VTach on bed1, as the monitor sends it; the rate counts once the bin has enough samples
+    vtach = {'Heart Rate': 130, 'alarms': {'Alarm_T_0': {'code': 'NOM_EVT_ECG_V_TACHY',
+                                                         'source': 'NOM_ECG_CARD_BEAT_RATE'}}}
+    onset = time.time()
+    for i in range(240, 248):
+        send('bed1', i, **vtach)
+        time.sleep(0.25)
+    alert = wait(2, 0)
+    assert alert and alert[1:] == ('bed1', 'vtach')
+    latency = alert[0] - onset
+    assert latency < 1
+    for i in range(248, 280):
+        send('bed1', i, **vtach)
+
+    # bed4 sends two fast records just before its bin ends, then goes quiet; too few to alert
+    # on until the timer closes the bin
+    quiet = time.time()
+    send('bed4', 278, **{'Heart Rate': 150})
+    send('bed4', 279, **{'Heart Rate': 150})
+    alert = wait(3, 3)
+    assert alert and alert[1:] == ('bed4', 'tachy')
+    quiet_latency = alert[0] - quiet
+
+    # The alarm continues through the next bin, without alerting again; bed2 opens its next
+    # bin with a single VTach record, which averages out with the rest of the bin
+    for i in range(280, 320):
+        send('bed1', i, **vtach)
+        if i == 280:
+            send('bed2', i, **{'Heart Rate': 130, 'alarms': vtach['alarms']})
+        else:
+            send('bed2', i)
+    time.sleep(0.2)
+    assert len(router.alerts) == 3
+
+    stats = generator.stats()
+    logging.debug(stats)
+    assert stats['records'] == 2*240 + 1 + 40 + 2 + 2*40 and stats['ignored'] == 240
+    # Kept for polling and back-testing too
+    assert len(generator.generator.event_store.get_summaries(['bed1', 'bed2'], 10)['bed2']) >= 6
+    logging.info('Push alert latency {0:.1f} ms alarm, {1:.1f} ms VTach onset, {2:.1f} ms quiet host'.format(
+        1000*alarm_latency, 1000*latency, 1000*quiet_latency))
+
+    sock.close()
+    server.shutdown()
+
+
+def test_stream_rules():
+    # Streams a bed into hypoxia and then VTach with the config.yaml rules, which have no
+    # names, and checks that the MAX alert is routed even though the HIGH one just was
+
+    import yaml
+    from Dispatch import AlertGenerator, AlertRouter, test_config
+
+    class Router(AlertRouter):
+        def __init__(self):
+            super(Router, self).__init__()
+            self.hosts = {'bed1'}
+            self.alerts = []
+
+        def alert(self, host, rule, values):
+            self.alerts.append((host, rule.priority, rule.alert_msg(host, values)))
+
+    with file(test_config) as f:
+        config = yaml.load(f)
+    router = Router()
+    generator = StreamingAlertGenerator(AlertGenerator(config.get('rules'), EventStore(), router),
+                                        store_events=False)
+    assert all(rule.name is None for rule in generator.generator.rules)
+
+    desat = {'code': 'NOM_EVT_DESAT', 'source': 'NOM_PULS_OXIM_SAT_O2'}
+    vtach = {'code': 'NOM_EVT_ECG_V_TACHY', 'source': 'NOM_ECG_CARD_BEAT_RATE'}
+    start = to_epoch(datetime.datetime(2016, 7, 28, 11, 30, 0))
+
+    def send(i, bpm, spo2, *alarms):
+        t = start + i/4.0
+        record = {'timestamp': datetime.datetime.fromtimestamp(t).isoformat(), 'Heart Rate': bpm, 'SpO2': spo2,
+                  'alarms': dict(('Alarm_T_{0}'.format(k), alarm) for k, alarm in enumerate(alarms))}
+        generator.ingest('bed1', record, t)
+
+    # A minute of normal rhythm, a 10 sec bin of hypoxia, then a bin of VTach, all within
+    # the realert interval, and a record to start the next bin
+    for i in range(240):
+        send(i, 80, 97)
+    for i in range(240, 280):
+        send(i, 80, 85, desat)
+    for i in range(280, 320):
+        send(i, 130, 85, desat, vtach)
+    send(320, 130, 85, desat, vtach)
+
+    logging.debug(router.alerts)
+    assert [alert[1] for alert in router.alerts] == ['HIGH', 'MAX']
+    assert router.alerts[0][2].startswith('HYPOXIA') and router.alerts[1][2].startswith('V.TACH')
+
+
+def test_window_parity():
+    # Streams sample records through a HostWindow and checks its rows, forecasts, and window
+    # aggregates against LocalEventStore.get_summaries over the same records as they go
+
+    host = 'sample1A'
+    store = LocalEventStore()
+    window = HostWindow(10, 120)
+    start = datetime.datetime(2016, 7, 28, 11, 30, 0)
+
+    def query(first_bin, last_bin):
+        query_args = {"earliest_time": datetime.datetime.fromtimestamp(first_bin*10).isoformat(),
+                      "latest_time": datetime.datetime.fromtimestamp((last_bin + 1)*10).isoformat()}
+        return store.get_summaries([host], 10, query_args)[host]
+
+    def same(row, expected, keys):
+        for key in keys:
+            a, b = row.get(key), expected.get(key)
+            if isinstance(a, float) or isinstance(b, float):
+                assert a is not None and b is not None and abs(a - b) < 1e-9, (key, row, expected)
+            else:
+                assert a == b, (key, row, expected)
+
+    # 10 minutes at 2 Hz: bpm swinging and climbing, spo2 sagging, NIBP every 2.5 minutes,
+    # a few alarms, and a 45 sec dropout
+    values = []
+    for i in range(1200):
+        if 700 <= i < 790:
+            continue
+        record = {'timestamp': (start + datetime.timedelta(seconds=i/2.0)).isoformat(),
+                  'Heart Rate': 70 + (i % 37) + i/40.0,
+                  'SpO2': 98 - (i % 11)/2.0 - i/400.0}
+        if i % 300 == 10:
+            record['Non-invasive Blood Pressure'] = {'systolic': 120 - i/30.0, 'diastolic': 80, 'mean': 90}
+        if i % 97 == 0:
+            record['alarms'] = {'Alarm_T_0': {'code': 'NOM_EVT_HI_HR', 'source': 'NOM_ECG_CARD_BEAT_RATE'}}
+        store.add_event(host, record)
+        assert window.add(record)
+        values.append((int(to_epoch(record['timestamp'])//10), record))
+
+        if i % 50 != 49:
+            continue
+        current = window.current['bin']
+        first = int(to_epoch(start)//10)
+        keys = ['_time', 'alarm_code', 'alarm_source'] + \
+               [prefix + key for key in window.numerics for prefix in ('', 'max_', 'min_')]
+
+        # Rows, with the open bin's one step forecasts
+        batch = query(first, current)
+        stream = window.rows()
+        batch_rows = dict((row['_time'], row) for row in batch)
+        for row in stream[:window.length]:
+            if row['_time'] in batch_rows:
+                same(row, batch_rows[row['_time']], keys)
+        same(stream[window.length], batch[-window.future - 1],
+             keys + ['pred_' + key for key in window.numerics])
+
+        # Forecasts past the open bin, from the closed bins, as the last poll would have made them
+        if current > first:
+            batch = query(first, current - 1)
+            for row, expected in zip(window.current_rows(), batch[-window.future:]):
+                same(row, expected, ['pred_' + key for key in window.numerics])
+
+        # The last closed bin and its forecasts, as the poll at its close would have made them
+        closed = window.bins[-1]['bin']
+        batch = query(first, closed)
+        assert len(window.closed) == window.future + 1
+        for row, expected in zip(window.closed, batch[-window.future - 1:]):
+            same(row, expected, keys + ['pred_' + key for key in window.numerics])
+
+        # Window aggregates, against the records themselves
+        for key in window.numerics:
+            name = window.field_names[key]
+            in_window = [record_value(record, name) for b, record in values if b >= current - window.length]
+            in_window = [value for value in in_window if value is not None]
+            aggregate = window.aggregate(key)
+            if not in_window:
+                assert aggregate is None
+                continue
+            assert aggregate['count'] == len(in_window)
+            assert aggregate['max'] == max(in_window) and aggregate['min'] == min(in_window)
+            assert abs(aggregate['avg'] - sum(in_window)/len(in_window)) < 1e-9
+
+    # The dropout shows up as empty bins, with forecasts carried across it
+    batch = query(first, window.current['bin'])
+    assert [row for row in batch if 'bpm' not in row and 'pred_bpm' in row]
+
+    # A late record still lands in its bin and the window aggregates
+    late = {'timestamp': (start + datetime.timedelta(seconds=570)).isoformat(), 'Heart Rate': 200}
+    assert window.add(late)
+    assert window.aggregate('bpm')['max'] == 200
+    assert not window.add({'timestamp': start.isoformat(), 'Heart Rate': 200})
+
+
+def benchmark_host_window(records=20000):
+    # Times HostWindow updates and queries (the rule rows and a window aggregate) with short
+    # and long windows; both should be flat in the window length
+
+    start = datetime.datetime(2016, 7, 28, 11, 30, 0)
+    stream = [(to_epoch(start) + i/4.0,
+               {'Heart Rate': 70 + i % 40, 'SpO2': 95,
+                'Non-invasive Blood Pressure': {'systolic': 120, 'diastolic': 80, 'mean': 90} if i % 1200 == 0 else None})
+              for i in range(records)]
+
+    for history in (120, 3600):
+        window = HostWindow(10, history)
+        tic = time.time()
+        for t, record in stream:
+            window.add(record, t)
+        added = time.time() - tic
+
+        tic = time.time()
+        for i in range(1000):
+            window.current_rows()
+            window.aggregate('bpm')
+        queried = time.time() - tic
+
+        logging.info('{0}s window: {1:.1f} us per record, {2:.1f} us per query'.format(
+            history, 1e6*added/records, 1e3*queried))
+
+
+def benchmark_stream_dispatch(hosts=30, secs=600):
+    # Times ingest (window update and rule checks) per record, for 4 Hz records from each host
+
+    from Dispatch import AlertGenerator, AlertRouter, test_config
+
+    with file(test_config) as f:
+        import yaml
+        config = yaml.load(f)
+    router = AlertRouter()
+    router.hosts = set('bed{0}'.format(h) for h in range(hosts))
+    generator = StreamingAlertGenerator(AlertGenerator(config.get('rules'), EventStore(), router), store_events=False)
+
+    start = datetime.datetime(2016, 7, 28, 11, 30, 0)
+    records = [(t, {'timestamp': start + datetime.timedelta(seconds=t/4.0),
+                    'Heart Rate': 70 + (t % 40), 'SpO2': 95,
+                    'alarms': {'Alarm_T_0': {'code': 'NOM_EVT_HI_HR', 'source': 'NOM_ECG_CARD_BEAT_RATE'}}
+                              if t % 13 == 0 else None})
+               for t in range(4*secs)]
+
+    tic = time.time()
+    for t, record in records:
+        for h in range(hosts):
+            generator.ingest('bed{0}'.format(h), record)
+    elapsed = time.time() - tic
+
+    logging.info('{0} records from {1} hosts: {2:.1f} us per record'.format(
+        len(records)*hosts, hosts, 1e6*elapsed/(len(records)*hosts)))
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    test_stream_dispatch()
+    test_stream_rules()
+    test_window_parity()
+    benchmark_stream_dispatch()
+    benchmark_host_window()
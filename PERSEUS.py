@@ -20,7 +20,7 @@ import os
 import yaml
 import subprocess
 
-from Dispatch import Dispatch
+from Dispatch import Dispatch, EventStore
 from TelemetryStream import TelemetryStream, PhilipsTelemetryStream
 
 __package__ = "PERSEUS"
@@ -67,6 +67,10 @@ def parse_args():
                                            description=TelemetryStream.__description__,
                                            help='Start an instance of a PERSEUS Listener node')
     parser_listen = TelemetryStream.configure_parser(parser_listen)
+    parser_listen.add_argument('--db', help="Also write numerics and alarms to a local event database file, "
+                                            "for a Dispatch run with --event_store local")
+    parser_listen.add_argument('--retention', type=float, default=24,
+                               help="Hours of events to keep in --db, 0 keeps everything (default: 24)")
 
     _opts = parser.parse_args()
     return _opts
@@ -84,7 +88,13 @@ if __name__ == "__main__":
             config = yaml.load(f)
             rules, zones, roles = config.get('rules'), config.get('zones'), config.get('roles')
 
-        dispatch = Dispatch.Dispatch(rules=rules, zones=zones, roles=roles)
+        event_store = None
+        if opts.event_store == 'local':
+            event_store = EventStore.LocalEventStore(opts.db, retention=3600*opts.retention)
+
+        push_address = (opts.push_host, opts.push) if opts.push else None
+        dispatch = Dispatch.Dispatch(rules=rules, zones=zones, roles=roles, event_store=event_store,
+                                     push_address=push_address)
         dispatch.run()
 
     elif opts.command == 'listener':
@@ -101,7 +111,10 @@ if __name__ == "__main__":
             tstream.add_update_func(PhilipsTelemetryStream.qos)
             redraw_interval = 0.05
 
-        TelemetryStream.attach_loggers(tstream, opts)
+        sinks = []
+        if opts.db:
+            sinks.append(EventStore.LocalEventStoreHandler(opts.db, retention=3600*opts.retention))
+        TelemetryStream.attach_loggers(tstream, opts, sinks)
 
         if opts.gui:
             # Pass the stream to a gui for use in it's own polling function and main loop
@@ -0,0 +1,134 @@
+"""
+Retrospective QoS scoring for archived Pleth recordings
+
+Memory-maps a recording, slides a window over it as strided views, and fans
+the windows out over a multiprocessing pool.  Each worker maps the recording
+itself, so windows are never copied or pickled; only the scores come back.
+
+Scores are saved column-wise in an .npz: 'start' (first sample of each
+window), 'time' (seconds from the start of the recording), and 'qos'
+(int8, 1/0/-1 as from isPPGGoodQuality).
+
+Dependencies: numpy, scipy
+"""
+
+from __future__ import division
+
+import argparse
+import logging
+import multiprocessing
+import time
+import numpy as np
+from QualityOfSignal import QualityOfSignal
+
+__description__ = "Score archived Pleth recordings with the PERSEUS quality of signal check"
+
+# Windows per task, big enough that the pool's overhead doesn't matter
+CHUNK_SIZE = 256
+
+# Set in each worker by _init_worker
+_recording = None
+_engine = None
+
+
+def load_recording(path, dtype='float64'):
+    # returns: read-only memory-mapped samples, from an .npy or a raw file of dtype
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def sliding_windows(samples, window, step):
+    # returns: (count, window) strided view of samples, each row starting step samples later
+    count = max((samples.size - window)//step + 1, 0)
+    return np.lib.stride_tricks.as_strided(samples, shape=(count, window),
+                                           strides=(step*samples.strides[0], samples.strides[0]))
+
+
+def _init_worker(path, dtype, fs, window, step):
+    global _recording, _engine
+    _recording = sliding_windows(load_recording(path, dtype), window, step)
+    _engine = QualityOfSignal(fs=fs)
+
+
+def _score_chunk(first, last):
+    # returns: (first, int8 scores for windows first..last-1), one stacked decomposition per chunk
+    scores = np.zeros(last - first, dtype=np.int8)
+    windows = _recording[first:last]
+    finite = np.flatnonzero(np.all(np.isfinite(windows), axis=1))
+    try:
+        scores[finite] = _engine.scoreMany([windows[i] for i in finite])
+    except Exception:
+        logging.exception('Failed to score windows {0}-{1}'.format(first, last))
+    return first, scores
+
+
+def _score_task(task):
+    return _score_chunk(*task)
+
+
+def score_recording(path, fs=125, dur=7, step=0.25, processes=None, dtype='float64', output=None):
+    """
+    Scores every dur second window of a Pleth recording, stepping by step
+    seconds, over processes workers (default all cores, 1 runs in process).
+    Returns {'start', 'time', 'qos'} columns, also saved to output if given.
+    """
+
+    window = int(dur*fs)
+    stride = max(int(round(step*fs)), 1)
+    count = sliding_windows(load_recording(path, dtype), window, stride).shape[0]
+    tasks = [(first, min(first + CHUNK_SIZE, count)) for first in range(0, count, CHUNK_SIZE)]
+
+    qos = np.zeros(count, dtype=np.int8)
+    tic = time.time()
+
+    if processes == 1:
+        _init_worker(path, dtype, fs, window, stride)
+        results = (_score_chunk(*task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                    initargs=(path, dtype, fs, window, stride))
+        results = pool.imap_unordered(_score_task, tasks)
+
+    try:
+        for first, scores in results:
+            qos[first:first + scores.size] = scores
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - tic
+    logging.info('Scored {0} windows in {1:.1f}s ({2:.0f} windows/s, {3} processes)'.format(
+        count, elapsed, count/elapsed if elapsed else 0, processes or multiprocessing.cpu_count()))
+
+    start = np.arange(count, dtype=np.int64)*stride
+    ret = {'start': start, 'time': start/fs, 'qos': qos}
+
+    if output:
+        np.savez_compressed(output, **ret)
+
+    return ret
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('recording', help="Pleth samples, .npy or raw (see --dtype)")
+    parser.add_argument('-o', '--output', help="Name of an .npz file for the scores")
+    parser.add_argument('--dtype', help="Sample type of a raw recording", default='float64')
+    parser.add_argument('--fs', help="Sampling frequency (Hz)", type=float, default=125)
+    parser.add_argument('--dur', help="Window length (secs)", type=float, default=7)
+    parser.add_argument('--step', help="Window step (secs)", type=float, default=0.25)
+    parser.add_argument('-j', '--processes', help="Worker processes (default all cores)", type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO)
+
+    opts = parse_args()
+    score_recording(opts.recording, fs=opts.fs, dur=opts.dur, step=opts.step,
+                    processes=opts.processes, dtype=opts.dtype, output=opts.output)
@@ -14,10 +14,107 @@ import codecs
 import copy
 import logging
 import os
+import sys
+import pickle
+import numpy as np
 
 # For path'd reads of label data
 package_directory = os.path.dirname(os.path.abspath(__file__))
 
+# Precompiled formats for reading fields in place
+UINT32 = struct.Struct('>I')
+UINT16 = struct.Struct('>H')
+INT16 = struct.Struct('>h')
+UINT8 = struct.Struct('>B')
+UINT16_PAIR = struct.Struct('>HH')
+
+# Wave samples are big-endian uint16s, read straight into arrays
+SAMPLES = np.dtype('>u2')
+
+# Decode plan opcodes, see IntellivueDecoder.compilePlan
+PLAN_FIXED = 0          # run of fixed-width fields read with one struct
+PLAN_DICT = 1           # nested data type with a variable-width member
+PLAN_LIST = 2           # [count, length, value[count]] list
+PLAN_ATTRIBUTES = 3     # AttributeList
+PLAN_LENGTH = 4         # ASNLength or LILength
+PLAN_READ = 5           # VariableLabel, VariableData, String
+
+# Field kinds within a PLAN_FIXED template
+FIELD_VALUE = 0         # store the unpacked value
+FIELD_LOOKUP = 1        # store lookup.get(value, value)
+FIELD_TABLE = 2         # store table[value]
+FIELD_CALL = 3          # store function(value)
+FIELD_BYTES = 4         # store b'' (keyed int16 and bcd quirk)
+FIELD_LIST = 5          # store a list of the next n values
+FIELD_DICT = 6          # nested template
+FIELD_ALARM = 7         # al_source_code (two values)
+
+# Nomenclature tables: name -> (source text file, IntellivueDecoder loader)
+NOMENCLATURE_SOURCES = {
+    'OIDType': ('OIDTypes.txt', 'loadOIDTypes'),
+    'EventTypes': ('EventTypes.txt', 'loadEventTypes'),
+    'SCADAType': ('SCADATypes.txt', 'loadSCADATypes'),
+    'UNITType': ('UNITTypes.txt', 'loadUNITTypes'),
+    'TextId': ('PhysioLabels.txt', 'loadPhysioLabels'),
+    'PhysioKeys': ('PhysioLabels.txt', 'loadPhysioKeys'),
+}
+
+# Process-wide registry of loaded tables, shared by every decoder and distiller
+NOMENCLATURE = {}
+
+# Set False to always parse the text files (ie read-only installs)
+NOMENCLATURE_CACHE = True
+
+
+def nomenclature(name):
+    """
+    Returns the named nomenclature table, loading it on first use.
+
+    Parsed tables are pickled next to their text file (one cache per python
+    major version, since py2 and py3 pickle bytes keys differently) along
+    with the text file's mtime; the cache is only used while that mtime
+    still matches.
+    """
+
+    if name in NOMENCLATURE:
+        return NOMENCLATURE[name]
+
+    source, loader = NOMENCLATURE_SOURCES[name]
+    source_path = os.path.join(package_directory, source)
+    cache_path = os.path.join(package_directory, '.{0}.py{1}.pickle'.format(name, sys.version_info[0]))
+    mtime = os.path.getmtime(source_path)
+
+    table = None
+
+    if NOMENCLATURE_CACHE:
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_mtime, cached_table = pickle.load(f)
+            if cached_mtime == mtime:
+                table = cached_table
+        except Exception:
+            # Missing, stale, or unreadable cache, just parse the text
+            pass
+
+    if table is None:
+        table = getattr(IntellivueDecoder, loader)()
+
+        if NOMENCLATURE_CACHE:
+            # Write to a temp file first so concurrent listeners never read a partial cache
+            temp_path = '{0}.{1}'.format(cache_path, os.getpid())
+            try:
+                with open(temp_path, 'wb') as f:
+                    pickle.dump((mtime, table), f, pickle.HIGHEST_PROTOCOL)
+                os.rename(temp_path, cache_path)
+            except (IOError, OSError):
+                logging.debug('Unable to write nomenclature cache {0}'.format(cache_path))
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    NOMENCLATURE[name] = table
+    return table
+
+
 class IntellivueDecoder(object):
     """
     This class contains all of the data structures defined in the Data Interface
@@ -713,17 +810,18 @@ class IntellivueDecoder(object):
             'NOM_ATTR_TIME_STAMP_REL': 'RelativeTime'
         }
 
-        self.DataKeys['OIDType'] = self.loadOIDTypes()
+        # Nomenclature tables are loaded once per process, see nomenclature
+        self.DataKeys['OIDType'] = nomenclature('OIDType')
 
-        self.DataKeys['SCADAType'] = self.loadSCADATypes()
+        self.DataKeys['SCADAType'] = nomenclature('SCADAType')
 
-        self.DataKeys['UNITType'] = self.loadUNITTypes()
+        self.DataKeys['UNITType'] = nomenclature('UNITType')
 
-        self.DataKeys['TextId'] = self.loadPhysioLabels()
+        self.DataKeys['TextId'] = nomenclature('TextId')
 
-        self.DataKeys['PhysioKeys'] = self.loadPhysioKeys()
+        self.DataKeys['PhysioKeys'] = nomenclature('PhysioKeys')
 
-        self.DataKeys['EventTypes'] = self.loadEventTypes()
+        self.DataKeys['EventTypes'] = nomenclature('EventTypes')
 
         self.DataKeys['NomPartition'] = {
             b'\x00\x01': 'NOM_PART_OBJ',
@@ -1114,21 +1212,42 @@ class IntellivueDecoder(object):
             'SetResult',
         ]
 
-    # Returns value from uint32 binary
-    def get32(self, data):
-        return struct.unpack('>I',data)[0]
-
-    # Returns value from uint16 binary
-    def get16(self, data):
-        return struct.unpack('>H',data)[0]
-
-    # Returns value from int16 binary
-    def geti16(self, data):
-        return struct.unpack('>h',data)[0]
-
-    # Returns value from uint8 binary
-    def get8(self, data):
-        return struct.unpack('>B',data)[0]
+        # Compile each message (and each attribute type) once into a flat
+        # decode plan, see compilePlan
+        self.FieldPlans = {}
+        self.TypePlans = {}
+        self.DecodePlans = {}
+        self.AttributeOIDs = self.compileAttributeOIDs()
+        for message_type in self.MessageLists:
+            self.DecodePlans[message_type] = self.compilePlan(self.MessageLists[message_type])
+        for attribute_type in set(self.DataKeys['AttributeType'].values()):
+            self.getTypePlan(attribute_type)
+
+        # OID codes and SCADA labels for the direct wave path, see readWaveObservations
+        self.WaveOIDs = {}
+        for name in ['NOM_MOC_VMO_METRIC_SA_RT', 'NOM_ATTR_SA_VAL_OBS', 'NOM_ATTR_SA_CMPD_VAL_OBS']:
+            self.WaveOIDs[name] = UINT16.unpack(self.DataKeys['OIDType'][name])[0]
+        self.SCADALabels = self.compileLookup(self.DataKeys['SCADAType'], 16)
+
+    # Returns value from uint32 binary (at index)
+    def get32(self, data, index=0):
+        return UINT32.unpack_from(data, index)[0]
+
+    # Returns value from uint16 binary (at index)
+    def get16(self, data, index=0):
+        return UINT16.unpack_from(data, index)[0]
+
+    # Returns value from int16 binary (at index)
+    def geti16(self, data, index=0):
+        return INT16.unpack_from(data, index)[0]
+
+    # Returns value from uint8 binary (at index)
+    def get8(self, data, index=0):
+        return UINT8.unpack_from(data, index)[0]
+
+    # Returns count raw bytes from index, for use as a dictionary key
+    def getBytes(self, data, index, count):
+        return bytes(data[index:index+count])
 
     # Returns uint32 binary from value
     def set32(self, data):
@@ -1144,7 +1263,8 @@ class IntellivueDecoder(object):
 
     # Reads in text file of OID Types into a bidirectional dictionary
     # with the format number:label and label:number, returns dict
-    def loadOIDTypes(self):
+    @staticmethod
+    def loadOIDTypes():
         """
         Creates a dictionary from the txt file OIDTypes.txt with label: number
         and number: label
@@ -1161,7 +1281,7 @@ class IntellivueDecoder(object):
             split_line = line.split()
 
             labels.append(split_line[0])
-            numbers.append(bytes(self.set16(int(split_line[1]))))
+            numbers.append(UINT16.pack(int(split_line[1])))
 
         OID_Type_Dict = dict(zip(numbers, labels))
         OID_Type_Reverse_Dict = dict(zip(labels, numbers))
@@ -1177,7 +1297,8 @@ class IntellivueDecoder(object):
 
     # Reads in text file of Event Types into a bidirectional dictionary
     # with the format number:label and label:number, returns dict
-    def loadEventTypes(self):
+    @staticmethod
+    def loadEventTypes():
         """
         Creates a dictionary from the txt file OIDTypes.txt with label: number
         and number: label
@@ -1208,7 +1329,8 @@ class IntellivueDecoder(object):
 
     # Reads in text file of SCADA Types into a bidirectional dictionary
     # with the format number:label and label:number, returns dict
-    def loadSCADATypes(self):
+    @staticmethod
+    def loadSCADATypes():
         """
         Creates a dictionary from the txt file SCADATypes.txt with label: number
         and number: label
@@ -1225,7 +1347,7 @@ class IntellivueDecoder(object):
             split_line = line.split()
 
             labels.append(split_line[0])
-            numbers.append(bytes(self.set16(int(split_line[1]))))
+            numbers.append(UINT16.pack(int(split_line[1])))
 
         SCADA_Type_Dict = dict(zip(numbers,labels))
         SCADA_Type_Reverse_Dict = dict(zip(labels,numbers))
@@ -1239,7 +1361,8 @@ class IntellivueDecoder(object):
 
     # Reads in text file of Unit Types into a bidirectional dictionary
     # with the format number:label and label:number, returns dict
-    def loadUNITTypes(self):
+    @staticmethod
+    def loadUNITTypes():
         """
         Creates a dictionary from the txt file UNITTypes.txt with
         unit:number and number:unit
@@ -1260,7 +1383,7 @@ class IntellivueDecoder(object):
                 split_line = line.split()
 
                 labels.append(split_line[0])
-                numbers.append(bytes(self.set16(int(split_line[1]))))
+                numbers.append(UINT16.pack(int(split_line[1])))
             else:
                 line = line.rstrip()
                 units.append(line)
@@ -1277,7 +1400,8 @@ class IntellivueDecoder(object):
 
     # Reads in text file of PhysioLabels into a bidirectional dictionary
     # with the format description:binary, symbol:binary, and binary:description
-    def loadPhysioLabels(self):
+    @staticmethod
+    def loadPhysioLabels():
         """
         Creates a dictionary from the txt file Physiolabels.txt with
         label:number and number:label
@@ -1354,7 +1478,8 @@ class IntellivueDecoder(object):
 
     # Reads in text file of Physiolabels into a dictionary with the format
     # description:labels (for creating Numpy arrays)
-    def loadPhysioKeys(self):
+    @staticmethod
+    def loadPhysioKeys():
         """
         Creates a dictionary from the txt file Physiolabels.txt with
         Physio Label: SCADA Type(s)
@@ -1420,8 +1545,8 @@ class IntellivueDecoder(object):
         """
         # Initialize Variables
         current_message_dict['AttributeList'] = {}
-        current_message_dict['AttributeList']['count'] = self.get16(data[index: index+2])
-        current_message_dict['AttributeList']['length'] = self.get16(data[index+2: index+4])
+        current_message_dict['AttributeList']['count'] = self.get16(data, index)
+        current_message_dict['AttributeList']['length'] = self.get16(data, index+2)
         current_message_dict['AttributeList']['AVAType'] = {}
 
         index += 4
@@ -1435,7 +1560,7 @@ class IntellivueDecoder(object):
             # Iterate through "count" attributes
             for i in range(current_message_dict['AttributeList']['count']):
 
-                OIDIndex = data[index:index+2]
+                OIDIndex = self.getBytes(data, index, 2)
 
                 if OIDIndex == b'\x00\x01':
                     OIDType = 'NOM_POLL_PROFILE_SUPPORT'
@@ -1451,7 +1576,7 @@ class IntellivueDecoder(object):
                     OIDType = self.DataKeys['OIDType'].get(OIDIndex, OIDIndex)
 
                 # length
-                length = self.get16(data[index+2:index+4])
+                length = self.get16(data, index+2)
                 index += 4
 
                 # Initialize AVAType variables
@@ -1489,8 +1614,8 @@ class IntellivueDecoder(object):
 
         # Initialize Variables
         current_message_dict[data_type] = {}
-        current_message_dict[data_type]['count'] = self.get16(data[index: index+2])
-        current_message_dict[data_type]['length'] = self.get16(data[index+2: index+4])
+        current_message_dict[data_type]['count'] = self.get16(data, index)
+        current_message_dict[data_type]['length'] = self.get16(data, index+2)
         index += 4
 
         # Initialize data_value
@@ -1514,14 +1639,14 @@ class IntellivueDecoder(object):
 
         # Initialize Variables
         current_message_dict['VariableLabel'] = {}
-        current_message_dict['VariableLabel']['length'] = self.get16(data[index: index+2])
+        current_message_dict['VariableLabel']['length'] = self.get16(data, index)
         current_message_dict['VariableLabel']['value'] = []
         index += 2
 
         # Read through the values "length" times
         for i in range(current_message_dict['VariableLabel']['length']):
 
-            current_message_dict['VariableLabel']['value'].append(self.get8(data[i:i+1]))
+            current_message_dict['VariableLabel']['value'].append(self.get8(data, i))
             index += 1
 
         return index
@@ -1529,20 +1654,19 @@ class IntellivueDecoder(object):
     # Reads in data types of format [length, value[length uint16s]], returns index
     def readVariableData(self, index, current_message_dict, data):
         """
-        Reads in VariableData (ie actual data values of uint16s)
+        Reads in VariableData (ie actual data values of uint16s) as a uint16
+        array over the message buffer, samples are never Python ints
         """
 
         # Initialize Variables
         current_message_dict['VariableData'] = {}
-        current_message_dict['VariableData']['length'] = self.get16(data[index: index+2])
-        current_message_dict['VariableData']['value'] = []
+        current_message_dict['VariableData']['length'] = self.get16(data, index)
         index += 2
 
-        # Read through the values "length" times
-        for i in range(int(current_message_dict['VariableData']['length']/2)):
-
-            current_message_dict['VariableData']['value'].append(self.get16(data[index: index+2]))
-            index += 2
+        # Read all "length/2" values in one pass
+        count = int(current_message_dict['VariableData']['length']/2)
+        current_message_dict['VariableData']['value'] = np.frombuffer(data, dtype=SAMPLES, count=count, offset=index)
+        index += 2 * count
 
         return index
 
@@ -1555,11 +1679,11 @@ class IntellivueDecoder(object):
         """
         # Initialize Variables
         current_message_dict['String'] = {}
-        current_message_dict['String']['length'] = self.get16(data[index: index+2])
+        current_message_dict['String']['length'] = self.get16(data, index)
 
         index += 2
 
-        byte_values = data[index:index+current_message_dict['String']['length']]
+        byte_values = self.getBytes(data, index, current_message_dict['String']['length'])
         current_message_dict['String']['value'] = ''
 
         for i in range(0, int(current_message_dict['String']['length']/2), 1):
@@ -1584,23 +1708,24 @@ class IntellivueDecoder(object):
         # Initialize Variables
         current_message_dict['FLOATType'] = {}
 
+        # Exponent is the signed top byte, mantissa the remaining 24 bits
+        exponent = struct.unpack_from('>b', data, index)[0]
+        mantissa = self.get32(data, index) & 0xFFFFFF
+
         # Check for exceptions
-        if data[index+1:index+4] == b'\x7F\xFF\xFF':
+        if mantissa == 0x7FFFFF:
             current_message_dict['FLOATType'] = 'Not a number'
 
-        elif data[index+1:index+4] == b'\x80\x00\x00':
+        elif mantissa == 0x800000:
             current_message_dict['FLOATType'] = 'Not at this resolution'
 
-        elif data[index+1:index+4] ==b'\x7F\xFF\xFE':
+        elif mantissa == 0x7FFFFE:
             current_message_dict['FLOATType'] = 'Positive Infinity'
 
-        elif data[index+1:index+4] ==b'\x80\x00\x02':
+        elif mantissa == 0x800002:
             current_message_dict['FLOATType'] = 'Negative Infinity'
 
         else:
-            exponent = struct.unpack('>b',data[index:index+1])[0]
-            (num1, num2, num3) = struct.unpack('>BBB', data[index+1:index+4])
-            mantissa = (num1*65536)+(num2*256)+num3
             if mantissa >= 0x800000:
                 mantissa -= 0x1000000
 
@@ -1616,12 +1741,12 @@ class IntellivueDecoder(object):
         Reads in DevAlarmEntry
         """
         # Store source
-        source = data[index:index+2]
+        source = self.getBytes(data, index, 2)
         index += 2
 
         # Store and determine code (ignoring last bit)
         # converting bc event types has binary keys
-        code = self.get16(data[index:index+2])
+        code = self.get16(data, index)
         index += 2
 
         # Based on code, determine source in OID or SCADA
@@ -1710,18 +1835,18 @@ class IntellivueDecoder(object):
 
                     # Read out uint32
                     if self.DataTypes[data_type][0] == 32:
-                        bit_range = data[index:index+4]
+                        bit_range = self.getBytes(data, index, 4)
                         index += 4
 
                     # Read out uint16
                     elif self.DataTypes[data_type][0] == 16:
 
-                        bit_range = data[index:index+2]
+                        bit_range = self.getBytes(data, index, 2)
                         index += 2
 
                     # Read out int16 (note: only 1 case)
                     elif self.DataTypes[data_type][0] == -16:
-                        current_message_dict[data_type] = self.geti16(data[index:index+2])
+                        current_message_dict[data_type] = self.geti16(data, index)
                         index += 2
                         bit_range = b''
 
@@ -1731,7 +1856,7 @@ class IntellivueDecoder(object):
                         # Deal with BCD encoding
                         if self.DataTypes[data_type][1] == 'bcd':
                             bit_range = b''
-                            temp_value = self.get8(data[index:index+1])
+                            temp_value = self.get8(data, index)
                             temp_bin = '{0:08b}'.format(temp_value)
                             digit_one = int(temp_bin[0:4],2)
                             digit_two = int(temp_bin[4:8],2)
@@ -1740,13 +1865,13 @@ class IntellivueDecoder(object):
                             index += 1
 
                         elif self.DataTypes[data_type][1] == 1:
-                            bit_range = data[index:index+1]
+                            bit_range = self.getBytes(data, index, 1)
                             index += 1
 
                         else:
                             bit_range = []
                             for i in range(self.DataTypes[data_type][1]):
-                                bit_range.append(self.get8(data[index:index+1]))
+                                bit_range.append(self.get8(data, index))
                                 index += 1
 
                     # If there is a key associated with the int
@@ -1793,7 +1918,8 @@ class IntellivueDecoder(object):
         return index
 
     # Main function to read in messages, returns dictionary
-    def readData(self,data):
+    # compiled=False uses recurseRead
+    def readData(self, data, compiled=True):
 
         # Determine message type
         message_type = self.getMessageType(data)
@@ -1814,8 +1940,11 @@ class IntellivueDecoder(object):
         else:
             index = 0
 
-        # Recursively read the message
-        if message_type != 'AssociationAbort':
+        # Read the message with its compiled plan, or recursively
+        plan = self.DecodePlans.get(message_type) if compiled else None
+        if message_type != 'AssociationAbort' and plan is not None:
+            finalIndex = self.readPlan(plan, index, current_message_dict, data)
+        elif message_type != 'AssociationAbort':
             finalIndex = self.recurseRead(current_message_list, index, current_message_dict, data)
         else:
             current_message_dict['AssociationAbort'] = ''
@@ -1856,36 +1985,494 @@ class IntellivueDecoder(object):
 
         if ('ASNLength' in data_type):
 
-            if (self.get8(data[index:index+1]) == 130):
-                current_message_dict['ASNLength'] = self.get16(data[index+1:index+3])
+            if (self.get8(data, index) == 130):
+                current_message_dict['ASNLength'] = self.get16(data, index+1)
                 index += 3
 
-            elif (self.get8(data[index:index+1]) == 129):
-                current_message_dict['ASNLength'] = self.get8(data[index+1:index+2])
+            elif (self.get8(data, index) == 129):
+                current_message_dict['ASNLength'] = self.get8(data, index+1)
                 index += 2
 
             else:
-                current_message_dict['ASNLength'] = self.get8(data[index:index+1])
+                current_message_dict['ASNLength'] = self.get8(data, index)
                 index += 1
 
 
         elif ('LILength' in data_type):
 
-            if (self.get8(data[index:index+1]) == 255):
-                current_message_dict['LILength'] = self.get16(data[index+1:index+3])
+            if (self.get8(data, index) == 255):
+                current_message_dict['LILength'] = self.get16(data, index+1)
                 index += 3
 
             else:
-                current_message_dict['LILength'] = self.get8(data[index:index+1])
+                current_message_dict['LILength'] = self.get8(data, index)
                 index += 1
 
         elif ('length' in data_type):
 
-            current_message_dict['length'] = self.get16(data[index:index+2])
+            current_message_dict['length'] = self.get16(data, index)
             index += 2
 
         return index
 
+    # Compiles a message list into a decode plan, returns plan (or None)
+    def compilePlan(self, message_list):
+        """
+        Walks the DataTypes tree for message_list once and flattens it into
+        a list of (opcode, argument, plan) steps for readPlan.  Runs of
+        fixed-width fields (including nested data types made only of them)
+        are merged into a single PLAN_FIXED step holding one struct.Struct
+        and a template that rebuilds the same nested dictionary that
+        recurseRead would.
+
+        Returns None if the tree has something recurseRead handles in a way
+        that can't be planned (ie unknown data types), so readData can fall
+        back to recurseRead.
+        """
+
+        try:
+            return self.finalizePlan(self.compileList(message_list))
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+
+    # Returns the (cached) decode plan for a single data type
+    def getTypePlan(self, data_type):
+
+        if data_type not in self.TypePlans:
+            self.TypePlans[data_type] = self.compilePlan([data_type])
+
+        return self.TypePlans[data_type]
+
+    # Compiles each data type in a list, merging adjacent fixed-width runs
+    def compileList(self, message_list):
+
+        plan = []
+
+        for data_type in message_list:
+
+            # Lists accompanying "AttributeLists" aren't read (see recurseRead)
+            if type(data_type) == list:
+                continue
+
+            for step in self.compileType(data_type):
+
+                if plan and step[0] == PLAN_FIXED and plan[-1][0] == PLAN_FIXED:
+                    plan[-1] = (PLAN_FIXED, plan[-1][1] + step[1], plan[-1][2] + step[2])
+                else:
+                    plan.append(step)
+
+        return plan
+
+    # Compiles a single data type in the same order of tests as recurseRead
+    def compileType(self, data_type):
+
+        if 'ASNLength' in data_type or 'LILength' in data_type:
+            return [(PLAN_LENGTH, data_type, None)]
+
+        elif 'length' in data_type:
+            return [(PLAN_FIXED, 'H', [(FIELD_VALUE, 'length', None)])]
+
+        elif data_type == 'AttributeList':
+            return [(PLAN_ATTRIBUTES, None, None)]
+
+        elif data_type == 'VariableLabel':
+            return [(PLAN_READ, self.readVariableLabel, None)]
+
+        elif data_type == 'VariableData':
+            return [(PLAN_READ, self.readVariableData, None)]
+
+        elif data_type == 'String':
+            return [(PLAN_READ, self.readString, None)]
+
+        elif data_type == 'FLOATType':
+            return [(PLAN_FIXED, 'I', [(FIELD_CALL, 'FLOATType', self.convertFLOAT)])]
+
+        elif data_type == 'al_source_code':
+            return [(PLAN_FIXED, 'HH', [(FIELD_ALARM, None, None)])]
+
+        elif self.DataTypes[data_type][0] == 'count':
+            return [(PLAN_LIST, data_type, self.compileList([self.DataTypes[data_type][2]]))]
+
+        elif type(self.DataTypes[data_type][0]) == int:
+
+            # Fields recur throughout the tree, only build their lookups once
+            if data_type not in self.FieldPlans:
+                self.FieldPlans[data_type] = self.compileField(data_type)
+
+            return [self.FieldPlans[data_type]]
+
+        else:
+            plan = self.compileList(self.DataTypes[data_type])
+
+            # Nothing variable inside, so the whole data type is one fixed run
+            if all(step[0] == PLAN_FIXED for step in plan):
+                fmt = ''.join(step[1] for step in plan)
+                template = [field for step in plan for field in step[2]]
+                return [(PLAN_FIXED, fmt, [(FIELD_DICT, data_type, template)])]
+
+            return [(PLAN_DICT, data_type, plan)]
+
+    # Compiles a basic (integer) data type into a PLAN_FIXED step
+    def compileField(self, data_type):
+
+        size = self.DataTypes[data_type][0]
+        keys = self.DataKeys.get(data_type, 'Not Defined')
+        keyed = keys != 'Not Defined'
+
+        if size == 32 or size == 16:
+
+            fmt = 'I' if size == 32 else 'H'
+
+            if not keyed:
+                return (PLAN_FIXED, fmt, [(FIELD_VALUE, data_type, None)])
+
+            return (PLAN_FIXED, fmt, [(FIELD_LOOKUP, data_type, self.compileLookup(keys, size))])
+
+        elif size == -16:
+
+            if keyed:
+                return (PLAN_FIXED, 'h', [(FIELD_BYTES, data_type, None)])
+
+            return (PLAN_FIXED, 'h', [(FIELD_VALUE, data_type, None)])
+
+        elif size == 8:
+
+            count = self.DataTypes[data_type][1]
+
+            if count == 'bcd':
+
+                if keyed:
+                    return (PLAN_FIXED, 'B', [(FIELD_BYTES, data_type, None)])
+
+                table = [int(str(value >> 4) + str(value & 0x0F)) for value in range(256)]
+                return (PLAN_FIXED, 'B', [(FIELD_TABLE, data_type, table)])
+
+            elif count == 1:
+
+                if keyed:
+                    table = []
+                    for value in range(256):
+                        key = UINT8.pack(value)
+                        table.append(keys.get(key, key))
+                    return (PLAN_FIXED, 'B', [(FIELD_TABLE, data_type, table)])
+
+                return (PLAN_FIXED, 'B', [(FIELD_VALUE, data_type, None)])
+
+            elif not keyed:
+                return (PLAN_FIXED, '%dB' % count, [(FIELD_LIST, data_type, count)])
+
+        raise ValueError('Can\'t plan {0} {1}'.format(data_type, self.DataTypes[data_type]))
+
+    # Turns a DataKeys dict into an int-keyed one for 16 or 32 bit fields
+    def compileLookup(self, keys, size):
+
+        fmt = '>I' if size == 32 else '>H'
+
+        # Binary keys become int keys, misses (and binary labels) stay ints
+        lookup = {}
+        for key, label in keys.items():
+            if isinstance(key, bytes) and len(key) == size // 8 and not isinstance(label, bytes):
+                lookup[struct.unpack(fmt, key)[0]] = label
+
+        return lookup
+
+    # Replaces fixed-width formats with compiled structs, returns plan
+    def finalizePlan(self, plan):
+
+        final = []
+
+        for opcode, argument, sub_plan in plan:
+
+            if opcode == PLAN_FIXED:
+                final.append((opcode, struct.Struct('>' + argument), sub_plan))
+            elif opcode == PLAN_DICT or opcode == PLAN_LIST:
+                final.append((opcode, argument, self.finalizePlan(sub_plan)))
+            else:
+                final.append((opcode, argument, sub_plan))
+
+        return final
+
+    # Same conversion as readFLOAT, from the raw uint32
+    def convertFLOAT(self, raw):
+
+        exponent = raw >> 24
+        if exponent >= 0x80:
+            exponent -= 0x100
+        mantissa = raw & 0xFFFFFF
+
+        if mantissa == 0x7FFFFF:
+            return 'Not a number'
+        elif mantissa == 0x800000:
+            return 'Not at this resolution'
+        elif mantissa == 0x7FFFFE:
+            return 'Positive Infinity'
+        elif mantissa == 0x800002:
+            return 'Negative Infinity'
+
+        if mantissa >= 0x800000:
+            mantissa -= 0x1000000
+
+        return mantissa * 10 ** exponent
+
+    # Maps int OIDs to the OIDType keys readAttributeList uses, returns dict
+    def compileAttributeOIDs(self):
+
+        AttributeOIDs = {}
+
+        for key, label in self.DataKeys['OIDType'].items():
+            if isinstance(key, bytes) and len(key) == 2:
+                AttributeOIDs[UINT16.unpack(key)[0]] = label
+
+        AttributeOIDs[0x0001] = 'NOM_POLL_PROFILE_SUPPORT'
+        AttributeOIDs[0x0102] = 'NOM_MDIB_OBJ_SUPPORT'
+        AttributeOIDs[0xF001] = 'NOM_ATTR_POLL_PROFILE_EXT'
+        # Fix from @uday for u'ALL' problem 3/18
+        AttributeOIDs[0x0000] = 0
+
+        return AttributeOIDs
+
+    # Executes a decode plan, returns index
+    def readPlan(self, plan, index, current_message_dict, data):
+        """
+        Inputs:
+        plan: A decode plan from compilePlan
+        index: The current index being parsed
+        current_message_dict: A dictionary created to store the data
+        data: UDP data packet
+
+        Output:
+        index: updates the index after each step
+        """
+
+        for opcode, argument, sub_plan in plan:
+
+            if opcode == PLAN_FIXED:
+                self.fillTemplate(sub_plan, argument.unpack_from(data, index), 0, current_message_dict)
+                index += argument.size
+
+            elif opcode == PLAN_DICT:
+                current_message_dict[argument] = {}
+                index = self.readPlan(sub_plan, index, current_message_dict[argument], data)
+
+            elif opcode == PLAN_READ:
+                index = argument(index, current_message_dict, data)
+
+            elif opcode == PLAN_ATTRIBUTES:
+                index = self.readPlanAttributeList(index, current_message_dict, data)
+
+            elif opcode == PLAN_LIST:
+                index = self.readPlanList(index, argument, sub_plan, current_message_dict, data)
+
+            elif opcode == PLAN_LENGTH:
+                index = self.readLengths(index, current_message_dict, data, argument)
+
+        return index
+
+    # Stores unpacked values into the dictionary per the template, returns position
+    def fillTemplate(self, template, values, position, current_message_dict):
+
+        for kind, name, argument in template:
+
+            if kind == FIELD_VALUE:
+                current_message_dict[name] = values[position]
+                position += 1
+
+            elif kind == FIELD_LOOKUP:
+                value = values[position]
+                current_message_dict[name] = argument.get(value, value)
+                position += 1
+
+            elif kind == FIELD_DICT:
+                current_message_dict[name] = {}
+                position = self.fillTemplate(argument, values, position, current_message_dict[name])
+
+            elif kind == FIELD_TABLE:
+                current_message_dict[name] = argument[values[position]]
+                position += 1
+
+            elif kind == FIELD_CALL:
+                current_message_dict[name] = argument(values[position])
+                position += 1
+
+            elif kind == FIELD_ALARM:
+                self.convertAlSourceCode(values[position], values[position+1], current_message_dict)
+                position += 2
+
+            elif kind == FIELD_LIST:
+                current_message_dict[name] = list(values[position:position+argument])
+                position += argument
+
+            elif kind == FIELD_BYTES:
+                current_message_dict[name] = b''
+                position += 1
+
+        return position
+
+    # Same conversion as readAlSourceCode, from the raw source and code
+    def convertAlSourceCode(self, source, code, current_message_dict):
+
+        source_key = UINT16.pack(source)
+
+        if code & 1:
+            current_message_dict['al_source'] = self.DataKeys['OIDType'].get(source_key, source)
+        else:
+            current_message_dict['al_source'] = self.DataKeys['SCADAType'].get(source_key, source)
+
+        code = code & ~1
+        current_message_dict['al_code'] = self.DataKeys['EventTypes'].get(code, code)
+
+    # Plan version of readVariableLengthList, returns index
+    def readPlanList(self, index, data_type, item_plan, current_message_dict, data):
+
+        count, length = UINT16_PAIR.unpack_from(data, index)
+        index += 4
+
+        current_message_dict[data_type] = {}
+        current_message_dict[data_type]['count'] = count
+        current_message_dict[data_type]['length'] = length
+
+        data_value = self.DataTypes[data_type][2] + '_'
+
+        for i in range(count):
+
+            current_message_dict[data_type][data_value + str(i)] = {}
+            index = self.readPlan(item_plan, index, current_message_dict[data_type][data_value + str(i)], data)
+
+        return index
+
+    # Plan version of readAttributeList, returns index
+    def readPlanAttributeList(self, index, current_message_dict, data):
+
+        count, length = UINT16_PAIR.unpack_from(data, index)
+        index += 4
+
+        current_message_dict['AttributeList'] = {}
+        current_message_dict['AttributeList']['count'] = count
+        current_message_dict['AttributeList']['length'] = length
+        current_message_dict['AttributeList']['AVAType'] = {}
+
+        # Deal with Null Attributes
+        if count == 0:
+            current_message_dict['AttributeList']['AVAType'] = 'Null'
+            return index
+
+        AVAType = current_message_dict['AttributeList']['AVAType']
+
+        for i in range(count):
+
+            OIDIndex, length = UINT16_PAIR.unpack_from(data, index)
+            index += 4
+
+            if OIDIndex in self.AttributeOIDs:
+                OIDType = self.AttributeOIDs[OIDIndex]
+            else:
+                OIDType = UINT16.pack(OIDIndex)
+
+            AVAType[OIDType] = {'length': length, 'AttributeValue': {}}
+
+            if isinstance(OIDType, unicode):
+
+                AttributeType = self.DataKeys['AttributeType'].get(OIDType, OIDType)
+                plan = self.getTypePlan(AttributeType)
+
+                if plan is None:
+                    index = self.recurseRead([AttributeType], index, AVAType[OIDType]['AttributeValue'], data)
+                else:
+                    index = self.readPlan(plan, index, AVAType[OIDType]['AttributeValue'], data)
+
+            else:
+                AVAType[OIDType]['AttributeValue'] = 'OIDType Not Defined'
+                index += length
+
+        return index
+
+    # Walks a wave poll result once, returns (RelativeTime, observations) or None
+    def readWaveObservations(self, data):
+        """
+        Direct path for (Linked)MDSExtendedPollActionResult wave messages that
+        skips building the readData dictionary.
+
+        Returns None if the poll isn't for NOM_MOC_VMO_METRIC_SA_RT, otherwise
+        the poll's RelativeTime and a list of (Handle, attributes, samples)
+        per ObservationPoll, where:
+
+            attributes - {OIDType: AttributeValue dict} for everything other
+                         than the sample values (ie label, scale, unit, and
+                         sample period on the first poll); the sample value
+                         attributes are present with None
+            samples - [(SCADAType, values, compound)] for each SaObsValue,
+                      compound if it came from NOM_ATTR_SA_CMPD_VAL_OBS
+        """
+
+        data = getattr(data, 'payload', data)
+
+        # SPpdu, ROapdus, and RORSapdu (ROLRSapdu has 2 more bytes of RolrsId)
+        index = 16 if self.get16(data, 4) == 5 else 14
+
+        # ActionResult, then poll_number, sequence_no, RelativeTime, AbsoluteTime, Type
+        index += 10
+        relative_time = self.get32(data, index+4)
+        if self.get16(data, index+18) != self.WaveOIDs['NOM_MOC_VMO_METRIC_SA_RT']:
+            return None
+        index += 22
+
+        observations = []
+
+        poll_count = self.get16(data, index)
+        index += 4
+
+        for i in range(poll_count):
+
+            # SingleContextPoll: MdsContext, poll_info count and length
+            observation_count = self.get16(data, index+2)
+            index += 6
+
+            for j in range(observation_count):
+
+                handle, attribute_count = UINT16_PAIR.unpack_from(data, index)
+                index += 6
+
+                attributes = {}
+                samples = []
+
+                for k in range(attribute_count):
+
+                    OIDIndex, length = UINT16_PAIR.unpack_from(data, index)
+                    index += 4
+                    OIDType = self.AttributeOIDs.get(OIDIndex)
+
+                    if OIDIndex == self.WaveOIDs['NOM_ATTR_SA_VAL_OBS']:
+                        attributes[OIDType] = None
+                        samples.append(self.readSaObsValue(index, data) + (False,))
+
+                    elif OIDIndex == self.WaveOIDs['NOM_ATTR_SA_CMPD_VAL_OBS']:
+                        attributes[OIDType] = None
+                        value_index = index + 4
+                        for n in range(self.get16(data, index)):
+                            samples.append(self.readSaObsValue(value_index, data) + (True,))
+                            value_index += 6 + self.get16(data, value_index+4)
+
+                    elif isinstance(OIDType, unicode):
+                        plan = self.getTypePlan(self.DataKeys['AttributeType'].get(OIDType, OIDType))
+                        if plan is not None:
+                            attributes[OIDType] = {}
+                            self.readPlan(plan, index, attributes[OIDType], data)
+
+                    index += length
+
+                observations.append((handle, attributes, samples))
+
+        return relative_time, observations
+
+    # Reads a SaObsValue in place, returns (SCADAType, values array)
+    def readSaObsValue(self, index, data):
+
+        # SCADAType, MeasurementState, then VariableData length and values
+        scada = self.get16(data, index)
+        count = int(self.get16(data, index+4)/2)
+
+        return self.SCADALabels.get(scada, scada), np.frombuffer(data, dtype=SAMPLES, count=count, offset=index+6)
+
     # Writes lengths, ASNLengths, LILengths into messages, no return
     def writeLengths(self, output_message, length, ASNLength, LILength, finalIndex):
         """
@@ -2318,6 +2905,226 @@ class IntellivueDecoder(object):
         return message_type
 
 
+# Helpers for building sample poll results (for tests and benchmarks)
+
+def _sample_attribute(oid, value):
+    return struct.pack('>HH', oid, len(value)) + value
+
+
+def _sample_counted(items, prefix=b''):
+    body = b''.join(items)
+    return prefix + struct.pack('>HH', len(items), len(body)) + body
+
+
+def _sample_float(exponent, mantissa):
+    return struct.pack('>b', exponent) + struct.pack('>i', mantissa)[1:]
+
+
+def _sample_string(text):
+    # Big endian utf-16 on the wire, see readString
+    raw = text.encode('utf-16-be')
+    return struct.pack('>H', len(raw)) + raw
+
+
+def _sample_poll_result(object_type, attribute_group, observations, relative_time, sequence_no):
+    poll_info = _sample_counted(observations, struct.pack('>H', 0))             # MdsContext
+    reply = struct.pack('>HHI', 1, sequence_no, relative_time) + \
+        b'\x20\x16\x10\x25\x11\x30\x15\x00' + \
+        struct.pack('>HHH', 1, object_type, attribute_group) + \
+        _sample_counted([poll_info])
+    action_result = struct.pack('>HHHHH', 33, 0, 0, 0xF13B, len(reply)) + reply   # NOM_MOC_VMS_MDS, NOM_ACT_POLL_MDIB_DATA_EXT
+    rors = struct.pack('>HHH', 1, 7, len(action_result)) + action_result           # CMD_CONFIRMED_ACTION
+    return struct.pack('>HHHH', 0xE100, 2, 2, len(rors)) + rors                    # RORS_APDU
+
+
+def sample_wave_poll_result(relative_time=0x00100000, sequence_no=1, full=True):
+    """
+    Builds a MDSExtendedPollActionResult message carrying a Pleth (32 samples)
+    and ECG II (64 samples) observation, the way a monitor sends them after
+    the wave priority list is set.  If full, the observations also include
+    the label, scale, unit, and sample period attributes from the first poll.
+    """
+
+    def observation(handle, label, scada, unit, period, scale, samples):
+        attributes = []
+        if full:
+            attributes += [_sample_attribute(2340, struct.pack('>I', label)),          # NOM_ATTR_ID_LABEL
+                           _sample_attribute(2415, _sample_float(*scale[0]) + _sample_float(*scale[1]) +
+                                             struct.pack('>HH', *scale[2])),             # NOM_ATTR_SCALE_SPECN_I16
+                           _sample_attribute(2454, struct.pack('>H', unit)),             # NOM_ATTR_UNIT_CODE
+                           _sample_attribute(2445, struct.pack('>I', period)),           # NOM_ATTR_TIME_PD_SAMP
+                           _sample_attribute(2337, struct.pack('>H', handle))]           # NOM_ATTR_ID_HANDLE
+        value = struct.pack('>HHH', scada, 0, 2 * len(samples)) + struct.pack('>%dH' % len(samples), *samples)
+        attributes.append(_sample_attribute(2414, value))                               # NOM_ATTR_SA_VAL_OBS
+        return _sample_counted(attributes, struct.pack('>H', handle))
+
+    pleth = [(2048 + (i * 97) % 1024) for i in range(32)]
+    ecg = [(0x1F7D + (i * 0x3C1) % 0x0400) for i in range(64)]
+
+    observations = [observation(0x0010, 0x00024BB4, 19380, 512, 64, ((0, 0), (1, 4095), (0, 4095)), pleth),
+                    observation(0x0011, 0x00020102, 258, 4274, 32, ((-2, -4000), (-2, 4000), (0, 16383)), ecg)]
+
+    return _sample_poll_result(9, 2051, observations, relative_time, sequence_no)   # NOM_MOC_VMO_METRIC_SA_RT
+
+
+def sample_numeric_poll_result(relative_time=0x00100000, sequence_no=1):
+    """
+    Builds a MDSExtendedPollActionResult message carrying heart rate, SpO2,
+    and a compound non-invasive blood pressure observation.
+    """
+
+    def value(scada, unit, exponent, mantissa):
+        return struct.pack('>HHH', scada, 0, unit) + _sample_float(exponent, mantissa)
+
+    def observation(handle, label, obs):
+        return _sample_counted([_sample_attribute(2340, struct.pack('>I', label)),        # NOM_ATTR_ID_LABEL
+                                _sample_attribute(2448, b'\x20\x16\x10\x25\x11\x30\x15\x00'),  # NOM_ATTR_TIME_STAMP_ABS
+                                obs], struct.pack('>H', handle))
+
+    observations = [observation(0x0020, 0x00024182,
+                                _sample_attribute(2384, value(16770, 2720, 0, 72))),     # NOM_ATTR_NU_VAL_OBS
+                    observation(0x0021, 0x00024BB8,
+                                _sample_attribute(2384, value(19384, 544, -1, 975))),
+                    observation(0x0022, 0x00024A04,
+                                _sample_attribute(2379, _sample_counted([                # NOM_ATTR_NU_CMPD_VAL_OBS
+                                    value(18949, 3872, 0, 120),
+                                    value(18950, 3872, 0, 80),
+                                    value(18951, 3872, 0, 0x7FFFFF)])))]
+
+    return _sample_poll_result(6, 2051, observations, relative_time, sequence_no)   # NOM_MOC_VMO_METRIC_NU
+
+
+def sample_alarm_poll_result(relative_time=0x00100000, sequence_no=1):
+    """
+    Builds a MDSExtendedPollActionResult message carrying one patient alarm
+    (HR high) and one technical alarm (leads off).
+    """
+
+    def alarm(source, code, handle, label, text):
+        info = struct.pack('>HIHH', 0, label, 2, 0x4000) + _sample_string(text)    # al_inst_no, TextId, AlertPriority, AlertFlags
+        return struct.pack('>HHHH', source, code, 1, 0) + \
+            struct.pack('>HHH', 6, 0, handle) + \
+            struct.pack('>HH', 0x0204, len(info)) + info                             # STR_ALMON_INFO
+
+    observations = [_sample_counted([
+        _sample_attribute(2306, _sample_counted([alarm(16770, 40, 0x0020, 0x00024182, '**HR 140 > 120')])),      # NOM_ATTR_AL_MON_P_AL_LIST
+        _sample_attribute(2308, _sample_counted([alarm(258, 61786 | 1, 0x0011, 0x00020102, 'ECG Leads Off')]))], # NOM_ATTR_AL_MON_T_AL_LIST
+        struct.pack('>H', 0x0001))]
+
+    return _sample_poll_result(54, 2049, observations, relative_time, sequence_no)  # NOM_MOC_VMO_AL_MON
+
+
+def benchmark_read_allocations(repeats=500):
+    """
+    Compares the memory and time spent reading a wave poll result when the
+    RS232 layer slices the payload out of the receive buffer (a bytearray
+    slice, then bytes) vs. copying it once through a memoryview, as
+    frameCheckRead does.  Requires tracemalloc (py3).
+    """
+
+    try:
+        import tracemalloc
+    except ImportError:
+        logging.warning('tracemalloc is not available, skipping allocation benchmark')
+        return
+
+    import time
+
+    decoder = IntellivueDecoder()
+    message = sample_wave_poll_result()
+    raw = bytearray(b'\xC0\x11\x01' + struct.pack('>H', len(message)) + message + b'\x00\x00\xC1')
+
+    def sliced():
+        return decoder.readData(bytes(raw[5:5+len(message)]))
+
+    def single_copy():
+        return decoder.readData(bytes(memoryview(raw)[5:5+len(message)]))
+
+    assert same_message(sliced(), single_copy())
+
+    for name, read in (('sliced payload', sliced), ('memoryview copy', single_copy)):
+        tracemalloc.start()
+        tic = time.time()
+        for i in range(repeats):
+            read()
+        toc = time.time()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        logging.info('{0}: {1:.1f} us/frame, peak {2} bytes traced'.format(
+            name, 1e6 * (toc - tic) / repeats, peak))
+
+
+# Compares decoded messages, which hold sample arrays that == can't compare
+def same_message(a, b):
+
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.array_equal(a, b)
+
+    if isinstance(a, dict) and isinstance(b, dict):
+        return sorted(a.keys()) == sorted(b.keys()) and all(same_message(a[key], b[key]) for key in a)
+
+    return a == b
+
+
+def test_decode_plans():
+    """
+    Golden-output check that the compiled decode plans give exactly the same
+    dictionaries as recurseRead.
+    """
+
+    decoder = IntellivueDecoder()
+
+    messages = [sample_wave_poll_result(),
+                sample_wave_poll_result(full=False, sequence_no=2),
+                sample_numeric_poll_result(),
+                sample_alarm_poll_result()]
+
+    for message in messages:
+        golden = decoder.readData(message, compiled=False)
+        assert same_message(decoder.readData(message), golden)
+
+    # Spot check a few decoded values
+    wave = decoder.readData(messages[0])['PollMdibDataReplyExt']
+    pleth = wave['PollInfoList']['SingleContextPoll_0']['SingleContextPoll']['poll_info']['ObservationPoll_0']['ObservationPoll']
+    assert wave['Type']['OIDType'] == 'NOM_MOC_VMO_METRIC_SA_RT'
+    assert pleth['AttributeList']['AVAType']['NOM_ATTR_SA_VAL_OBS']['AttributeValue']['SaObsValue']['SCADAType'] == 'NOM_PLETH'
+    assert len(pleth['AttributeList']['AVAType']['NOM_ATTR_SA_VAL_OBS']['AttributeValue']['SaObsValue']['PhysioValue']['VariableData']['value']) == 32
+
+    numeric = decoder.readData(messages[2])['PollMdibDataReplyExt']
+    spo2 = numeric['PollInfoList']['SingleContextPoll_0']['SingleContextPoll']['poll_info']['ObservationPoll_1']['ObservationPoll']
+    assert spo2['AttributeList']['AVAType']['NOM_ATTR_NU_VAL_OBS']['AttributeValue']['NuObsValue']['FLOATType'] == 97.5
+
+    logging.info('Decode plans match recurseRead')
+
+
+def benchmark_decode_plans(repeats=2000):
+    """
+    Compares readData throughput with compiled decode plans vs. recurseRead
+    for MDSExtendedPollActionResult messages.
+    """
+
+    import time
+
+    decoder = IntellivueDecoder()
+
+    for name, message in (('wave', sample_wave_poll_result(full=False)),
+                          ('numeric', sample_numeric_poll_result()),
+                          ('alarm', sample_alarm_poll_result())):
+
+        rates = []
+        for compiled in (False, True):
+            tic = time.time()
+            for i in range(repeats):
+                decoder.readData(message, compiled=compiled)
+            rates.append(repeats / (time.time() - tic))
+
+        logging.info('{0}: recurseRead {1:.0f} msg/s, decode plan {2:.0f} msg/s ({3:.1f}x)'.format(
+            name, rates[0], rates[1], rates[1] / rates[0]))
+
+
 if __name__ == '__main__':
 
-    IntellivueDecoder()
+    logging.basicConfig(level=logging.INFO)
+    test_decode_plans()
+    benchmark_decode_plans()
+    benchmark_read_allocations()
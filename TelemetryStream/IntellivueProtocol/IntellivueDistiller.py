@@ -11,7 +11,7 @@ from __future__ import division
 import datetime
 import time
 import numpy as np
-from IntellivueDecoder import IntellivueDecoder
+from IntellivueDecoder import nomenclature
 import logging
 
 
@@ -23,8 +23,8 @@ class IntellivueDistiller(object):
 
     def __init__(self):
 
-        # Initialize Intellivue because has data types
-        self.Intellivue = IntellivueDecoder()
+        # Physio label -> SCADA types, shared with the decoder's nomenclature
+        self.PhysioKeys = nomenclature('PhysioKeys')
 
         # Initialize data reading/writing variables
         self.initialTimeDateTime = datetime.datetime.now()
@@ -39,6 +39,8 @@ class IntellivueDistiller(object):
         # Dictionary to be dumped into json file
         self.VitalsWaveData = {}
         self.VitalsWaveInfo = {}
+        # Handle -> labels in VitalsWaveInfo, so observations don't scan all of it
+        self.VitalsWaveHandles = {}
         self.VitalsNumericsInfo = {}
         self.VitalsNumericsAlarmsData = {}
         self.VitalsNumericsAlarmsData['Info'] = {}
@@ -54,7 +56,10 @@ class IntellivueDistiller(object):
 
     def timestamp(self, decoded_message):
         # Initialize timestamp
-        return self.initialTimeDateTime + datetime.timedelta(seconds=float((decoded_message['PollMdibDataReplyExt']['RelativeTime'] - self.relativeInitialTime)/8000))
+        return self.relative_timestamp(decoded_message['PollMdibDataReplyExt']['RelativeTime'])
+
+    def relative_timestamp(self, relative_time):
+        return self.initialTimeDateTime + datetime.timedelta(seconds=float((relative_time - self.relativeInitialTime)/8000))
 
     def strftime(self, ts):
         return ts.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
@@ -147,6 +152,7 @@ class IntellivueDistiller(object):
 
                                         # Inititialize Handle (to help uniquely identify scada)
                                         self.VitalsWaveInfo[label]['Handle'] = decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']['NOM_ATTR_ID_HANDLE']['AttributeValue']['Handle']
+                                        self.VitalsWaveHandles.setdefault(self.VitalsWaveInfo[label]['Handle'], []).append(label)
 
                         # If the message contains data regarding value conversion, units, and sampling freq, and is not compound, store it as defined below:
                         elif 'NOM_ATTR_SCALE_SPECN_I16' in decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']:
@@ -185,6 +191,7 @@ class IntellivueDistiller(object):
 
                                 # Inititialize Handle (to help uniquely identify data type)
                                 self.VitalsWaveInfo[label]['Handle'] = decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']['NOM_ATTR_ID_HANDLE']['AttributeValue']['Handle']
+                                self.VitalsWaveHandles.setdefault(self.VitalsWaveInfo[label]['Handle'], []).append(label)
 
                         # If the message contains data, save it
                         if 'NOM_ATTR_SA_VAL_OBS' in decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']:
@@ -193,12 +200,12 @@ class IntellivueDistiller(object):
                             for dataTypes in self.VitalsWaveInfo:
 
                                 # If label identified (ie handle and SCADA type match Text ID)...
-                                if self.VitalsWaveInfo[dataTypes]['Handle'] == decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['Handle'] and decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']['NOM_ATTR_SA_VAL_OBS']['AttributeValue']['SaObsValue']['SCADAType'] in self.Intellivue.DataKeys['PhysioKeys'][dataTypes]:
+                                if self.VitalsWaveInfo[dataTypes]['Handle'] == decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['Handle'] and decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']['NOM_ATTR_SA_VAL_OBS']['AttributeValue']['SaObsValue']['SCADAType'] in self.PhysioKeys[dataTypes]:
 
                                     label = dataTypes
 
                                     # Create temporary time and data variables
-                                    temp_array = np.array(decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']['NOM_ATTR_SA_VAL_OBS']['AttributeValue']['SaObsValue']['PhysioValue']['VariableData']['value'])
+                                    temp_array = decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']['NOM_ATTR_SA_VAL_OBS']['AttributeValue']['SaObsValue']['PhysioValue']['VariableData']['value']
                                     temp_times = np.linspace((decoded_message['PollMdibDataReplyExt']['RelativeTime'] - self.relativeInitialTime)/8000, (decoded_message['PollMdibDataReplyExt']['RelativeTime'] - self.relativeInitialTime)/8000 + temp_array.size/self.VitalsWaveInfo[label]['SamplingFreq'], temp_array.size, endpoint=False)
 
                                     #*self.checkPatientFile(self.VitalsWaveInfo[label], temp_array.size, self.VitalsNumericsAlarmsData[label].shape[1])
@@ -212,7 +219,7 @@ class IntellivueDistiller(object):
                                     # Add to index
                                     # self.VitalsWaveInfo[label]['Index'] += temp_array.size
 
-                                    ret[label] = temp_array*self.VitalsWaveInfo[label]['ValueConversion'][0] + self.VitalsWaveInfo[label]['ValueConversion'][1]
+                                    ret[label] = self.scaleValues(temp_array, self.VitalsWaveInfo[label]['ValueConversion'])
 
                         # If the message contains compound data, save it
                         if 'NOM_ATTR_SA_CMPD_VAL_OBS' in decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']:
@@ -236,7 +243,7 @@ class IntellivueDistiller(object):
                                                 label = dataTypes
 
                                                 # Create temporary time and data variables
-                                                temp_array = np.array(decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']['NOM_ATTR_SA_CMPD_VAL_OBS']['AttributeValue']['SaObsValueCmp'][saObsValues]['SaObsValue']['PhysioValue']['VariableData']['value']).T
+                                                temp_array = decoded_message['PollMdibDataReplyExt']['PollInfoList'][singleContextPolls]['SingleContextPoll']['poll_info'][observationPolls]['ObservationPoll']['AttributeList']['AVAType']['NOM_ATTR_SA_CMPD_VAL_OBS']['AttributeValue']['SaObsValueCmp'][saObsValues]['SaObsValue']['PhysioValue']['VariableData']['value'].T
                                                 temp_times = np.linspace((decoded_message['PollMdibDataReplyExt']['RelativeTime'] - self.relativeInitialTime)/8000, (decoded_message['PollMdibDataReplyExt']['RelativeTime'] - self.relativeInitialTime)/8000 + temp_array.size/self.VitalsWaveInfo[label]['SamplingFreq'], temp_array.size, endpoint=False).T
 
                                                 #*self.checkPatientFile(self.VitalsWaveInfo[label], temp_array.size, self.VitalsNumericsAlarmsData[label].shape[1])
@@ -250,7 +257,7 @@ class IntellivueDistiller(object):
                                                 # Add to index
 #                                                self.VitalsWaveInfo[label]['Index'] += temp_array.size
 
-                                                ret[label] = temp_array*self.VitalsWaveInfo[label]['ValueConversion'][0] + self.VitalsWaveInfo[label]['ValueConversion'][1]
+                                                ret[label] = self.scaleValues(temp_array, self.VitalsWaveInfo[label]['ValueConversion'])
 
         ret['timestamp'] = self.timestamp(decoded_message)
 
@@ -261,8 +268,80 @@ class IntellivueDistiller(object):
         if len(ret) < 2:
             return None
 
+        # Monitor ticks (1/8000 s) of the first sample, for SampledDataBuffer
+        ret['relative_time'] = decoded_message['PollMdibDataReplyExt']['RelativeTime']
+
+        return ret
+
+    # Save the wave data from IntellivueDecoder.readWaveObservations
+    def refine_wave_observations(self, relative_time, observations):
+        """
+        Direct path version of refine_wave_message, for the (Handle,
+        attributes, samples) tuples from IntellivueDecoder.readWaveObservations.
+        Returns the same dict, but matches handles through VitalsWaveHandles.
+        """
+
+        ret = {}
+        has_times = False
+        start_time = (relative_time - self.relativeInitialTime)/8000
+
+        for handle, attributes, samples in observations:
+
+            # The first poll carries value conversion, units, and sampling freq
+            if 'NOM_ATTR_SCALE_SPECN_I16' in attributes:
+
+                # For compound values the label is the scada label, otherwise the TextId
+                if 'NOM_ATTR_SA_CMPD_VAL_OBS' in attributes:
+                    labels = [scada for scada, values, compound in samples if compound]
+                else:
+                    labels = [attributes['NOM_ATTR_ID_LABEL']['TextId']]
+
+                for label in labels:
+                    if label not in self.VitalsWaveInfo:
+                        self.add_wave_info(label, attributes)
+
+            for scada, values, compound in samples:
+
+                for label in self.VitalsWaveHandles.get(handle, []):
+
+                    # Compound values match on the scada label, others on the physio label's scada types
+                    if compound:
+                        if scada != label:
+                            continue
+                    elif scada not in self.PhysioKeys.get(label, []):
+                        continue
+
+                    ret[label] = self.scaleValues(values, self.VitalsWaveInfo[label]['ValueConversion'])
+
+                    # Same test as temp_times.any() in refine_wave_message
+                    has_times = len(values) > 1 or (len(values) == 1 and start_time != 0)
+
+        ret['timestamp'] = self.relative_timestamp(relative_time)
+
+        if has_times:
+            # about 25 samples/250ms, so back up 10ms
+            ret['end_time'] = ret['timestamp'] + datetime.timedelta(milliseconds=250-10)
+
+        if len(ret) < 2:
+            return None
+
+        # Monitor ticks (1/8000 s) of the first sample, for SampledDataBuffer
+        ret['relative_time'] = relative_time
+
         return ret
 
+    # Stores basic attributes of a wave from its first poll's attributes
+    def add_wave_info(self, label, attributes):
+
+        self.VitalsWaveInfo[label] = {}
+        self.VitalsWaveInfo[label]['Index'] = 0
+        self.VitalsWaveInfo[label]['ValueConversion'] = self.convertValues(attributes['NOM_ATTR_SCALE_SPECN_I16']['ScaleRangeSpec16'])
+        self.VitalsWaveInfo[label]['Units'] = attributes['NOM_ATTR_UNIT_CODE']['UNITType']
+        self.VitalsWaveInfo[label]['SamplingFreq'] = int(8000/attributes['NOM_ATTR_TIME_PD_SAMP']['RelativeTime'])
+        self.VitalsWaveInfo[label]['Handle'] = attributes['NOM_ATTR_ID_HANDLE']['Handle']
+
+        self.VitalsWaveHandles.setdefault(self.VitalsWaveInfo[label]['Handle'], []).append(label)
+
     # Save the numeric data
     def refine_numerics_message(self, decoded_message):
         """
@@ -561,3 +640,56 @@ class IntellivueDistiller(object):
             b = ScaleRangeSpec16['lower_absolute_value']['FLOATType'] - a * ScaleRangeSpec16['lower_scaled_value']
 
             return a, b
+
+    # Scales a uint16 sample array by the a, b from convertValues, returns float array
+    def scaleValues(self, values, ValueConversion):
+        """
+        One float copy of the decoder's sample array, then y = ax + b in place
+        """
+        a, b = ValueConversion
+
+        scaled = values.astype(np.float64)
+        scaled *= a
+        scaled += b
+
+        return scaled
+
+
+def test_fast_distill():
+    """
+    Checks that the direct wave path gives the same result as the nested
+    dict path for a first (full) poll and the polls that follow it.
+    """
+
+    from IntellivueDecoder import IntellivueDecoder, sample_wave_poll_result
+
+    decoder = IntellivueDecoder()
+    nested = IntellivueDistiller()
+    direct = IntellivueDistiller()
+    direct.initialTimeDateTime = nested.initialTimeDateTime
+
+    messages = [sample_wave_poll_result(),
+                sample_wave_poll_result(relative_time=0x00100800, sequence_no=2, full=False),
+                sample_wave_poll_result(relative_time=0x00101000, sequence_no=3, full=False)]
+
+    for message in messages:
+        expected = nested.refine_wave_message(decoder.readData(message))
+        result = direct.refine_wave_observations(*decoder.readWaveObservations(message))
+
+        assert sorted(result.keys()) == sorted(expected.keys())
+        for key in expected:
+            if isinstance(expected[key], np.ndarray):
+                assert np.array_equal(result[key], expected[key])
+            else:
+                assert result[key] == expected[key]
+
+    assert direct.VitalsWaveInfo == nested.VitalsWaveInfo
+    assert direct.VitalsWaveHandles == nested.VitalsWaveHandles
+
+    logging.info('Direct wave path matches refine_wave_message')
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO)
+    test_fast_distill()
@@ -17,6 +17,92 @@ import serial.tools.list_ports
 import struct
 import logging
 import itertools
+import time
+import random
+
+try:
+    # Optional compiled CRC; the manual's FCS is CRC-16/X.25 (0x8408 reflected, init 0xFFFF, complemented)
+    import crcmod.predefined
+    fast_crc16 = crcmod.predefined.mkCrcFun('x-25')
+except ImportError:
+    fast_crc16 = None
+
+
+class FrameBuffer(object):
+    """
+    Accumulates raw serial bytes and splits them into complete frames
+
+    Frames are delimited by BOF (0xC0) and EOF (0xC1).  Because of the
+    transparency encoding, neither byte can occur inside a frame, so a BOF
+    seen before the next EOF means the earlier frame was truncated.
+    """
+
+    BOF = b'\xC0'
+    EOF = b'\xC1'
+
+    def __init__(self, compact_size=4096):
+        self.buffer = bytearray()
+        self.start = 0
+        # Consumed bytes are only discarded once there are this many of them
+        self.compact_size = compact_size
+
+    def extend(self, data):
+        self.buffer.extend(data)
+
+    def pending(self):
+        """
+        returns: True if a partial frame has been started but not finished
+        """
+        return self.buffer.find(self.BOF, self.start) >= 0
+
+    def next_frame(self):
+        """
+        returns: frame - bytearray from BOF to EOF inclusive, or None if no
+        complete frame is buffered yet
+        """
+        frame = None
+
+        bof = self.buffer.find(self.BOF, self.start)
+        if bof < 0:
+            # Nothing but noise, drop it
+            self.start = len(self.buffer)
+
+        else:
+            eof = self.buffer.find(self.EOF, bof)
+            if eof < 0:
+                # Keep the partial frame, skip anything before it
+                self.start = bof
+
+            else:
+                # Resync to the last BOF if an earlier frame lost its EOF
+                bof = self.buffer.rfind(self.BOF, bof, eof)
+                frame = self.buffer[bof:eof+1]
+                self.start = eof + 1
+
+        self.compact()
+        return frame
+
+    def frames(self):
+        """
+        Yields all of the complete frames that are currently buffered
+        """
+        frame = self.next_frame()
+        while frame:
+            yield frame
+            frame = self.next_frame()
+
+    def compact(self):
+        # Amortize the cost of dropping consumed bytes
+        if self.start == len(self.buffer):
+            del self.buffer[:]
+            self.start = 0
+        elif self.start >= self.compact_size:
+            del self.buffer[:self.start]
+            self.start = 0
+
+    def clear(self):
+        del self.buffer[:]
+        self.start = 0
 
 
 class RS232(object):
@@ -47,12 +133,15 @@ class RS232(object):
 
         # Create CRC16 Table
         self.CRCTable = self.getCRCTable()
+
+        # Buffer for bytes read from the socket but not yet framed
+        self.frames = FrameBuffer()
         logging.debug('Serial connection opened')
 
     # Returns value from uint16 binary
-    def get16(self, data):
+    def get16(self, data, index=0):
         try:
-            ret = struct.unpack('>H', data)[0]
+            ret = struct.unpack_from('>H', data, index)[0]
         except struct.error:
             # Occasionally get a bad message format, returning 0 will fail the CRC check and ignore
             ret = 0
@@ -90,22 +179,23 @@ class RS232(object):
         """
         generates CRC16 as defined by manual
 
+        message may be bytes, a bytearray, or a memoryview onto either
+
         returns: fcs - 16 bit crc code
         """
-        length = len(message)
-        fcs = 0xFFFF
 
-        if type(message) != bytearray:
-            message = bytearray(message)
+        if fast_crc16:
+            fcs = fast_crc16(message)
 
-        # logging.debug("CRC16->Message as bytes {0}:".format(message))
+        else:
+            fcs = 0xFFFF
 
-        for i in range(0, length):
-            # fcs = (fcs >> 8) ^ table[(fcs ^ message[i]) & 0xFF]
-            fcs = (fcs >> 8) ^ table[(fcs ^ message[i]) & 0xFF]
+            # Tight loop with everything bound locally
+            for byte in bytearray(message):
+                fcs = (fcs >> 8) ^ table[(fcs ^ byte) & 0xFF]
 
-        # One's Complement
-        fcs = ~fcs & 0xFFFF
+            # One's Complement
+            fcs = ~fcs & 0xFFFF
 
         # Byte Swap
         fcs = struct.pack('<H', fcs)
@@ -133,38 +223,20 @@ class RS232(object):
         """
         performs transparency check while reading as defined by manual
 
-        returns: message - bytes ready to be deciphered
-        """
-
-        if type(message) != bytearray:
-            message = bytearray(message)
+        Each escape (0x7D) is followed by its byte XOR 0x20, i.e., 0x7D 0xE0
+        for 0xC0, 0x7D 0xE1 for 0xC1, and 0x7D 0x5D for 0x7D.  The 0x7D
+        pair is undone last so it cannot create new escape sequences.
 
-        # store (index, bin) in these lists
-        indices = []
+        returns: message - bytes (or bytearray) ready to be deciphered
+        """
 
-        # iterate through message and store indices of 0xc1,0xc0,0x7d
-        for i in range(0, len(message)-1):
-            if message[i] == 0x7D:
-                if message[i+1] == 0xC0 ^ 0x20:
-                    indices.append((i, 192))  # 0xc0 = 192
-                elif message[i+1] == 0xC1 ^ 0x20:
-                    indices.append((i, 193))  # 0xc1 = 193
-                elif message[i+1] == 0x7D ^ 0x20:
-                    indices.append((i, 125))  # 0x7d = 125
-
-        # Sort indices
-        sortedIndices = sorted(indices, reverse=True)
-
-        # Iterate through list and change message
-        for value in sortedIndices:
-            if value[1] == 192:
-                message[value[0]:value[0]+2] = b'\xC0'
-            elif value[1] == 193:
-                message[value[0]:value[0]+2] = b'\xC1'
-            elif value[1] == 125:
-                message[value[0]:value[0]+2] = b'\x7D'
+        # Most frames have nothing escaped at all
+        if b'\x7D' in message:
+            message = message.replace(b'\x7D\xE0', b'\xC0') \
+                             .replace(b'\x7D\xE1', b'\xC1') \
+                             .replace(b'\x7D\x5D', b'\x7D')
 
-        return bytes(message)
+        return message
 
     # Adds header, fcs, transparency check to messages
     def frameCheckWrite(self, message):
@@ -199,24 +271,25 @@ class RS232(object):
 
         Also checks FCS to ensure proper format
 
-        returns: decodedMessage - dict of deciphered message
+        returns: finalMessage - the message bytes, b'' on a CRC mismatch,
+        or None if the framing is wrong
         """
 
         finalMessage = None
         # Check for start bit and correct protocol id
         if message[0:3] == b'\xC0\x11\x01':
 
-            # Transparency Check (not including start, stop)
-            message = self.readTransparencyCheck(message[1:-1])
+            # Transparency Check (start and stop are never escaped, so they can stay in place)
+            message = self.readTransparencyCheck(message)
 
             # Length, CRC calculations
-            length = self.get16(message[2:4])
-            givenCRC = message[4+length:6+length]
-            validatedCRC = self.getCRC16(message[:4+length], self.CRCTable)
+            length = self.get16(message, 3)
+            givenCRC = message[5+length:7+length]
+            validatedCRC = self.getCRC16(memoryview(message)[1:5+length], self.CRCTable)
 
             # Check that CRC's match up, otherwise ignore message
             if givenCRC == validatedCRC:
-                finalMessage = message[4:4+length]
+                finalMessage = bytes(memoryview(message)[5:5+length])
             # If they are not the same, output CRC mismatch
             else:
                 finalMessage = b''
@@ -241,51 +314,49 @@ class RS232(object):
             logging.warn('Trying to receive without a socket')
             return
 
-        # initialize message
-        message = bytearray()
-
-        # initialize boolean
-        messageNotDone = True
+        while True:
 
-        # read in current byte
-        currentByte = self.socket.read(1)
+            # Hand back any frame that is already buffered
+            message = self.frames.next_frame()
+            if message:
+                return self.frameCheckRead(message)
 
-        # Loop to read in entire message
-        if currentByte == b'\xC0':
-            message = message + currentByte
+            # Pull in whatever is waiting (or block for one byte until the timeout)
+            chunk = self.socket.read(max(1, self.socket.inWaiting()))
 
-            while(messageNotDone):
-                messageByte = self.socket.read(1)
-
-                if not messageByte:
+            if not chunk:
+                if self.frames.pending():
                     # Bail out! The message is incomplete.
                     logging.warn('Incomplete message received!')
                     return None
-                elif messageByte != b'\xC1':
-                    message = message + messageByte
-                else:
-                    message = message + messageByte
-                    messageNotDone = False
 
-            # Frame check message
-            finalMessage = self.frameCheckRead(bytes(message))
+                # If not at start bit return nothing
+                return b''
 
-        # If not at start bit return nothing
-        else:
-            finalMessage = b''
+            self.frames.extend(chunk)
 
-        return finalMessage
+            # Only noise so far, don't spin on it
+            if not self.frames.pending():
+                return b''
 
     # Sends final messages to monitor
     def send(self, message):
         """
         Sends the finalized message to the monitor
         """
+        self.sendFramed(self.frameCheckWrite(message))
+
+    # Sends already framed messages (from frameCheckWrite) to monitor
+    def sendFramed(self, frame):
+        """
+        Sends a message that has already been through frameCheckWrite, ie
+        one that is cached and resent as is
+        """
         if not self.socket or not self.socket.isOpen():
             logging.warn('Trying to write without a socket')
             return
 
-        self.socket.write(self.frameCheckWrite(message))
+        self.socket.write(frame)
 
     def __del__(self):
         print('Tearing down socket.')
@@ -302,6 +373,7 @@ class RS232(object):
             # self.socket.flush()
             self.socket.flushInput()
             self.socket.flushOutput()
+            self.frames.clear()
             self.socket.close()
             logging.warn('Socket closed')
         except:
@@ -309,8 +381,91 @@ class RS232(object):
             raise
 
 
+def benchmark_frame_check_read(capture_file=None, repeats=2000):
+    """
+    Compares frames/second for frameCheckRead against the original per-byte
+    CRC16 and splice-based transparency check
+
+    capture_file is a raw serial capture from a monitor; if none is given,
+    wave-sized frames (~64 random uint16 samples, so some bytes are escaped)
+    are synthesized instead
+    """
+
+    # The frame layer does not need an open port
+    rs232 = RS232.__new__(RS232)
+    rs232.socket = None
+    rs232.CRCTable = rs232.getCRCTable()
+
+    if capture_file:
+        frames = FrameBuffer()
+        with open(capture_file, 'rb') as f:
+            frames.extend(f.read())
+        frames = list(frames.frames())
+
+    else:
+        frames = []
+        for i in range(20):
+            payload = bytearray(b'\xE1\x00\x00\x02\x00\x02\x00\xB0\x00\x01\x00\x07\x00\xAA')
+            for j in range(64):
+                payload += rs232.set16(random.randint(0, 0xFFFF))
+            body = bytearray(b'\x11\x01') + rs232.set16(len(payload)) + payload
+            body += rs232.getCRC16(body, rs232.CRCTable)
+            body = bytes(body).replace(b'\x7D', b'\x7D\x5D') \
+                              .replace(b'\xC0', b'\x7D\xE0') \
+                              .replace(b'\xC1', b'\x7D\xE1')
+            frames.append(b'\xC0' + body + b'\xC1')
+
+    # Original implementation, kept here for comparison
+    def original_crc16(message, table):
+        fcs = 0xFFFF
+        message = bytearray(message)
+        for i in range(0, len(message)):
+            fcs = (fcs >> 8) ^ table[(fcs ^ message[i]) & 0xFF]
+        return struct.pack('<H', ~fcs & 0xFFFF)
+
+    def original_transparency(message):
+        message = bytearray(message)
+        indices = []
+        for i in range(0, len(message)-1):
+            if message[i] == 0x7D:
+                if message[i+1] in (0xE0, 0xE1, 0x5D):
+                    indices.append((i, message[i+1] ^ 0x20))
+        for index, value in sorted(indices, reverse=True):
+            message[index:index+2] = bytearray([value])
+        return bytes(message)
+
+    def original_frame_check_read(message):
+        message = original_transparency(message[1:-1])
+        length = rs232.get16(message[2:4])
+        if message[4+length:6+length] == original_crc16(message[:4+length], rs232.CRCTable):
+            return message[4:4+length]
+        return b''
+
+    def frames_per_sec(func):
+        tic = time.time()
+        for i in range(repeats):
+            for frame in frames:
+                func(frame)
+        toc = time.time()
+        return repeats * len(frames) / (toc - tic)
+
+    for frame in frames:
+        assert rs232.frameCheckRead(frame) == original_frame_check_read(frame)
+
+    original = frames_per_sec(original_frame_check_read)
+    current = frames_per_sec(rs232.frameCheckRead)
+
+    logging.info('Frame check on {0} frames ({1})'.format(
+        len(frames), 'compiled crc' if fast_crc16 else 'pure python crc'))
+    logging.info('  original: {0:.0f} frames/sec'.format(original))
+    logging.info('  current:  {0:.0f} frames/sec ({1:.1f}x)'.format(current, current / original))
+
+    return original, current
+
+
 if __name__ == '__main__':
 
     logging.basicConfig(level=logging.DEBUG)
-    ser = RS232('/dev/cu.usbserial')
+    benchmark_frame_check_read()
+    # ser = RS232('/dev/cu.usbserial')
 
@@ -30,18 +30,47 @@ __version__ = '.'.join(__version_info__)
 # updated 0.7.3 accounts for 8000Hz data collection throughout
 
 
-# Wrapper for UCSF QoS code
+# One QoS engine for the process, so filters are only designed once
+qos_engine = QoS(fs=125)  # For Philips monitors, Pleth frequency is 32 per 1.024/4 second
+
+
+# Wrapper for UCSF QoS code; the stream passes its own qos_mode in with the update kwargs
 def qos(*args, **kwargs):
-    my_qos = QoS()
     history = kwargs.get('sampled_data')
+    mode = kwargs.get('qos_mode') or qos_engine.mode
     if history:
-        res = my_qos.isPPGGoodQuality(history.get('Pleth').get('samples').y,
-                                      125)  # For Philips monitors, Pleth frequency is 32 per 1.024/4 second
-        return {'qos': res}
+        samples = history.get('Pleth').get('samples')
+        ret = {}
+
+        if mode != 'streaming':
+            ret['qos'] = qos_engine.score(samples.y)
+            logging.debug('QoS evaluated in {0:.1f}ms'.format(qos_engine.last_eval_time*1000))
+
+        if mode != 'batch':
+            # Only the samples since the last read
+            new_samples = samples.values(max(samples.written - qos_engine.streamSeen, 0))
+            res = qos_engine.update(new_samples, samples.written)
+            logging.debug('Streaming QoS evaluated in {0:.1f}ms'.format(qos_engine.last_eval_time*1000))
+
+            if mode == 'streaming':
+                ret['qos'] = res
+            else:
+                ret['qos_streaming'] = res
+
+        return ret
     else:
         return -1
 
 
+# Hashable copy of message parameters, for keying the outbound message cache
+def freeze(parameters):
+    if isinstance(parameters, dict):
+        return tuple(sorted((key, freeze(value)) for key, value in parameters.items()))
+    elif isinstance(parameters, (list, tuple)):
+        return tuple(freeze(value) for value in parameters)
+    return parameters
+
+
 class CriticalIOError(IOError):
     """Need to tear the socket down and reset."""
     pass
@@ -69,6 +98,13 @@ class PhilipsTelemetryStream(TelemetryStream):
         self.decoder = IntellivueDecoder()
         self.distiller = IntellivueDistiller()
 
+        # Distill waves straight from the message bytes; False decodes the full
+        # message dict first (slower, but easier to debug)
+        self.fast_distill = kwargs.get('fast_distill', True)
+
+        # Batch, streaming, or compare both (see QualityOfSignal), for this stream's qos hook
+        self.update_kwargs['qos_mode'] = kwargs.get('qos') or qos_engine.mode
+
         # Initialize variables to keep track of time, and values to collect
 
         # Note: The listener automatically shuts down after this many seconds
@@ -82,25 +118,17 @@ class PhilipsTelemetryStream(TelemetryStream):
         self.relativeInitialTime = 0
 
         #  Initialize Messages
-        self.AssociationRequest = self.decoder.writeData('AssociationRequest')
-        self.AssociationAbort = self.decoder.writeData('AssociationAbort')
+        # Outbound requests (association, priority lists, polls, keep alive, release)
+        # are encoded and framed once and kept in self.outbound, see send_message
+        self.outbound = {}
         self.ConnectIndication = {}
         self.AssociationResponse = ''
         self.MDSCreateEvent = {}
         self.MDSParameters = {}
         self.MDSCreateEventResult = ''
-        self.MDSSetPriorityListWave = self.decoder.writeData('MDSSetPriorityListWAVE', self.desiredWaveParams)
-        self.MDSSetPriorityListNumeric = ''
         self.MDSSetPriorityListResultWave = {}
         self.MDSSetPriorityListResultNumeric = {}
-        self.MDSGetPriorityList = self.decoder.writeData('MDSGetPriorityList')
         self.MDSGetPriorityListResult = {}
-        self.ReleaseRequest = self.decoder.writeData('ReleaseRequest')
-        self.MDSExtendedPollActionNumeric = self.decoder.writeData('MDSExtendedPollActionNUMERIC',
-                                                                   self.dataCollection)
-        self.MDSExtendedPollActionWave = self.decoder.writeData('MDSExtendedPollActionWAVE', self.dataCollection)
-        self.MDSExtendedPollActionAlarm = self.decoder.writeData('MDSExtendedPollActionALARM', self.dataCollection)
-        self.KeepAliveMessage = self.decoder.writeData('MDSSinglePollAction')
 
         # Boolean to keep track of whether data should still be polled
         self.data_flow = False
@@ -122,7 +150,7 @@ class PhilipsTelemetryStream(TelemetryStream):
                 logging.warn('Trying to send an Association Request without a socket!')
                 raise CriticalIOError
             try:
-                self.rs232.send(self.AssociationRequest)
+                self.send_message('AssociationRequest')
                 self.logger.debug('Sent Association Request...')
             except:
                 self.logger.warn("Unable to send Association Request")
@@ -233,11 +261,8 @@ class PhilipsTelemetryStream(TelemetryStream):
         Sends MDSSetPriorityListWave
         Receives the confirmation
         """
-        # Writes priority lists
-        self.MDSSetPriorityListWave = self.decoder.writeData('MDSSetPriorityListWAVE', self.desiredWaveParams)
-
         # Send priority lists
-        self.rs232.send(self.MDSSetPriorityListWave)
+        self.send_message('MDSSetPriorityListWAVE', self.desiredWaveParams)
         logging.debug('Sent MDS Set Priority List Wave...')
 
         # Read in confirmation of changes
@@ -267,8 +292,26 @@ class PhilipsTelemetryStream(TelemetryStream):
                 no_confirmation = False
                 logging.warn('Failed to confirm priority list setting.')
 
+    # Sends an outbound request, encoding and framing it only the first time
+    def send_message(self, message_type, parameters=None):
+        """
+        Outbound requests are keyed by (message_type, frozen parameters) and
+        kept fully encoded and framed, so resending them on every reconnect
+        or keep alive is a single write
+        """
+        key = (message_type, freeze(parameters))
+
+        if key not in self.outbound:
+            if parameters is None:
+                message = self.decoder.writeData(message_type)
+            else:
+                message = self.decoder.writeData(message_type, parameters)
+            self.outbound[key] = bytes(self.rs232.frameCheckWrite(bytearray(message)))
+
+        self.rs232.sendFramed(self.outbound[key])
+
     def submit_keep_alive(self):
-        self.rs232.send(self.KeepAliveMessage)
+        self.send_message('MDSSinglePollAction')
         self.last_keep_alive = time.time()
         logging.debug('Sent Keep Alive Message...')
 
@@ -358,9 +401,9 @@ class PhilipsTelemetryStream(TelemetryStream):
             raise IOError
 
         # Send Association Abort and Release Request
-        self.rs232.send(self.AssociationAbort)
+        self.send_message('AssociationAbort')
         logging.debug('Sent Association Abort...')
-        self.rs232.send(self.ReleaseRequest)
+        self.send_message('ReleaseRequest')
         logging.debug('Sent Release Request...')
 
         not_refused = True
@@ -381,9 +424,9 @@ class PhilipsTelemetryStream(TelemetryStream):
             if message_type == 'ReleaseResponse' or message_type == 'AssociationAbort' or message_type == 'TimeoutError' or message_type == 'Unknown':
                 logging.debug('Connection with monitor released.')
             elif count % 12 == 0:
-                self.rs232.send(self.AssociationAbort)
+                self.send_message('AssociationAbort')
                 logging.debug('Re-sent Association Abort...')
-                self.rs232.send(self.ReleaseRequest)
+                self.send_message('ReleaseRequest')
                 logging.debug('Re-sent Release Request...')
 
             logging.debug('Trying to disconnect {0}'.format(count))
@@ -396,11 +439,11 @@ class PhilipsTelemetryStream(TelemetryStream):
         """
         Sends Extended Poll Requests for Numeric, Alarm, and Wave Data
         """
-        self.rs232.send(self.MDSExtendedPollActionNumeric)
+        self.send_message('MDSExtendedPollActionNUMERIC', self.dataCollection)
         logging.debug('Sent MDS Extended Poll Action for Numerics...')
-        self.rs232.send(self.MDSExtendedPollActionWave)
+        self.send_message('MDSExtendedPollActionWAVE', self.dataCollection)
         logging.debug('Sent MDS Extended Poll Action for Waves...')
-        self.rs232.send(self.MDSExtendedPollActionAlarm)
+        self.send_message('MDSExtendedPollActionALARM', self.dataCollection)
         logging.debug('Sent MDS Extended Poll Action for Alarms...')
 
     def single_poll(self):
@@ -442,11 +485,22 @@ class PhilipsTelemetryStream(TelemetryStream):
             logging.debug('Received (unhandled) \'SinglePollActionResult\' message type')
 
         elif message_type == 'MDSExtendedPollActionResult' or message_type == 'LinkedMDSExtendedPollActionResult':
-            decoded_message = self.decoder.readData(message)
-            m = self.distiller.refine(decoded_message)
-            if not m:
-                logging.warn('Failed to distill message: {0}'.format(decoded_message))
+            # Waves skip the message dict entirely, anything else is decoded and refined
+            waves = None
+            if self.fast_distill:
+                waves = self.decoder.readWaveObservations(message)
+
+            if waves is not None:
+                m = self.distiller.refine_wave_observations(*waves)
+                if not m:
+                    logging.warn('Failed to distill wave message: {0}'.format(waves))
             else:
+                decoded_message = self.decoder.readData(message)
+                m = self.distiller.refine(decoded_message)
+                if not m:
+                    logging.warn('Failed to distill message: {0}'.format(decoded_message))
+
+            if m:
                 self.last_read_time = time.time()
 
         else:
@@ -485,7 +539,8 @@ class PhilipsTelemetryStream(TelemetryStream):
                 'Non-invasive Blood Pressure': bp,
                 'Airway': airway,
                 'alarms': m.get('alarms'),
-                'timestamp': m.get('timestamp')}
+                'timestamp': m.get('timestamp'),
+                'relative_time': m.get('relative_time')}
 
         # TODO: Recursively go through ret and delete any None keys or {}...
 
@@ -536,13 +591,9 @@ class PhilipsTelemetryStream(TelemetryStream):
                 self.update_sampled_data(data)
 
                 # Call any update functions in the order they were added
-                if data:
-                    for f in self.update_funcs:
-                        new_data = f(sampled_data=self.sampled_data, **data)
-                        data.update(new_data)
+                self.run_update_funcs(data)
 
-                # TODO: This should be sent to the data logger
-                self.logger.info(data)
+                self.data_logger.info(data)
                 return data
             except IOError:
                 while 1:
@@ -583,7 +634,9 @@ if __name__ == '__main__':
 
     tstream = PhilipsTelemetryStream(port=opts.port,
                                      values=opts.values,
-                                     polling_interval=0.05)
+                                     polling_interval=0.05,
+                                     background_updates=opts.background_updates,
+                                     qos=opts.qos)
 
     # Attach any post-processing functions
     tstream.add_update_func(qos)
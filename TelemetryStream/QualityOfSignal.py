@@ -9,14 +9,236 @@ import numpy as np
 import scipy
 from scipy import signal
 import logging
-from matplotlib import pyplot as plt
+import time
 import scipy.io
 
 class QualityOfSignal():
     # just need to run isPPGGoodQuality(signal, timestamp, samplingFreq)
     # and it will output 1 or -1
-    def __init__(self):
-        pass
+    # Keep one instance around and call score(), filter designs and default
+    # parameters are only computed once
+    #
+    # mode is 'batch' (score() the whole window every read), 'streaming' (update()
+    # with only the new samples), or 'compare' (both, to check one against the other)
+    def __init__(self, fs=125, mode='batch', dur=7):
+        self.fs = fs
+        self.mode = mode
+        self.dur = dur
+        self.opt = self.makeDefaultPPGSignalQualityParameter()
+        self.algoParam = self.makeDefaultSig2MatrixParam()
+        # (order, ripple, attenuation, cutoff, type) -> (b, a)
+        self.filters = {}
+        # Seconds taken by the last score() or update()
+        self.last_eval_time = 0
+        self.resetStream()
+
+    def score(self, sig, fs=None):
+        """
+        Per-read entry point, sig is a window of Pleth (ie a SampledDataBuffer
+        view), returns 1, 0, or -1 like isPPGGoodQuality
+        """
+        tic = time.time()
+        qualityFlag = self.isPPGGoodQuality(sig, fs or self.fs, opt=self.opt)
+        self.last_eval_time = time.time() - tic
+        return qualityFlag
+
+    # Streaming mode: everything is kept in absolute sample numbers, counted from the
+    # first sample fed to update(), and only the last dur seconds are kept
+    def resetStream(self):
+        # Causal version of the zpIIR low pass in DetectPulseOnset, carried across updates
+        self.streamFilter = scipy.signal.ellip(3, .1, 20, 5 * 2/self.fs, output='sos')
+        self.streamZi = None
+        self.streamSize = int(self.fs*self.dur)
+        self.wSmp = int(np.round(self.opt['pulseWidth']*self.fs/1000))
+        self.blankWin = int(np.round(400*self.fs/1000))
+
+        # Samples fed so far, raw and filtered samples for the window end here
+        self.streamSeen = 0
+        self.streamRaw = np.zeros(0)
+        self.streamFiltered = np.zeros(0)
+
+        # Slope sum function, streamZ[0] is sample streamZStart
+        self.streamZ = np.zeros(0)
+        self.streamZStart = 0
+
+        # Onset search state, see DetectPulseOnset
+        self.streamOnsets = []
+        self.streamSearching = False
+        self.subStart, self.subStop = 0, 0
+
+        # (start, stop, beatLen) -> normalized beat, and the last beat matrix's flag
+        self.beatColumns = {}
+        self.lastBeats = None
+        self.streamFlag = 0
+
+    def update(self, values, total=None):
+        """
+        Streaming entry point, values are the Pleth samples that arrived since the
+        last call; total is the source's running sample count (ie
+        SampledDataBuffer.written), if it doesn't follow on from the last call the
+        stream starts over.  Returns 1, 0, or -1 for the last dur seconds.
+        """
+        tic = time.time()
+
+        values = np.asarray(values, dtype=float)
+        if total is not None and total - values.size != self.streamSeen:
+            self.resetStream()
+            self.streamSeen = total - values.size
+
+        if values.size:
+            self.filterNewSamples(values)
+            self.detectNewOnsets()
+            self.streamFlag = self.streamQuality()
+
+        self.last_eval_time = time.time() - tic
+        return self.streamFlag
+
+    def filterNewSamples(self, values):
+        # Filters the new samples and extends the slope sum function over them
+
+        if self.streamZi is None:
+            self.streamZi = scipy.signal.sosfilt_zi(self.streamFilter) * values[0]
+        filtered, self.streamZi = scipy.signal.sosfilt(self.streamFilter, values, zi=self.streamZi)
+
+        self.streamSeen += values.size
+        self.streamRaw = np.concatenate((self.streamRaw, values))[-self.streamSize:]
+        self.streamFiltered = np.concatenate((self.streamFiltered, filtered))[-self.streamSize:]
+        windowStart = self.streamSeen - self.streamFiltered.size
+
+        # z[j] sums the positive slopes from sample j to j+wSmp, so it needs the samples from
+        # the first new j on
+        zEnd = self.streamZStart + self.streamZ.size
+        first = max(zEnd, windowStart)
+        diffsig = np.diff(self.streamFiltered[first-windowStart:])
+
+        if diffsig.size >= self.wSmp:
+            rising = diffsig > 0
+            slopeSum = np.concatenate(([0], np.cumsum(np.where(rising, diffsig, 0))))
+            risingCount = np.concatenate(([0], np.cumsum(rising)))
+            z = slopeSum[self.wSmp:] - slopeSum[:-self.wSmp]
+            z[risingCount[self.wSmp:] == risingCount[:-self.wSmp]] = 0
+
+            if first != zEnd:
+                self.streamZ = np.zeros(0)
+                self.streamZStart = first
+            self.streamZ = np.concatenate((self.streamZ, z))
+
+        # Drop anything that has left the window
+        if self.streamZStart < windowStart:
+            self.streamZ = self.streamZ[windowStart-self.streamZStart:]
+            self.streamZStart = windowStart
+        self.streamOnsets = [a for a in self.streamOnsets if a >= windowStart]
+
+    def anchorThresholds(self):
+        # Starts the thresholds over from the current window, as DetectPulseOnset does
+
+        z = self.streamZ
+        MedianArrayWinSize = 5
+        self.z0 = np.mean(z)
+        self.zThres = 0
+        self.SSFAmpArray = np.ones((MedianArrayWinSize,1))*(np.max(z) - np.min(z)) * .2
+        self.SSFCrossThresholdArray = np.ones((MedianArrayWinSize,1))*self.z0*.2
+        self.onsetIdx = 1
+
+    def detectNewOnsets(self):
+        # Continues DetectPulseOnset's search over the new part of the slope sum function
+
+        z = self.streamZ
+        zStart, zEnd = self.streamZStart, self.streamZStart + self.streamZ.size
+        wSmp, blankWin = self.wSmp, self.blankWin
+        MedianArrayWinSize = 5
+
+        # Wait for a full window before setting the first thresholds
+        if not self.streamSearching:
+            if self.streamSeen < self.streamSize or z.size == 0:
+                return
+            self.anchorThresholds()
+            self.subStart, self.subStop = zStart, zStart + 4*blankWin + 1
+            self.streamSearching = True
+
+        while(1):
+
+            # look for the first location where z > z0
+            lo = max(self.subStart, zStart)
+            crossed = np.flatnonzero(z[lo-zStart:max(min(self.subStop, zEnd)-zStart, 0)] > self.z0)
+
+            if crossed.size == 0:
+                # Wait for the rest of the search window
+                if self.subStop > zEnd:
+                    return
+                # Nothing in a whole search window, start the thresholds over like a new
+                # batch run would and keep looking
+                self.anchorThresholds()
+                self.subStart, self.subStop = self.subStart + blankWin, self.subStop + blankWin
+                continue
+
+            ix = lo + crossed[0]
+            srcStart, srcStop = max(zStart, ix - wSmp), ix + wSmp
+            # Wait until the whole onset window has arrived
+            if srcStop > zEnd:
+                return
+
+            # remove the initial zero-region in the SSF function before looking for onset
+            zPnt = np.flatnonzero(z[srcStart-zStart:ix-zStart] == 0)
+            if zPnt.size != 0:
+                srcStart += zPnt[-1]
+
+            srcWin = z[srcStart-zStart:srcStop-zStart]
+            srcMax, srcMin = np.max(srcWin), np.min(srcWin)
+
+            # accept the window
+            if (srcMax - srcMin > self.zThres):
+
+                # calculate the threshold for next cycle
+                SSFAmp = (srcMax - srcMin) * .2
+                self.SSFAmpArray[np.remainder(self.onsetIdx, MedianArrayWinSize)] = SSFAmp
+                self.zThres = np.median(self.SSFAmpArray)
+                self.SSFCrossThresholdArray[np.remainder(self.onsetIdx, MedianArrayWinSize)] = np.mean(srcWin)*.2
+                self.z0 = np.median(self.SSFCrossThresholdArray)
+
+                # The onset is placed at the start of the source window, as in DetectPulseOnset
+                a = srcStart
+                self.streamOnsets.append(a)
+
+                # adaptively determine analysis window for next cycle
+                self.subStart, self.subStop = a + blankWin, a + 3*blankWin
+                self.onsetIdx += 1
+
+            else:
+                # no beat detected
+                self.subStart, self.subStop = self.subStart + blankWin, self.subStop + blankWin
+
+    def streamQuality(self):
+        # Scores the current window, only fitting beats that weren't in the last beat matrix
+
+        windowStart = self.streamSeen - self.streamRaw.size
+        if self.streamRaw.size < self.streamSize:
+            return 0
+
+        # Like DetectPulseOnset, the start of the window counts as an onset
+        onset = np.array([windowStart] + [a for a in self.streamOnsets if a > windowStart])
+        if len(onset) < 3:
+            return 0
+
+        idx, beatLen = self.selectBeats(onset, self.fs, self.algoParam)
+        if idx.size == 0:
+            return 0
+
+        beats = tuple((onset[i], onset[i+1], beatLen) for i in idx)
+        if beats == self.lastBeats:
+            return self.streamFlag
+
+        columns = {}
+        for beat in beats:
+            column = self.beatColumns.get(beat)
+            if column is None:
+                start, stop = beat[0] - windowStart, beat[1] - windowStart
+                column = self.beatColumn(self.streamRaw, start, stop, beatLen)
+            columns[beat] = column
+        self.beatColumns = columns
+        self.lastBeats = beats
+
+        return self.matrixQuality(np.column_stack([columns[beat] for beat in beats]), self.opt)
 
     def isPPGGoodQuality(self, ppgSig, fs, **kwargs):
 
@@ -29,27 +251,110 @@ class QualityOfSignal():
         # Derek -- this throws div0 error sometimes, appears to be unused?
         # dt = 1./np.diff(tsofSig)
 
-        onset = self.DetectPulseOnset(ppgSig, fs, opt['pulseWidth'])
+        sigMat = self.beatMatrix(ppgSig, fs, opt)
 
-        if (len(onset) < 3):
+        if sigMat is None:
             qualityFlag = 0
             return qualityFlag
 
+        return self.matrixQuality(sigMat, opt)
+
+    def beatMatrix(self, ppgSig, fs, opt):
+        # returns: the normalized beat matrix for a window, or None if there aren't enough beats
+
+        onset = self.DetectPulseOnset(ppgSig, fs, opt['pulseWidth'])
+
+        if (len(onset) < 3):
+            return None
+
         sigMat, idx = self.formSignalMatrix(ppgSig, onset, fs)
 
-        if len(sigMat) != 0:
+        if len(sigMat) == 0:
+            return None
 
-            try:
-                u, s, v = np.linalg.svd(sigMat)
-            except np.linalg.linalg.LinAlgError:
-                logging.warn("Single value decomposition failed! Returning indeterminate (0)")
-                return 0
+        return sigMat
 
-        else:
-            qualityFlag = 0
-            return qualityFlag
+    def matrixQuality(self, sigMat, opt):
+        # Quality flag for one beat matrix, only the singular values are needed
+
+        try:
+            s = np.linalg.svd(sigMat, compute_uv=False)
+        except np.linalg.LinAlgError:
+            logging.warn("Single value decomposition failed! Returning indeterminate (0)")
+            return 0
+
+        return self.alignmentQuality(s, opt)
 
-        ai = np.array([np.NaN, np.NaN, np.NaN])
+    def scoreMany(self, sigs, fs=None):
+        """
+        Scores several windows at once (ie one per bed in a multi-bed process,
+        or a chunk of an archived recording) with one stacked decomposition,
+        returns an int8 array of 1, 0, or -1 like isPPGGoodQuality
+        """
+        tic = time.time()
+
+        qualityFlags = np.zeros(len(sigs), dtype=np.int8)
+        sigMats = []
+        scored = []
+
+        for i, sig in enumerate(sigs):
+            sigMat = self.beatMatrix(sig, fs or self.fs, self.opt)
+            if sigMat is not None:
+                sigMats.append(sigMat)
+                scored.append(i)
+
+        if sigMats:
+            qualityFlags[scored] = self.stackedQuality(sigMats, self.opt)
+
+        self.last_eval_time = time.time() - tic
+        return qualityFlags
+
+    def stackedQuality(self, sigMats, opt):
+        # Quality flags for several beat matrices in one call.  The matrices are zero-padded
+        # to a common shape (which only adds zero singular values), and the singular values
+        # come from the eigenvalues of the stacked Gram matrices, which are only beats x beats
+
+        qualityFlags = np.zeros(len(sigMats), dtype=np.int8)
+
+        # A matrix with NaNs (ie a flat beat) can't be decomposed, let matrixQuality say so
+        finite = [i for i, sigMat in enumerate(sigMats) if np.all(np.isfinite(sigMat))]
+        for i in set(range(len(sigMats))) - set(finite):
+            qualityFlags[i] = self.matrixQuality(sigMats[i], opt)
+        if not finite:
+            return qualityFlags
+
+        rows = max(sigMats[i].shape[0] for i in finite)
+        cols = max(sigMats[i].shape[1] for i in finite)
+        stack = np.zeros((len(finite), rows, cols))
+        for n, i in enumerate(finite):
+            stack[n, :sigMats[i].shape[0], :sigMats[i].shape[1]] = sigMats[i]
+
+        try:
+            eigenvalues = np.linalg.eigvalsh(np.matmul(stack.transpose(0, 2, 1), stack))
+        except np.linalg.LinAlgError:
+            # One bad matrix fails the whole stack, fall back to one at a time
+            for i in finite:
+                qualityFlags[i] = self.matrixQuality(sigMats[i], opt)
+            return qualityFlags
+        s = np.sqrt(np.clip(eigenvalues[:, ::-1], 0, None))
+
+        # Same ratios as alignmentQuality, but only over each matrix's own singular values
+        rank = np.array([min(sigMats[i].shape) for i in finite])
+        ai = np.empty((len(finite), 3))
+        ai[:] = np.nan
+        for j in range(1, 4):
+            valid = rank > j
+            ai[valid, j-1] = s[valid, j-1]/s[valid, j]
+
+        good = (ai[:, 0] > opt['AI1Threshold']) | (ai[:, 1] > opt['AI2Threshold']) | (ai[:, 2] > opt['AI3Threshold'])
+        qualityFlags[finite] = np.where(good, 1, -1)
+
+        return qualityFlags
+
+    def alignmentQuality(self, s, opt):
+        # Quality flag from the singular values of the beat matrix, 1 if the beats line up
+
+        ai = np.array([np.nan, np.nan, np.nan])
         for j in range(1, np.minimum(4,len(s))):
             ai[j-1] = s[j-1]/s[j]
 
@@ -66,7 +371,7 @@ class QualityOfSignal():
         if 'algoParam' in kwargs:
             algoParam = kwargs.get('algoParam')
         else:
-            algoParam = self.makeDefaultSig2MatrixParam()
+            algoParam = self.algoParam
 
         if type(fiducialPnt) == list:
             fiducialPnt = np.array(fiducialPnt)
@@ -83,6 +388,21 @@ class QualityOfSignal():
             if sig.shape[1] > sig.shape[0]:
                 sig = sig.T
 
+        idx, beatLen = self.selectBeats(fiducialPnt, fs, algoParam)
+        if idx.size == 0:
+            sigMat = []
+            return sigMat, idx
+
+        sigMat = np.zeros((beatLen, len(idx)))
+
+        for i in range(0, len(idx)):
+            sigMat[:,i] = self.beatColumn(sig, fiducialPnt[idx[i]], fiducialPnt[idx[i]+1], beatLen)
+
+        return sigMat, idx
+
+    def selectBeats(self, fiducialPnt, fs, algoParam):
+        # Picks the beats to compare and the length to fit them to, returns (idx, beatLen)
+
         maxBeatLeninMS = 60/algoParam['minHR'] * 1000
         minBeatLeninMS = 60/algoParam['maxHR'] * 1000
 
@@ -94,45 +414,44 @@ class QualityOfSignal():
         idx_max = np.where(beatLeninMS < maxBeatLeninMS)[0]
         idx = np.intersect1d(idx_min, idx_max)
         if idx.size == 0:
-            sigMat = []
-            return sigMat, idx
+            return idx, None
 
         finalBeatLeninMS = np.percentile(beatLeninMS[idx], algoParam['prctile4BeatLength'])
         minimalBeatLeninMS = np.percentile(beatLeninMS[idx], algoParam['prctile4MinimalBeatLength'])
 
         # also remove pulses with a length less than minimal length
         idxx = np.where(beatLeninMS[idx] < minimalBeatLeninMS)
-        idx[idxx] = []
+        idx = np.delete(idx, idxx)
 
         beatLen = int(np.fix(finalBeatLeninMS * fs/1000))
-        sigMat = np.zeros((beatLen, len(idx)))
 
-        for i in range(0, len(idx)):
+        return idx, beatLen
 
-            lenofPulse = fiducialPnt[idx[i]+1] - fiducialPnt[idx[i]]
+    def beatColumn(self, sig, start, stop, beatLen):
+        # One beat, sig[start:stop], fit to beatLen samples and normalized
 
-            if lenofPulse >= beatLen:
-                sigMat[:,i] = sig[fiducialPnt[idx[i]]:fiducialPnt[idx[i]]+beatLen]
+        lenofPulse = stop - start
 
-            else:
-                deltaW = beatLen - lenofPulse
+        if lenofPulse >= beatLen:
+            column = sig[start:start+beatLen]
 
-                if deltaW < 3:
-                    samplesToFitData = 3
+        else:
+            deltaW = beatLen - lenofPulse
 
-                elif deltaW > 10:
-                    samplesToFitData = 10
+            if deltaW < 3:
+                samplesToFitData = 3
 
-                else:
-                    samplesToFitData = deltaW
+            elif deltaW > 10:
+                samplesToFitData = 10
 
-                vv = self.PolyReSample(sig[fiducialPnt[idx[i]+1] - samplesToFitData: fiducialPnt[idx[i]+1]], np.r_[0:samplesToFitData].T, np.r_[samplesToFitData:samplesToFitData+deltaW].T, 1)
-                sigMat[:,i] = np.hstack((sig[fiducialPnt[idx[i]]:fiducialPnt[idx[i]+1]], vv))
+            else:
+                samplesToFitData = deltaW
 
-            # remove mean and normalized by standard deviation
-            sigMat[:,i] = self.NormalizeSig(sigMat[:,i],2)
+            vv = self.PolyReSample(sig[stop - samplesToFitData: stop], np.r_[0:samplesToFitData].T, np.r_[samplesToFitData:samplesToFitData+deltaW].T, 1)
+            column = np.hstack((sig[start:stop], vv))
 
-        return sigMat, idx
+        # remove mean and normalized by standard deviation
+        return self.NormalizeSig(column, 2)
 
     def makeDefaultPPGSignalQualityParameter(self):
 
@@ -177,20 +496,25 @@ class QualityOfSignal():
         # delta x
         diffsig = np.diff(sig)
 
-        z = np.empty((sig.size - 1 - wSmp, 1))
-        z[:] = np.NaN
-
-        # calculate slope sum function
-        for i in range(wSmp,sig.size-1):
-            subsig = diffsig[i-wSmp:i]
-            z[i-wSmp] = np.sum(subsig[subsig>0])
+        # calculate slope sum function, the sum of the positive slopes over the last wSmp
+        # samples, as a difference of running sums (running counts of the positive slopes
+        # keep flat stretches exactly 0, the onset search looks for them)
+        rising = diffsig > 0
+        slopeSum = np.concatenate(([0], np.cumsum(np.where(rising, diffsig, 0))))
+        risingCount = np.concatenate(([0], np.cumsum(rising)))
+        zLen = max(diffsig.size - wSmp, 0)
+        z = slopeSum[wSmp:wSmp+zLen] - slopeSum[:zLen]
+        z[risingCount[wSmp:wSmp+zLen] == risingCount[:zLen]] = 0
+        # z stays a column vector, as the onset search has always seen it
+        z = z.reshape(-1, 1)
 
         z0 = np.mean(z)
         onset = [0]
         tPnt = []
         zThres = 0
         blankWin = int(np.round(400*fs/1000))
-        subIdx = np.r_[onset[0]: onset[0] + 4*blankWin + 1]
+        # search window is z[subStart:subStop]
+        subStart, subStop = onset[0], onset[0] + 4*blankWin + 1
         MedianArrayWinSize = 5
 
         # this value controls the final acceptance
@@ -205,52 +529,47 @@ class QualityOfSignal():
         while(1):
 
             # look for the first location where z > z0
-            try:
-
-                # Look in z[subIdx] (and make sure it doesn't go past z's size)
-                # find first index where z > the mean of z
-                tempIndex = np.trim_zeros(subIdx*(z.size>subIdx), 'b')
-                ix = np.amin(np.where(z[tempIndex] > z0)[0])
-            except:
+            # Look in the search window (and make sure it doesn't go past z's size)
+            crossed = np.flatnonzero(z[subStart:min(subStop, z.size)] > z0)
+            if crossed.size == 0:
                 break
 
-            ix = tempIndex[ix]
+            ix = subStart + crossed[0]
             tPnt.append(ix)
-            srcWin = np.r_[np.maximum(0,ix - wSmp): ix + wSmp]
+            srcStart, srcStop = max(0, ix - wSmp), ix + wSmp
             #if the window has passed the length of the data, then exit
-            if srcWin[-1] >= len(z):
+            if srcStop > len(z):
                 break
 
             # This section of code is to remove the initial zero-region in the SSF function before looking for onset (if such region exists)
-            zPnt = np.where(z[srcWin] == 0)
+            zPnt = np.flatnonzero(z[srcStart:ix] == 0)
+            if zPnt.size != 0:
+                srcStart += zPnt[-1]
 
-            if zPnt[0].size != 0:
-                zPnt = srcWin[zPnt[0]]
-
-                if np.any(zPnt < ix):
-                    srcWin = np.r_[zPnt[np.max(np.where(zPnt < ix))]: ix + wSmp]
+            srcWin = z[srcStart:srcStop]
+            srcMax, srcMin = np.max(srcWin), np.min(srcWin)
 
             # accept the window
-            if ( np.max(z[srcWin]) - np.min(z[srcWin]) > zThres):
+            if (srcMax - srcMin > zThres):
 
                 # calculate the threshold for next cycle
-                SSFAmp = (np.max(z[srcWin]) - np.min(z[srcWin])) * PrcofMaxAMP
+                SSFAmp = (srcMax - srcMin) * PrcofMaxAMP
                 SSFAmpArray[np.remainder(idx, MedianArrayWinSize)] = SSFAmp
                 zThres = np.median(SSFAmpArray)
-                SSFCrossThresholdArray[np.remainder(idx, MedianArrayWinSize)] = np.mean(z[srcWin])*DetectionThreshold
+                SSFCrossThresholdArray[np.remainder(idx, MedianArrayWinSize)] = np.mean(srcWin)*DetectionThreshold
                 z0 = np.median(SSFCrossThresholdArray)
-                minSSF = np.min(z[srcWin]) + SSFAmp *AmplitudeRatio
-                a = srcWin[0] + np.min(np.where(z[srcWin] >= minSSF))
+                minSSF = srcMin + SSFAmp *AmplitudeRatio
+                a = srcStart + np.min(np.where(srcWin >= minSSF))
                 onset.append(a)
 
                 # adaptively determine analysis window for next cycle
                 bw = blankWin
-                subIdx = np.round(np.r_[a + bw: a + 3*bw])
+                subStart, subStop = a + bw, a + 3*bw
                 idx = idx + 1
 
             else:
             # no beat detected
-                subIdx = np.round(subIdx + blankWin)
+                subStart, subStop = subStart + blankWin, subStop + blankWin
 
         return onset
 
@@ -282,14 +601,20 @@ class QualityOfSignal():
             blowpass = 1
 
         if blowpass == 1:
-            b, a = scipy.signal.ellip(p, rp, rs, wn)
+            btype = 'low'
 
         else:
             # This was "size", but probably should be len
             if len(wn) > 1:
-                b, a = scipy.signal.ellip(p, rp, rs, wn, 'stop')
+                btype = 'stop'
             else:
-                b, a = scipy.signal.ellip(p, rp, rs, wn, 'high')
+                btype = 'high'
+
+        # Design each filter once
+        key = (p, rp, rs, tuple(np.atleast_1d(wn)), btype)
+        if key not in self.filters:
+            self.filters[key] = scipy.signal.ellip(p, rp, rs, wn, btype)
+        b, a = self.filters[key]
 
         osig = scipy.signal.filtfilt(b, a, sig)
 
@@ -320,6 +645,7 @@ class QualityOfSignal():
         return newy
 
 if __name__ == '__main__':
+    from matplotlib import pyplot as plt
     logging.basicConfig(level=logging.DEBUG)
 
     # Importing test data from csv files
@@ -1,7 +1,7 @@
 # Outline for a telemetry stream library and wrapper functions with structured event
 # logging to text files and to Splunk
 #
-# Dependencies: PyYAML, splunk-sdk, matplotlib, pyserial, numpy
+# Dependencies: PyYAML, splunk-sdk, matplotlib, pyserial, numpy, orjson (optional)
 #
 # Merck, Spring 2016
 
@@ -21,6 +21,22 @@ import yaml
 import numpy as np
 import subprocess
 import collections
+import threading
+import copy
+import ssl
+import base64
+
+try:
+    import httplib
+    import urlparse
+except ImportError:
+    import http.client as httplib
+    import urllib.parse as urlparse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 __hash__ = None
 try:
@@ -28,13 +44,14 @@ try:
 except:
     __hash__ = 'unknown'
 
+from WaveformLog import BinaryLogHandler, epoch
+
 try:
     from SimpleStripchart import Stripchart
 except ImportError:
     logging.error('Cannot import Stripchart, check Matplotlib')
 
 # @derek
-# TODO: Split out data logger and status loggers
 # TODO: Split into multiple threads -- is this really going to make a difference?
 
 __description__ = "Monitor decoder for PERSEUS (Push Electronic Relay for Smart Alarms for End User Situational Awareness)"
@@ -90,58 +107,356 @@ class TelemetryGUI(object):
 
 
 class SampledDataBuffer(object):
-    # This is a fixed-length double queue for time/value pairs s.t. f(t)=y
+    # This is a fixed-length ring buffer for time/value pairs s.t. f(t)=y
     # Once initialized, it can be updated with a single time point and a set of values
     # taken at a given frequency.
-    # t is re-evaluated relative to the initialization time
+    # t is re-evaluated relative to the first packet
+    #
+    # Every sample is written twice, at i and i+size, so the most recent window is always
+    # the contiguous slice [cursor:cursor+size].  Readers (GUI, QoS, ...) get read-only
+    # views of that slice, so appending never reallocates and reading never copies.
+    #
+    # Times are kept as monitor RelativeTime ticks (1/8000 s, int64) for the first sample of
+    # each packet; sample times are only computed when t is read.  A packet that starts more
+    # than half a packet away from where the last one ended is recorded as a gap or an overlap.
+
+    TICKS = 8000
 
     def __init__(self, freq, dur):
         self.freq = freq
         self.dur = dur
-        self.y = np.zeros(self.freq*self.dur)
-        self.t = np.zeros(self.freq*self.dur)
+        self.size = self.freq*self.dur
+        self.period = self.TICKS/self.freq
+        self._y = np.zeros(2*self.size)
+        # Index of the oldest sample
+        self.cursor = 0
+        # Total samples appended, readers can compare against this to tell what's new
+        self.written = 0
         self.start_time = datetime.datetime.now()
+        # Tick of the first sample, t is measured from here
         self.t1 = None
+        # (first tick, sample index, count) for each packet still in the window
+        self.segments = collections.deque()
+        # (sample index, samples) for gaps (> 0) and overlaps (< 0) still in the window
+        self.discontinuities = collections.deque()
         self.dropped_packets = 0
+        self.gap_samples = 0
+        self.overlaps = 0
+        self.overlap_samples = 0
+
+    @property
+    def y(self):
+        return self.values()
+
+    @property
+    def t(self):
+        return self.view()[0]
+
+    def view(self):
+        # returns: (t, y) for the whole window, oldest first
+        return self.latest(self.size)
+
+    def latest(self, n):
+        # returns: (t, y) for the last n samples, oldest first; y is a read-only view,
+        # t is seconds since the first packet (0 for samples never written)
+        n = min(n, self.size)
+        return self.times(n), self.values(n)
+
+    def values(self, n=None):
+        # returns: read-only view of the last n (default all) values, oldest first
+        n = self.size if n is None else min(n, self.size)
+        end = self.cursor + self.size
+        y = self._y[end-n:end]
+        y.flags.writeable = False
+        return y
+
+    def times(self, n):
+        # returns: seconds since the first packet for the last n samples
+        t = np.zeros(n)
+        first = self.written - n
+        for tick, index, count in self.segments:
+            a = max(index, first)
+            b = index + count
+            if b <= a:
+                continue
+            t[a-first:b-first] = (tick - self.t1 + (np.arange(a, b) - index)*self.period)/self.TICKS
+        return t
+
+    def real_samples(self):
+        # returns: number of samples in the window that came from the monitor
+        return min(self.written, self.size)
+
+    def missing_samples(self):
+        # returns: number of samples lost to gaps inside the window
+        first = self.written - self.size
+        return sum(samples for index, samples in self.discontinuities if index > first and samples > 0)
+
+    def coverage(self):
+        # returns: fraction of the time spanned by the window that is real data
+        real = self.real_samples()
+        if not real:
+            return 0.0
+        return real/(real + self.missing_samples())
+
+    def snapshot(self):
+        # returns: a copy that later appends won't touch, for readers on other threads
+        other = copy.copy(self)
+        other._y = self._y.copy()
+        other.segments = collections.deque(self.segments)
+        other.discontinuities = collections.deque(self.discontinuities)
+        return other
+
+    def _write(self, buf, values, length):
+        # Writes values at the cursor and mirrors them into the other half of buf
+        start = self.cursor
+        end = start + length
+        buf[start:end] = values
+        if end <= self.size:
+            buf[start+self.size:end+self.size] = values
+        else:
+            k = self.size - start
+            buf[start+self.size:] = values[:k]
+            buf[:end-self.size] = values[k:]
+
+    def _check_continuity(self, tick):
+        # Compares a packet's first tick with the end of the last packet
+        if not self.segments:
+            return
 
-        # self.t = np.linspace(now-self.dur, now-1, self.freq*self.dur)
+        last_tick, index, count = self.segments[-1]
+        # Whole samples between where this packet starts and where it was expected
+        samples = int(round((tick - last_tick)/self.period)) - count
 
-    def rolling_append(self, _t0, values):
+        # Clock jitter and a slightly-off nominal freq are not discontinuities, a lost or
+        # repeated packet is
+        if abs(samples) <= count//2:
+            return
+
+        if samples > 0:
+            self.dropped_packets += 1
+            self.gap_samples += samples
+            self.discontinuities.append((self.written, samples))
+        elif samples < 0:
+            self.overlaps += 1
+            self.overlap_samples -= samples
+            self.discontinuities.append((self.written, samples))
+
+    def rolling_append(self, _t0, values, relative_time=None):
 
         if values is None:
             return
 
-        # Convert t0 to seconds since start_time
-        t0 = (_t0 - self.start_time).total_seconds()
-        if not self.t1:
-            self.t1 = t0
-        # logging.debug('t0 {0}'.format(t0))
-        # logging.debug('t1 {0}'.format(self.t1))
+        # Monitor ticks when given, otherwise ticks since start_time
+        if relative_time is None:
+            tick = int(round((_t0 - self.start_time).total_seconds()*self.TICKS))
+        else:
+            tick = int(relative_time)
+            # RelativeTime is a uint32, unwrap it after ~6 days
+            if self.segments:
+                last_tick = self.segments[-1][0]
+                tick += (last_tick - tick + 2**31) // 2**32 * 2**32
 
-        t0 -= self.t1
+        if self.t1 is None:
+            self.t1 = tick
 
         length = values.size or 1  # For scalar
-        # logging.debug('len {0}'.format(length))
-        if length == 1:
-            times = t0
-        else:
-            sec_offset = length/self.freq
-            times = np.linspace(t0, t0+sec_offset, length)
 
-        # TODO: Fix this if it's important; it needs to fix itself so it does't get into a loop
-        # if t0 - self.t[-1] > 0:
-        #     self.dropped_packets += 1
-        #     logging.warn('>{0} dropped packets (t0={t0} != t[-1]={t1})'.format(self.dropped_packets, t0=t0, t1=self.t[-1]))
-        #     # Everytime this happens, it increases the total duration; if it's consistent, it
-        #     # will be a multiplier on the duration.
+        self._check_continuity(tick)
 
-        self.y = np.roll(self.y, -length)
-        self.y[-length:] = values
-        self.t = np.roll(self.t, -length)
-        self.t[-length:] = times
+        # Anything older than the window would be overwritten anyway
+        if length > self.size:
+            values = values[-self.size:]
+            self.segments.append((tick, self.written, length))
+            self.written += length - self.size
+            length = self.size
+        else:
+            self.segments.append((tick, self.written, length))
+
+        self._write(self._y, values, length)
+        self.cursor = (self.cursor + length) % self.size
+        self.written += length
+
+        # Forget packets and discontinuities that have left the window
+        first = self.written - self.size
+        while self.segments[0][1] + self.segments[0][2] <= first:
+            self.segments.popleft()
+        while self.discontinuities and self.discontinuities[0][0] <= first:
+            self.discontinuities.popleft()
+
+
+class UpdateWorker(object):
+    # Runs a stream's update functions on a background thread, so the reader never waits on
+    # analytics like QoS.  Jobs are (sampled_data snapshot, data) pairs; if the worker falls
+    # behind, the oldest pending job is dropped.  Whatever the functions returned is picked
+    # up with results() and goes out with the next record.
+
+    def __init__(self, funcs, max_pending=2, kwargs=None):
+        self.funcs = funcs
+        self.kwargs = kwargs or {}
+        self.pending = collections.deque(maxlen=max_pending)
+        self.done = {}
+        self.dropped = 0
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self.work, name='UpdateWorker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, sampled_data, data):
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+                logging.debug('Update worker behind, dropped {0} jobs'.format(self.dropped))
+            self.pending.append((sampled_data, data))
+            self.lock.notify()
+
+    def results(self):
+        with self.lock:
+            ret, self.done = self.done, {}
+        return ret
+
+    def work(self):
+        while 1:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                sampled_data, data = self.pending.popleft()
+
+            ret = {}
+            for f in self.funcs:
+                try:
+                    new_data = f(sampled_data=sampled_data, **dict(self.kwargs, **data))
+                except Exception:
+                    logging.exception('Update function {0} failed'.format(f))
+                    continue
+                data.update(new_data)
+                ret.update(new_data)
+
+            with self.lock:
+                self.done.update(ret)
+
+
+class DataLogQueue(logging.Handler):
+    # Takes data records off the reader thread.  emit() only appends the record to a bounded
+    # queue; a sink thread hands each record to the sink handlers (file, Splunk, binary), so
+    # serialization and network I/O never hold up the serial port.  If the sinks fall behind,
+    # the oldest pending record is dropped and counted.
+
+    def __init__(self, sinks=None, max_pending=1000, report_interval=60, name='DataLogQueue'):
+        super(DataLogQueue, self).__init__()
+        self.set_name(name)
+        self.sinks = list(sinks or [])
+        self.pending = collections.deque(maxlen=max_pending)
+        self.enqueued = 0
+        self.dropped = 0
+        self.max_depth = 0
+        # {sink name: [records, total secs, max secs]}, time spent in each sink
+        self.latency = {}
+        # Secs from the reader logging a record to the sink thread picking it up
+        self.wait = [0, 0.0, 0.0]
+        self.busy = False
+        self.report_interval = report_interval
+        self.last_report = time.time()
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self.work, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def sink_name(sink):
+        return sink.name or type(sink).__name__
+
+    def add_sink(self, sink):
+        with self.lock:
+            self.sinks.append(sink)
+
+    def emit(self, record):
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(record)
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self.pending))
+            self.lock.notify()
+
+    def work(self):
+        while 1:
+            with self.lock:
+                while not self.pending:
+                    self.busy = False
+                    self.lock.notify_all()
+                    self.lock.wait()
+                record = self.pending.popleft()
+                self.busy = True
+                sinks = list(self.sinks)
+
+            tic = time.time()
+            waited = tic - record.created
+            times = []
+            for sink in sinks:
+                try:
+                    sink.handle(record)
+                except Exception:
+                    logging.exception('Data log sink {0} failed'.format(self.sink_name(sink)))
+                toc = time.time()
+                times.append((self.sink_name(sink), toc - tic))
+                tic = toc
+
+            # stats() reads these from other threads
+            with self.lock:
+                self.tally(self.wait, waited)
+                for name, secs in times:
+                    self.tally(self.latency.setdefault(name, [0, 0.0, 0.0]), secs)
+
+            if self.report_interval and tic >= self.last_report + self.report_interval:
+                self.last_report = tic
+                self.report()
+
+    @staticmethod
+    def tally(stats, secs):
+        stats[0] += 1
+        stats[1] += secs
+        stats[2] = max(stats[2], secs)
+
+    def stats(self):
+        # returns: queue depth, drop counts, and mean/max latency (ms) for the queue and each sink
+        def summary(stats):
+            count, total, worst = stats
+            return {'records': count,
+                    'mean_ms': 1000*total/count if count else 0,
+                    'max_ms': 1000*worst}
+
+        with self.lock:
+            return {'depth': len(self.pending),
+                    'max_depth': self.max_depth,
+                    'capacity': self.pending.maxlen,
+                    'enqueued': self.enqueued,
+                    'dropped': self.dropped,
+                    'wait': summary(self.wait),
+                    'sinks': dict((name, summary(stats)) for name, stats in self.latency.items())}
+
+    def report(self):
+        stats = self.stats()
+        sinks = ', '.join('{0} {1:.2f}/{2:.2f}ms'.format(name, value['mean_ms'], value['max_ms'])
+                          for name, value in sorted(stats['sinks'].items()))
+        logging.debug('{0}: depth {1} (max {2}/{3}), dropped {4} of {5}, wait {6:.2f}/{7:.2f}ms, '
+                      'sinks (mean/max) {8}'.format(self.name, stats['depth'], stats['max_depth'], stats['capacity'],
+                                                   stats['dropped'], stats['enqueued'], stats['wait']['mean_ms'],
+                                                   stats['wait']['max_ms'], sinks))
+
+    def flush(self, timeout=5.0):
+        # Wait (up to timeout secs) for the sink thread to catch up, then flush the sinks
+        end = time.time() + timeout
+        with self.lock:
+            while (self.pending or self.busy) and time.time() < end:
+                self.lock.wait(end - time.time())
+        for sink in self.sinks:
+            sink.flush()
 
-        # logging.debug(self.y)
-        # logging.debug(self.t)
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+        super(DataLogQueue, self).close()
 
 
 class TelemetryStream(object):
@@ -152,8 +467,16 @@ class TelemetryStream(object):
         # Setup a specialized output logger
         self.logger = logging.getLogger()
         # self.logger.setLevel(logging.WARN)
+        # Data records go to their own logger, which attach_loggers points at a DataLogQueue
+        self.data_logger = logging.getLogger('PERSEUS.data')
         # Do anything else that would be generic across all monitor readers here
         self.update_funcs = []
+        # Stream settings passed to every update func along with the record, ie qos_mode
+        self.update_kwargs = {}
+        # Run update funcs on a background thread with at most this many snapshots waiting
+        self.background_updates = kwargs.get('background_updates', False)
+        self.max_pending_updates = kwargs.get('max_pending_updates', 2)
+        self.update_worker = None
         self.polling_interval = kwargs.get('polling_interval', 0.25)
         self.sampled_data_dur = kwargs.get('sampled_data_dur', 7)
         self.sampled_data = {}
@@ -177,7 +500,7 @@ class TelemetryStream(object):
             if key in self.sampled_data.keys():
                 t = data['timestamp']
                 y = data[key]
-                self.sampled_data[key]['samples'].rolling_append(t,y)
+                self.sampled_data[key]['samples'].rolling_append(t, y, data.get('relative_time'))
 
     def __del__(self):
         # Note that logging may no longer exist by here
@@ -187,6 +510,28 @@ class TelemetryStream(object):
     def add_update_func(self, f):
         self.update_funcs.append(f)
 
+    def run_update_funcs(self, data):
+        # Call any update functions in the order they were added, or hand them a snapshot on
+        # the background thread and add in whatever it finished since the last record
+        if not data:
+            return
+
+        if not self.background_updates:
+            for f in self.update_funcs:
+                new_data = f(sampled_data=self.sampled_data, **dict(self.update_kwargs, **data))
+                data.update(new_data)
+            return
+
+        if not self.update_worker:
+            self.update_worker = UpdateWorker(self.update_funcs, self.max_pending_updates, self.update_kwargs)
+
+        snapshot = {}
+        for key, value in self.sampled_data.items():
+            snapshot[key] = {'freq': value['freq'], 'samples': value['samples'].snapshot()}
+
+        self.update_worker.submit(snapshot, dict(data))
+        data.update(self.update_worker.results())
+
     def run(self, blocking=False):
         # Create a main loop that just echoes the results to the loggers
         self.open()
@@ -201,41 +546,104 @@ class TelemetryStream(object):
         raise NotImplementedError
 
     def read(self, *args, **kwargs):
-        # Read should echo data to self.logger at "info" level
+        # Read should echo data to self.data_logger at "info" level
         raise NotImplementedError
 
 
-class TelemetryEncoder(json.JSONEncoder):
-    def default(self, o):
-        # Deal with datetime
+class RecordSerializer(object):
+    # The one serialization stage for data records.  Each record is encoded once per variant
+    # (with or without waves, monitor or host time) and the bytes are cached on the record,
+    # so every sink on the DataLogQueue shares them.  Timestamps are formatted before
+    # encoding and waves are written as lists or, in 'base64' mode, as
+    # {"dtype", "base64"} objects; orjson is used if it is available.
+
+    def __init__(self, wave_format='list'):
+        self.wave_format = wave_format
+        self.encoded = 0
+        self.shared = 0
+
+    @staticmethod
+    def default(o):
+        # Anything the prepared record still holds that the encoder can't
         if isinstance(o, datetime.datetime):
             return o.isoformat()
-        # Deal with numpy
-        if type(o).__module__ == np.__name__:
+        if isinstance(o, (np.ndarray, np.generic)):
             return o.tolist()
-        return json.JSONEncoder.default(self, o)
+        raise TypeError('{0!r} is not JSON serializable'.format(o))
+
+    def format_value(self, value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        if isinstance(value, np.ndarray):
+            if self.wave_format == 'base64':
+                return {'dtype': value.dtype.str,
+                        'base64': base64.b64encode(value.tobytes()).decode('ascii')}
+            # orjson writes native, contiguous arrays itself (and misreads byte-swapped ones)
+            if orjson and value.dtype.isnative and value.flags.c_contiguous:
+                return value
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, dict):
+            return dict((key, self.format_value(item)) for key, item in value.items())
+        return value
+
+    def prepare(self, record, waves=True, host_time=False):
+        # returns: a copy of record.msg ready to encode, with the timestamp sorted up to the front
+        # for legibility/indexing.  Host time is when the record was logged, not when a sink
+        # thread gets to it, so every sink stamps the same time.
+        msg = record.msg
+        ret = collections.OrderedDict()
+        ret['timestamp'] = self.format_value(datetime.datetime.fromtimestamp(record.created) if host_time
+                                             else msg.get('timestamp'))
+        for key, value in msg.items():
+            if key == 'timestamp' or (not waves and isinstance(value, np.ndarray)):
+                continue
+            ret[key] = self.format_value(value)
+        return ret
+
+    def dumps(self, msg):
+        # returns: JSON bytes
+        if orjson:
+            return orjson.dumps(msg, default=self.default,
+                                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        return json.dumps(msg, default=self.default, separators=(',', ':')).encode('ascii')
+
+    def encode(self, record, waves=True, host_time=False):
+        # returns: JSON bytes for a data record, shared with any other sink asking for the same variant
+        key = (waves, host_time, self.wave_format)
+        cache = record.__dict__.setdefault('encoded', {})
+        if key in cache:
+            self.shared += 1
+        else:
+            cache[key] = self.dumps(self.prepare(record, waves, host_time))
+            self.encoded += 1
+        return cache[key]
+
+
+serializer = RecordSerializer()
 
 
 class JSONLogHandler(logging.handlers.TimedRotatingFileHandler):
 #class JSONLogHandler(logging.FileHandler):
 
     def __init__(self, *args, **kwargs):
+        self.show_host_time = kwargs.pop('host_time', False)
+        # False if waves go to a BinaryLogHandler instead
+        self.waves = kwargs.pop('waves', True)
         super(JSONLogHandler, self).__init__(*args, **kwargs)
-        self.show_host_time = kwargs.get('host_time', False)
 
     def emit(self, record):
-        # Submit an event over HTTP
-        # logging.debug("Emitting: {0}".format(record.msg))
-        if not record.msg: return
+        # Write the record's shared JSON encoding as a line
+        if not isinstance(record.msg, dict): return
         if record.levelno != logging.INFO: return
-        if self.show_host_time:
-            record.msg['timestamp'] = datetime.datetime.now()
-        # Sorts the timestamp up to the front for legibility/indexing
-        msg = collections.OrderedDict([('timestamp', record.msg['timestamp'])])
-        msg.update(record.msg)
-        msgs = json.dumps(msg, cls=TelemetryEncoder, ensure_ascii=False).encode('ascii', errors='ignore')
-        record.msg = msgs
-        super(JSONLogHandler, self).emit(record)
+        msgs = serializer.encode(record, self.waves, self.show_host_time).decode('utf-8')
+        # Leave the record as it was for any other handlers
+        data, record.msg = record.msg, msgs
+        try:
+            super(JSONLogHandler, self).emit(record)
+        finally:
+            record.msg = data
 
 
 class SplunkLogHandler(logging.Handler):
@@ -247,6 +655,8 @@ class SplunkLogHandler(logging.Handler):
     def __init__(self, index_name=None, sourcetype='_json', **kwargs):
         super(SplunkLogHandler, self).__init__()
         self.show_host_time = kwargs.get('host_time', False)
+        # False if waves go to a BinaryLogHandler instead
+        self.waves = kwargs.get('waves', True)
 
         # Create a Service instance and log in
         self.service = SplunkClient.connect(
@@ -267,16 +677,301 @@ class SplunkLogHandler(logging.Handler):
     def emit(self, record):
         # Submit an event over HTTP
         # logging.debug("Emitting: {0}".format(record.msg))
-        if not record.msg: return
+        if not isinstance(record.msg, dict): return
         if record.levelno != logging.INFO: return
-        if self.show_host_time:
-            record.msg['timestamp'] = datetime.datetime.now
-        # Sorts the timestamp up to the front for legibility/indexing
-        msg = collections.OrderedDict([('timestamp', record.msg['timestamp'])])
-        msg.update(record.msg)
-        msgs = json.dumps(msg, cls=TelemetryEncoder, ensure_ascii=False).encode('ascii', errors='ignore')
+        msgs = serializer.encode(record, self.waves, self.show_host_time)
         self.index.submit(msgs, sourcetype=self.sourcetype, host=SplunkLogHandler.host)
 
+class HECLogHandler(logging.Handler):
+    # Sends events to a Splunk HTTP Event Collector in batches, rather than a request per
+    # record.  A batch of newline-delimited events goes out once it reaches batch_size bytes
+    # or is flush_interval secs old, over one keep-alive connection.  Failed sends are retried
+    # with exponential backoff; while the server is unreachable, batches are spilled to a
+    # journal file, which is replayed (oldest first) once a send gets through again.
+
+    host = socket.gethostname()
+    default_path = '/services/collector/event'
+
+    def __init__(self, url, token, index=None, sourcetype='_json', journal='splunk.journal',
+                 batch_size=256*1024, flush_interval=1.0, retries=3, backoff=0.5, max_backoff=60,
+                 timeout=5.0, verify=True, **kwargs):
+        super(HECLogHandler, self).__init__()
+        self.show_host_time = kwargs.get('host_time', False)
+        # False if waves go to a BinaryLogHandler instead
+        self.waves = kwargs.get('waves', True)
+
+        url = urlparse.urlsplit(url)
+        self.netloc = url.netloc
+        self.path = url.path if url.path not in ('', '/') else self.default_path
+        if url.scheme == 'https':
+            context = None if verify else ssl._create_unverified_context()
+            self.connect = lambda: httplib.HTTPSConnection(self.netloc, timeout=timeout, context=context)
+        else:
+            self.connect = lambda: httplib.HTTPConnection(self.netloc, timeout=timeout)
+        self.headers = {'Authorization': 'Splunk {0}'.format(token),
+                        'Content-Type': 'application/json',
+                        'Connection': 'keep-alive'}
+        self.connection = None
+
+        self.index = index
+        self.sourcetype = sourcetype
+        # The fields every event shares, up to its time
+        head = collections.OrderedDict([('host', HECLogHandler.host), ('sourcetype', sourcetype)])
+        if index:
+            head['index'] = index
+        self.event_head = json.dumps(head).encode('ascii')[:-1] + b',"time":'
+        self.journal = journal
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.batch = []
+        self.batch_bytes = 0
+        self.batch_started = None
+        # Consecutive failed sends; no sends are tried before retry_at, batches go to the journal
+        self.failures = 0
+        self.retry_at = 0
+        self.sent = 0
+        self.spilled = 0
+        self.replayed = 0
+
+        # Sends batches that are due when records stop coming in
+        self.closed = False
+        self.timer = threading.Thread(target=self.tick, name='HECLogHandler')
+        self.timer.daemon = True
+        self.timer.start()
+
+    def event(self, record):
+        # returns: one HEC event, as a line of JSON around the record's shared encoding
+        ts = record.msg.get('timestamp')
+        if self.show_host_time or not isinstance(ts, datetime.datetime):
+            t = record.created
+        else:
+            t = epoch(ts)
+        return b''.join([self.event_head, '{0:.6f}'.format(t).encode('ascii'), b',"event":',
+                         serializer.encode(record, self.waves, self.show_host_time), b'}'])
+
+    def emit(self, record):
+        if not isinstance(record.msg, dict): return
+        if record.levelno != logging.INFO: return
+        try:
+            line = self.event(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.batch.append(line)
+        self.batch_bytes += len(line) + 1
+        if self.batch_started is None:
+            self.batch_started = time.time()
+        if self.batch_bytes >= self.batch_size or time.time() >= self.batch_started + self.flush_interval:
+            self.send_batch()
+
+    def tick(self):
+        while not self.closed:
+            time.sleep(self.flush_interval/2)
+            self.acquire()
+            try:
+                if self.batch and time.time() >= self.batch_started + self.flush_interval:
+                    self.send_batch()
+            finally:
+                self.release()
+
+    def send_batch(self):
+        payload = b'\n'.join(self.batch) + b'\n'
+        count = len(self.batch)
+        self.batch = []
+        self.batch_bytes = 0
+        self.batch_started = None
+
+        if time.time() >= self.retry_at and self.replay() and self.post(payload):
+            self.sent += count
+        else:
+            self.spill(payload, count)
+
+    def post(self, payload):
+        # returns: True if the collector took the payload, after up to retries attempts
+        for attempt in range(self.retries):
+            if attempt:
+                time.sleep(self.backoff*2**(attempt-1))
+            try:
+                if not self.connection:
+                    self.connection = self.connect()
+                self.connection.request('POST', self.path, payload, self.headers)
+                response = self.connection.getresponse()
+                body = response.read()
+            except (IOError, httplib.HTTPException) as e:
+                logging.warn('Splunk HEC send failed: {0}'.format(e))
+                self.close_connection()
+                continue
+
+            if response.status == 200:
+                self.failures = 0
+                self.retry_at = 0
+                return True
+
+            logging.warn('Splunk HEC returned {0}: {1}'.format(response.status, body[:200]))
+            if (response.getheader('Connection') or '').lower() == 'close':
+                self.close_connection()
+            if response.status < 500 and response.status != 429:
+                # Bad token, index, etc. won't get better by retrying now
+                break
+
+        self.failures += 1
+        self.retry_at = time.time() + min(self.backoff*2**self.failures, self.max_backoff)
+        return False
+
+    def spill(self, payload, count):
+        with open(self.journal, 'ab') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        self.spilled += count
+        logging.debug('Splunk HEC unavailable, journaled {0} events ({1} total)'.format(count, self.spilled))
+
+    def replay(self):
+        # Sends journaled events, oldest first, in batch_size payloads
+        # returns: False if any are still waiting
+        if not os.path.exists(self.journal) or not os.path.getsize(self.journal):
+            return True
+
+        with open(self.journal, 'rb') as f:
+            lines = f.read().splitlines()
+
+        replayed = 0
+        while lines:
+            size = 0
+            count = 0
+            while count < len(lines) and (not count or size + len(lines[count]) < self.batch_size):
+                size += len(lines[count]) + 1
+                count += 1
+            if not self.post(b'\n'.join(lines[:count]) + b'\n'):
+                with open(self.journal, 'wb') as f:
+                    f.write(b'\n'.join(lines) + b'\n')
+                return False
+            lines = lines[count:]
+            replayed += count
+
+        os.remove(self.journal)
+        self.replayed += replayed
+        logging.info('Splunk HEC back up, replayed {0} journaled events'.format(replayed))
+        return True
+
+    def stats(self):
+        # returns: event counts, and whether the server is currently being skipped
+        return {'sent': self.sent,
+                'spilled': self.spilled,
+                'replayed': self.replayed,
+                'batched': len(self.batch),
+                'failures': self.failures,
+                'backing_off': time.time() < self.retry_at}
+
+    def close_connection(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.batch:
+                self.send_batch()
+        finally:
+            self.release()
+
+    def close(self):
+        self.closed = True
+        self.flush()
+        self.close_connection()
+        super(HECLogHandler, self).close()
+
+
+class DispatchLogHandler(logging.Handler):
+    # Pushes numerics and alarms (no waves) to a PERSEUS Dispatch ingest socket as they are
+    # read, one {"host", "event"} line per record, so alerts don't wait for a polling cycle.
+    # Records are dropped, and counted, while Dispatch can't be reached; the event logs keep
+    # them for back-testing.  Connecting is held to connect_timeout, as it runs on the data log
+    # queue's one sink thread; timeout bounds each send.
+
+    host = socket.gethostname()
+
+    def __init__(self, address, host=None, timeout=5.0, connect_timeout=0.25, backoff=1.0, max_backoff=30,
+                 **kwargs):
+        super(DispatchLogHandler, self).__init__()
+        self.show_host_time = kwargs.get('host_time', False)
+        if not isinstance(address, tuple):
+            address = address.rsplit(':', 1)
+            address = (address[0], int(address[1]))
+        self.address = address
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.head = b'{"host":' + json.dumps(host or DispatchLogHandler.host).encode('ascii') + b',"event":'
+
+        self.sock = None
+        self.failures = 0
+        self.retry_at = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def connect(self):
+        # returns: True if connected, trying no more often than the backoff allows
+        if self.sock:
+            return True
+        if time.time() < self.retry_at:
+            return False
+        try:
+            self.sock = socket.create_connection(self.address, timeout=self.connect_timeout)
+            self.sock.settimeout(self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.failures:
+                logging.info('Reconnected to Dispatch at {0}:{1}'.format(*self.address))
+            self.failures = 0
+            return True
+        except (IOError, socket.error) as e:
+            self.failures += 1
+            self.retry_at = time.time() + min(self.backoff*2**(self.failures-1), self.max_backoff)
+            logging.warn('Dispatch unavailable at {0}:{1}: {2}'.format(self.address[0], self.address[1], e))
+            return False
+
+    def emit(self, record):
+        if not isinstance(record.msg, dict): return
+        if record.levelno != logging.INFO: return
+        try:
+            line = b''.join([self.head, serializer.encode(record, False, self.show_host_time), b'}\n'])
+        except Exception:
+            self.handleError(record)
+            return
+        if not self.connect():
+            self.dropped += 1
+            return
+        try:
+            self.sock.sendall(line)
+            self.sent += 1
+        except (IOError, socket.error) as e:
+            logging.warn('Lost Dispatch connection: {0}'.format(e))
+            self.close_connection()
+            self.failures = 1
+            self.retry_at = time.time() + self.backoff
+            self.dropped += 1
+
+    def stats(self):
+        return {'sent': self.sent,
+                'dropped': self.dropped,
+                'connected': self.sock is not None}
+
+    def close_connection(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def close(self):
+        self.close_connection()
+        super(DispatchLogHandler, self).close()
+
+
 class SampleTelemetryStream(TelemetryStream):
     # Implements specific handshaking and parsing for Philips monitor serial protocol
 
@@ -330,23 +1025,31 @@ class SampleTelemetryStream(TelemetryStream):
         self.update_sampled_data(data)
 
         # Call any update functions in the order they were added
-        if data:
-            for f in self.update_funcs:
-                new_data = f(sampled_data=self.sampled_data, **data)
-                data.update(new_data)
+        self.run_update_funcs(data)
 
-        self.logger.info(data)
+        self.data_logger.info(data)
         return data
 
 
 def configure_parser(parser):
-    parser.add_argument('-b', '--binary', help="Name of an hdf5 file for binary logging")
+    parser.add_argument('-b', '--binary', help="Base name for binary wave logs (hdf5 if h5py is available)")
     parser.add_argument('-f', '--file', help="Name of a text file for event logging")
     parser.add_argument('-ht', '--host_time', help="Include host time in file outputs", action='store_true')
-    parser.add_argument('-s', '--splunk', help="Name of a Splunk index for event logging")
+    parser.add_argument('-s', '--splunk', help="Name of a Splunk index for event logging (batched to the HTTP "
+                                                "Event Collector if SPLUNK_HEC_TOKEN is set)")
+    parser.add_argument('--splunk_journal', help="File for Splunk events while the collector is unreachable",
+                        default='splunk.journal')
+    parser.add_argument('--dispatch', help="Push numerics and alarms to a Dispatch ingest socket, HOST:PORT")
     parser.add_argument('-g', '--gui', help="Display a graphic user interface, e.g., 'SimpleStripchart'")
     # Default for PL203 usb to serial device
     parser.add_argument('-p', '--port', help="Device port (or 'sample')", default="/dev/cu.usbserial")
+    parser.add_argument('--background_updates', help="Run update functions (QoS) on a background thread", action='store_true')
+    parser.add_argument('--qos', choices=['batch', 'streaming', 'compare'], default='batch',
+                        help="Score Pleth quality on the whole window each read, on new samples only, or both")
+    parser.add_argument('--wave_format', choices=['list', 'base64'], default='list',
+                        help="Write waves in the JSON logs as lists of numbers or as base64 encoded arrays")
+    parser.add_argument('--log_queue', help="Max data records waiting for the loggers before the oldest are dropped",
+                        type=int, default=1000)
     parser.add_argument('--values', nargs="+",
                         help="List of paired value names and frequencies to monitor, e.g. 'Pleth 128 ECG 256'",
                         default=['Pleth', 128, 'ECG', 256])
@@ -365,25 +1068,447 @@ def parse_args():
     return _opts
 
 
-def attach_loggers(tstream, opts):
-    # Attach any additional loggers
+def attach_loggers(tstream, opts, sinks=None):
+    # Attach any additional loggers, plus any other sink handlers given.  The data handlers
+    # run on a DataLogQueue's sink thread, the reader only enqueues records; status messages
+    # stay on the root logger.  returns: the DataLogQueues
+    queue = DataLogQueue(sinks, max_pending=getattr(opts, 'log_queue', 1000))
+    queues = [queue]
+    serializer.wave_format = getattr(opts, 'wave_format', 'list')
+
+    if opts.binary:
+        # Store the waveform data in a compact binary format, not as text files; numerics
+        # and alarms still go to the structured logs
+        freqs = dict((key, value['freq']) for key, value in tstream.sampled_data.items())
+        bh = BinaryLogHandler(opts.binary, freqs=freqs)
+        bh.setLevel(logging.INFO)
+        queue.add_sink(bh)
+
     if opts.file:
         # Add a file stuctured log handler that only saves "INFO" level messages
         # Should be able to include the following parameters here: when='h', interval=1, backupCount=0, encoding=None, delay=False, utc=False
-        fh = JSONLogHandler(opts.file, host_time=opts.host_time)
+        fh = JSONLogHandler(opts.file, host_time=opts.host_time, waves=not opts.binary)
         fh.setLevel(logging.INFO)
-        tstream.logger.addHandler(fh)
+        queue.add_sink(fh)
+
+    hec_url = os.environ.get('SPLUNK_HEC_URL')
+    if not hec_url and os.environ.get('SPLUNK_HOST'):
+        hec_url = 'https://{0}:8088'.format(os.environ['SPLUNK_HOST'])
+
+    if opts.splunk and os.environ.get('SPLUNK_HEC_TOKEN') and not hec_url:
+        logging.error('SPLUNK_HEC_TOKEN is set, but neither SPLUNK_HEC_URL nor SPLUNK_HOST is, '
+                      'not logging to Splunk')
+
+    elif opts.splunk and os.environ.get('SPLUNK_HEC_TOKEN'):
+        # Send batches to the HTTP Event Collector, journaled to disk while it's unreachable
+        sh = HECLogHandler(hec_url, os.environ['SPLUNK_HEC_TOKEN'], index=opts.splunk,
+                           journal=getattr(opts, 'splunk_journal', 'splunk.journal'),
+                           verify=os.environ.get('SPLUNK_HEC_VERIFY', '1') != '0',
+                           host_time=opts.host_time, waves=not opts.binary)
+        sh.setLevel(logging.INFO)
+        queue.add_sink(sh)
 
-    if opts.splunk:
+    elif opts.splunk:
         # Add a splunk API structured log handler
-        sh = SplunkLogHandler(opts.splunk)
+        sh = SplunkLogHandler(opts.splunk, waves=not opts.binary)
         sh.setLevel(logging.INFO)
-        tstream.logger.addHandler(sh)
-
-    if opts.binary:
-        # Set flag for a binary file output
-        # You want to store that waveform data in a compact binary format, not as text files
-        pass
+        queue.add_sink(sh)
+
+    if getattr(opts, 'dispatch', None):
+        # Stream records to Dispatch for alerting as they arrive, on a queue and sink thread of
+        # its own, so a slow disk or a Splunk outage can't hold alerts up behind the other sinks
+        dh = DispatchLogHandler(opts.dispatch, host_time=opts.host_time)
+        dh.setLevel(logging.INFO)
+        queues.append(DataLogQueue([dh], max_pending=getattr(opts, 'log_queue', 1000), name='DispatchLogQueue'))
+
+    for queue in queues:
+        if queue.sinks:
+            queue.setLevel(logging.INFO)
+            tstream.data_logger.addHandler(queue)
+            tstream.data_logger.setLevel(logging.INFO)
+            # Records go only to the sinks, not echoed by the console handler on the reader thread
+            tstream.data_logger.propagate = False
+    return queues
+
+
+def test_sampled_data_buffer():
+    # Checks the ring buffer against the original np.roll buffer, including wrap-around,
+    # scalars, and packets longer than the window, then the gap and overlap tracking
+
+    buf = SampledDataBuffer(8, 2)
+    y = np.zeros(buf.size)
+    t0 = buf.start_time
+
+    for i, length in enumerate([3, 5, 1, 7, 16, 2, 20, 4]):
+        values = np.arange(length) + 100*i if length > 1 else np.float64(100*i)
+        buf.rolling_append(t0 + datetime.timedelta(seconds=i+1), values)
+
+        y = np.roll(y, -length)
+        y[-length:] = values[-buf.size:] if length > 1 else values
+
+        assert np.array_equal(buf.y, y)
+        assert np.array_equal(buf.latest(4)[1], y[-4:])
+        assert buf.t[-1] == i + (length-1)/buf.freq
+
+    assert buf.written == 58
+    assert not buf.y.flags.writeable
+
+    # 125 Hz, 32 sample packets are 2048 ticks apart; start just before RelativeTime wraps
+    buf = SampledDataBuffer(125, 2)
+    tick = 2**32 - 3*2048
+    for i in range(6):
+        buf.rolling_append(None, np.ones(32), tick % 2**32)
+        tick += 2048
+    assert buf.coverage() == 1.0 and buf.dropped_packets == 0
+    assert np.allclose(np.diff(buf.t[-192:]), 1/125)
+
+    # Drop a packet, then repeat one
+    tick += 2048
+    buf.rolling_append(None, np.ones(32), tick % 2**32)
+    buf.rolling_append(None, np.ones(32), tick % 2**32)
+    assert buf.dropped_packets == 1 and buf.missing_samples() == 32
+    assert buf.overlaps == 1 and buf.overlap_samples == 32
+    assert buf.real_samples() == 250 and buf.coverage() == 250/282
+    assert buf.t[-1] == buf.t[-33] == (7*2048 + 31*64)/8000
+
+
+def test_update_kwargs():
+    # Each stream hands its own settings to its update funcs, in the foreground and on the
+    # background worker, so two streams in one process don't share them
+
+    def mode(*args, **kwargs):
+        return {'mode': kwargs.get('qos_mode')}
+
+    streams = []
+    for qos_mode, background in (('batch', False), ('streaming', False), ('compare', True)):
+        tstream = SampleTelemetryStream(background_updates=background)
+        tstream.update_kwargs['qos_mode'] = qos_mode
+        tstream.add_update_func(mode)
+        streams.append(tstream)
+
+    for tstream in streams:
+        data = {'timestamp': datetime.datetime.now()}
+        tstream.run_update_funcs(data)
+        if tstream.background_updates:
+            tic = time.time()
+            while 'mode' not in data and time.time() < tic + 2:
+                time.sleep(0.01)
+                tstream.run_update_funcs(data)
+        assert data['mode'] == tstream.update_kwargs['qos_mode'] and 'qos_mode' not in data
+
+
+def test_record_serializer():
+    # With host time, every sink stamps the time the record was logged, however long it
+    # waited on the queue
+
+    record = logging.makeLogRecord({'msg': {'timestamp': datetime.datetime(2016, 10, 25, 11, 0, 0),
+                                            'Heart Rate': 80, 'Pleth': np.zeros(32)}})
+    record.created -= 5
+    logged = datetime.datetime.fromtimestamp(record.created).isoformat()
+
+    assert json.loads(serializer.encode(record))['timestamp'] == '2016-10-25T11:00:00'
+    with_waves = json.loads(serializer.encode(record, True, True))
+    without_waves = json.loads(serializer.encode(record, False, True))
+    assert with_waves['timestamp'] == without_waves['timestamp'] == logged
+    assert 'Pleth' in with_waves and 'Pleth' not in without_waves
+
+
+def test_hec_log_handler():
+    # Runs HECLogHandler against a stub collector on localhost: batching over one keep-alive
+    # connection, an outage spilled to the journal, and the journal replayed in order
+
+    try:
+        import BaseHTTPServer
+        import SocketServer
+    except ImportError:
+        import http.server as BaseHTTPServer
+        import socketserver as SocketServer
+    import tempfile
+
+    collector = {'down': False, 'payloads': [], 'connections': set()}
+
+    class Collector(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            collector['connections'].add(self.client_address)
+            status = 503 if collector['down'] else 200
+            if status == 200:
+                assert self.headers['Authorization'] == 'Splunk test-token'
+                collector['payloads'].append(body)
+            reply = b'{"text":"Server is busy","code":9}' if status == 503 else b'{"text":"Success","code":0}'
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Collector)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    journal = os.path.join(tempfile.mkdtemp(), 'splunk.journal')
+    handler = HECLogHandler('http://127.0.0.1:{0}'.format(server.server_address[1]), 'test-token',
+                            index='perseus', journal=journal, batch_size=600, flush_interval=60,
+                            retries=2, backoff=0.01)
+
+    def log(i):
+        handler.handle(logging.makeLogRecord({'levelno': logging.INFO, 'levelname': 'INFO',
+                                              'msg': {'timestamp': datetime.datetime(2016, 10, 25, 11, 0, i),
+                                                      'i': i, 'Heart Rate': 80}}))
+
+    def received():
+        return [json.loads(line)['event']['i']
+                for payload in collector['payloads'] for line in payload.splitlines()]
+
+    for i in range(10):
+        log(i)
+    handler.flush()
+    assert received() == list(range(10))
+    assert 1 < len(collector['payloads']) < 10
+    assert len(collector['connections']) == 1
+
+    # Outage: batches go to the journal, then skip the server while backing off
+    collector['down'] = True
+    for i in range(10, 20):
+        log(i)
+    handler.flush()
+    assert handler.spilled == 10 and os.path.getsize(journal)
+    assert received() == list(range(10))
+
+    # Back up: the journal goes out before new events
+    collector['down'] = False
+    handler.retry_at = 0
+    for i in range(20, 25):
+        log(i)
+    handler.flush()
+    assert received() == list(range(25))
+    assert handler.replayed == 10 and not os.path.exists(journal)
+
+    event = json.loads(collector['payloads'][0].splitlines()[0])
+    assert event['index'] == 'perseus' and event['event']['timestamp'] == '2016-10-25T11:00:00'
+
+    handler.close()
+    server.shutdown()
+
+
+def test_dispatch_log_handler():
+    # Pushes records to a stub Dispatch socket: waves left out, records dropped while it's
+    # down, and the connection picked up again once it's back; a Dispatch that doesn't answer
+    # holds a record up for no more than connect_timeout
+
+    try:
+        import SocketServer
+    except ImportError:
+        import socketserver as SocketServer
+
+    lines = []
+
+    class Ingest(SocketServer.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                lines.append(json.loads(line))
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Ingest)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+
+    handler = DispatchLogHandler('127.0.0.1:{0}'.format(port), host='bed1', backoff=0.01)
+
+    def log(i):
+        handler.handle(logging.makeLogRecord({'levelno': logging.INFO, 'levelname': 'INFO',
+                                              'msg': {'timestamp': datetime.datetime(2016, 10, 25, 11, 0, i),
+                                                      'i': i, 'Heart Rate': 80, 'Pleth': np.zeros(32)}}))
+
+    def wait(count):
+        tic = time.time()
+        while len(lines) < count and time.time() < tic + 2:
+            time.sleep(0.01)
+
+    for i in range(5):
+        log(i)
+    wait(5)
+    assert [line['event']['i'] for line in lines] == list(range(5))
+    assert lines[0]['host'] == 'bed1' and lines[0]['event']['timestamp'] == '2016-10-25T11:00:00'
+    assert 'Pleth' not in lines[0]['event']
+
+    # Dispatch goes down
+    server.shutdown()
+    server.server_close()
+    handler.close_connection()
+    handler.retry_at = 0
+    for i in range(5, 10):
+        log(i)
+    assert handler.dropped == 5 and handler.failures
+
+    # And comes back on the same port
+    server = Server(('127.0.0.1', port), Ingest)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    handler.retry_at = 0
+    log(10)
+    wait(6)
+    assert lines[-1]['event']['i'] == 10 and handler.stats()['sent'] == 6
+
+    handler.close()
+    server.shutdown()
+
+    # A Dispatch whose accept queue is full never answers the connect
+    stalled = socket.socket()
+    stalled.bind(('127.0.0.1', 0))
+    stalled.listen(0)
+    queued = socket.create_connection(stalled.getsockname())
+    handler = DispatchLogHandler(stalled.getsockname(), host='bed1')
+    tic = time.time()
+    log(11)
+    assert time.time() - tic < 1 and handler.dropped == 1 and handler.failures == 1
+    handler.close()
+    queued.close()
+    stalled.close()
+
+
+def test_dispatch_queue():
+    # A sink that stalls, as HECLogHandler does through a collector outage, doesn't hold up
+    # records pushed to Dispatch, which get their own DataLogQueue
+
+    try:
+        import SocketServer
+    except ImportError:
+        import socketserver as SocketServer
+
+    lines = []
+
+    class Ingest(SocketServer.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                lines.append((time.time(), json.loads(line)))
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    class StalledSink(logging.Handler):
+        def emit(self, record):
+            time.sleep(2)
+
+    server = Server(('127.0.0.1', 0), Ingest)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    class Stream(object):
+        data_logger = logging.getLogger('PERSEUS.data.test_dispatch_queue')
+        sampled_data = {}
+
+    opts = configure_parser(argparse.ArgumentParser()).parse_args(
+        ['--dispatch', '127.0.0.1:{0}'.format(server.server_address[1])])
+    queues = attach_loggers(Stream, opts, [StalledSink()])
+    assert len(queues) == 2 and queues[1].name == 'DispatchLogQueue'
+
+    tic = time.time()
+    for i in range(4):
+        Stream.data_logger.info({'timestamp': datetime.datetime.now(), 'i': i, 'Heart Rate': 80})
+    while len(lines) < 4 and time.time() < tic + 1:
+        time.sleep(0.01)
+    assert [line['event']['i'] for t, line in lines] == list(range(4))
+    assert lines[-1][0] - tic < 1 and queues[0].stats()['depth'] >= 2
+
+    for queue in queues:
+        Stream.data_logger.removeHandler(queue)
+    queues[1].close()
+    server.shutdown()
+
+
+def benchmark_serialization(records=2000, sinks=2):
+    # Compares secs/record for each sink dumping its own copy of a record (the old per-handler
+    # path) vs one shared RecordSerializer encoding, for a 250ms packet of ECG and Pleth
+
+    class TelemetryEncoder(json.JSONEncoder):
+        def default(self, o):
+            if isinstance(o, datetime.datetime):
+                return o.isoformat()
+            if type(o).__module__ == np.__name__:
+                return o.tolist()
+            return json.JSONEncoder.default(self, o)
+
+    now = datetime.datetime.now()
+    msgs = [{'timestamp': now + datetime.timedelta(seconds=i/4), 'ECG': np.random.random(64),
+             'Pleth': np.random.random(32), 'Heart Rate': 80, 'SpO2': 95, 'qos': np.int8(1),
+             'alarms': {'A0': {'type': None, 'source': None}}} for i in range(records)]
+
+    tic = time.time()
+    for msg in msgs:
+        for i in range(sinks):
+            ordered = collections.OrderedDict([('timestamp', msg['timestamp'])])
+            ordered.update(msg)
+            json.dumps(ordered, cls=TelemetryEncoder, ensure_ascii=False).encode('ascii', errors='ignore')
+    per_sink = (time.time() - tic)/records
+
+    ret = {}
+    for wave_format in ['list', 'base64']:
+        encoder = RecordSerializer(wave_format)
+        tic = time.time()
+        for msg in msgs:
+            record = logging.makeLogRecord({'msg': msg})
+            for i in range(sinks):
+                encoder.encode(record)
+        ret[wave_format] = (time.time() - tic)/records
+
+    logging.info('{0} sinks: per-sink json.dumps {1:.3f} ms/record, shared {2} {3:.3f} ms/record, '
+                 'base64 {4:.3f} ms/record'.format(sinks, 1000*per_sink, 'orjson' if orjson else 'json',
+                                                   1000*ret['list'], 1000*ret['base64']))
+
+
+def benchmark_sampled_data_buffer(channels=16, freq=256, dur=7, packets=2000):
+    # Compares appends/sec for the ring buffer vs np.roll (and linspace times), with 250ms
+    # packets timed in monitor ticks
+
+    def roll_append(buf, values, times):
+        buf.y = np.roll(buf.y, -values.size)
+        buf.y[-values.size:] = values
+        buf.t = np.roll(buf.t, -values.size)
+        buf.t[-values.size:] = times
+
+    class RollBuffer(object):
+        def __init__(self):
+            self.y = np.zeros(freq*dur)
+            self.t = np.zeros(freq*dur)
+
+    length = freq//4
+    values = np.random.random(length)
+    now = datetime.datetime.now()
+
+    rolled = [RollBuffer() for i in range(channels)]
+    tic = time.time()
+    for i in range(packets):
+        times = np.linspace(i, i+0.25, length)
+        for buf in rolled:
+            roll_append(buf, values, times)
+    roll_rate = packets*channels/(time.time() - tic)
+
+    ring = [SampledDataBuffer(freq, dur) for i in range(channels)]
+    tic = time.time()
+    for i in range(packets):
+        for buf in ring:
+            buf.rolling_append(now + datetime.timedelta(seconds=i/4), values, i*2000)
+    ring_rate = packets*channels/(time.time() - tic)
+
+    logging.info('{0} channels at {1} Hz: np.roll {2:.0f} appends/s, ring buffer {3:.0f} appends/s ({4:.1f}x)'
+                 .format(channels, freq, roll_rate, ring_rate, ring_rate/roll_rate))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,256 @@
+"""
+Binary waveform logging for PERSEUS telemetry streams
+
+Wave arrays (ECG, Pleth, ...) are appended to per-channel, chunked, compressed
+datasets rather than written to the JSON event logs as text.  Each chunk is
+indexed by its timestamp (and monitor RelativeTime if known), so a time range
+can be read back without decoding the whole file.
+
+Uses HDF5 if h5py is available, otherwise a simple length-prefixed chunk file
+of zlib-compressed float32 arrays.  Files are rotated every `interval` secs.
+
+Dependencies: numpy, h5py (optional)
+"""
+
+from __future__ import division
+
+import datetime
+import glob
+import logging
+import struct
+import time
+import zlib
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def epoch(ts):
+    # Seconds since the epoch for a (naive, local) datetime
+    return time.mktime(ts.timetuple()) + ts.microsecond/1e6
+
+
+class HDF5WaveFile(object):
+    # One group per channel with 'values' (float32, chunked, compressed) and
+    # 'index' rows of (timestamp, relative_time, offset of the first sample)
+
+    extension = '.h5'
+
+    def __init__(self, filename, mode='a'):
+        self.filename = filename
+        self.f = h5py.File(filename, mode)
+
+    def append(self, channel, timestamp, relative_time, fs, values):
+        if channel not in self.f:
+            group = self.f.create_group(channel)
+            group.attrs['fs'] = fs
+            group.create_dataset('values', (0,), maxshape=(None,), dtype='float32',
+                                 chunks=(4096,), compression='gzip', shuffle=True)
+            group.create_dataset('index', (0, 3), maxshape=(None, 3), dtype='float64',
+                                 chunks=(256, 3))
+        group = self.f[channel]
+
+        offset = group['values'].shape[0]
+        group['values'].resize((offset + values.size,))
+        group['values'][offset:] = values
+
+        n = group['index'].shape[0]
+        group['index'].resize((n + 1, 3))
+        group['index'][n] = (timestamp, relative_time, offset)
+
+    def channels(self):
+        return list(self.f.keys())
+
+    def chunks(self, channel):
+        # returns: [(timestamp, relative_time, fs, values)] for a channel
+        group = self.f[channel]
+        index = group['index'][:]
+        offsets = list(index[:, 2].astype(np.int64)) + [group['values'].shape[0]]
+        values = group['values']
+        fs = float(group.attrs['fs'])
+        return [(index[i, 0], int(index[i, 1]), fs, lambda a=offsets[i], b=offsets[i+1]: values[a:b])
+                for i in range(index.shape[0])]
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class ChunkWaveFile(object):
+    # A stream of chunks, each a fixed header, the channel name, then zlib'd
+    # little-endian float32 samples:
+    #   magic, name length, timestamp, relative_time, fs, payload length
+
+    extension = '.pwv'
+    HEADER = struct.Struct('<4sHdqfI')
+    MAGIC = b'PWV1'
+
+    def __init__(self, filename, mode='a'):
+        self.filename = filename
+        self.f = open(filename, mode + 'b')
+
+    def append(self, channel, timestamp, relative_time, fs, values):
+        name = channel.encode('utf-8')
+        payload = zlib.compress(values.astype('<f4').tobytes(), 6)
+        self.f.write(self.HEADER.pack(self.MAGIC, len(name), timestamp, relative_time, fs, len(payload)))
+        self.f.write(name)
+        self.f.write(payload)
+
+    def scan(self):
+        # returns: {channel: [(timestamp, relative_time, fs, payload offset, payload length)]},
+        # reading only the headers
+        index = {}
+        self.f.seek(0)
+        while 1:
+            header = self.f.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                break
+            magic, name_length, timestamp, relative_time, fs, length = self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                logging.warn('Corrupt chunk in {0}, ignoring the rest'.format(self.filename))
+                break
+            channel = self.f.read(name_length).decode('utf-8')
+            index.setdefault(channel, []).append((timestamp, relative_time, fs, self.f.tell(), length))
+            self.f.seek(length, 1)
+        return index
+
+    def channels(self):
+        return list(self.scan().keys())
+
+    def chunks(self, channel):
+        # returns: [(timestamp, relative_time, fs, values)] for a channel
+        return [(timestamp, relative_time, fs, lambda offset=offset, length=length: self.read_payload(offset, length))
+                for timestamp, relative_time, fs, offset, length in self.scan().get(channel, [])]
+
+    def read_payload(self, offset, length):
+        self.f.seek(offset)
+        return np.frombuffer(zlib.decompress(self.f.read(length)), dtype='<f4')
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class BinaryLogHandler(logging.Handler):
+    # Takes the wave arrays out of each INFO record and appends them to the binary file;
+    # everything else is left to the JSON loggers
+
+    def __init__(self, filename, freqs=None, interval=3600, use_hdf5=None):
+        super(BinaryLogHandler, self).__init__()
+        self.base_filename = filename
+        # {channel: sampling frequency}, stored with each channel
+        self.freqs = freqs or {}
+        self.interval = interval
+        if use_hdf5 is None:
+            use_hdf5 = h5py is not None
+        self.file_type = HDF5WaveFile if use_hdf5 else ChunkWaveFile
+        self.wave_file = None
+        self.rollover_at = 0
+
+    def rotate(self, now):
+        if self.wave_file:
+            self.wave_file.close()
+        filename = '{0}.{1}{2}'.format(self.base_filename,
+                                       datetime.datetime.fromtimestamp(now).strftime('%Y%m%d-%H%M%S'),
+                                       self.file_type.extension)
+        self.wave_file = self.file_type(filename)
+        self.rollover_at = now + self.interval
+        logging.debug('Logging waves to {0}'.format(filename))
+
+    def emit(self, record):
+        if not isinstance(record.msg, dict): return
+        if record.levelno != logging.INFO: return
+
+        waves = [(key, value) for key, value in record.msg.items() if isinstance(value, np.ndarray)]
+        if not waves: return
+
+        now = time.time()
+        if now >= self.rollover_at:
+            self.rotate(now)
+
+        ts = record.msg.get('timestamp')
+        timestamp = epoch(ts) if isinstance(ts, datetime.datetime) else now
+        relative_time = record.msg.get('relative_time')
+        if relative_time is None:
+            relative_time = -1
+
+        try:
+            for key, value in waves:
+                self.wave_file.append(key, timestamp, relative_time, self.freqs.get(key, 0), value.ravel())
+            self.wave_file.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.wave_file:
+            self.wave_file.close()
+            self.wave_file = None
+        super(BinaryLogHandler, self).close()
+
+
+class WaveReader(object):
+    # Reads back waves written by BinaryLogHandler from one or more (rotated) files,
+    # given as a list of names or a glob pattern like 'waves.*'
+
+    def __init__(self, filenames):
+        if isinstance(filenames, (list, tuple)):
+            self.filenames = sorted(filenames)
+        else:
+            self.filenames = sorted(glob.glob(filenames))
+        self.files = [self.open(filename) for filename in self.filenames]
+
+    @staticmethod
+    def open(filename):
+        if filename.endswith(HDF5WaveFile.extension):
+            if h5py is None:
+                raise ImportError('h5py is needed to read {0}'.format(filename))
+            return HDF5WaveFile(filename, 'r')
+        return ChunkWaveFile(filename, 'r')
+
+    def channels(self):
+        ret = set()
+        for f in self.files:
+            ret.update(f.channels())
+        return sorted(ret)
+
+    def index(self, channel):
+        # returns: (timestamp, relative_time, fs) for each chunk of a channel, in file order
+        return [chunk[:3] for f in self.files for chunk in f.chunks(channel)]
+
+    def read(self, channel, start=None, end=None):
+        """
+        Reads a channel between start and end (datetimes or epoch secs, by
+        chunk timestamp), returns (t, y) with t in epoch secs for each sample
+        """
+        if isinstance(start, datetime.datetime):
+            start = epoch(start)
+        if isinstance(end, datetime.datetime):
+            end = epoch(end)
+
+        t = []
+        y = []
+        for f in self.files:
+            for timestamp, relative_time, fs, values in f.chunks(channel):
+                if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                    continue
+                values = values()
+                y.append(values)
+                if fs:
+                    t.append(timestamp + np.arange(values.size)/fs)
+                else:
+                    t.append(np.repeat(timestamp, values.size))
+
+        if not y:
+            return np.zeros(0), np.zeros(0, dtype='float32')
+        return np.concatenate(t), np.concatenate(y)
+
+    def close(self):
+        for f in self.files:
+            f.close()
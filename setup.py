@@ -47,12 +47,14 @@ setup(
     url=__url__,
     license=__license__,
     py_modules=["PERSEUS",
-                "Dispatch.Dispatch", "Dispatch.Messenger", "Dispatch.EventStore",
+                "Dispatch.Dispatch", "Dispatch.Messenger", "Dispatch.EventStore", "Dispatch.StreamDispatch",
                 "TelemetryLogger.CWRU_utils",
                 "TelemetryStream.TelemetryStream",
                 "TelemetryStream.SimpleStripChart",
                 "TelemetryStream.PhilipsTelemetryStream",
                 "TelemetryStream.QualityOfSignal",
+                "TelemetryStream.BatchQualityOfSignal",
+                "TelemetryStream.WaveformLog",
                 "TelemetryStream.IntellivueProtocol.IntellivueDecoder",
                 "TelemetryStream.IntellivueProtocol.IntellivueDistiller",
                 "TelemetryStream.IntellivueProtocol.RS232"],